@@ -1,12 +1,32 @@
+"""
+Инициализация узлов PostgreSQL по SQL-шаблонам:
+- Шаблоны рендерятся один раз общим окружением Jinja до подключения к узлам
+- Шаги узла (SQL узла, затем SQL перекрестного доступа) выполняются по порядку в одном соединении,
+  а узлы настраиваются параллельно - время развертывания определяет самый медленный узел, а не их сумма
+- Готовность узла проверяется опросом с экспоненциальной задержкой вместо фиксированных пауз
+- Шаблоны идемпотентны (IF NOT EXISTS), поэтому повторный запуск безопасен
+"""
+
 import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg2
-from psycopg2 import sql
 from jinja2 import Environment, FileSystemLoader
 from dotenv import dotenv_values
 import logging
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
 
+SQL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql")
+# Сколько ждать готовности узла
+READY_TIMEOUT_SECONDS = float(os.environ.get("SETUP_READY_TIMEOUT_SECONDS", "120"))
+READY_MAX_DELAY_SECONDS = 5.0
+
+# Окружение Jinja общее для всех шаблонов: скомпилированные шаблоны кешируются в нем
+TEMPLATES = Environment(loader=FileSystemLoader(SQL_DIR))
+
 def load_env(env_path):
     if not os.path.exists(env_path):
         raise FileNotFoundError(f"Env-файл {env_path} не найден")
@@ -24,66 +44,73 @@ def build_dsn(env):
 
     return f"postgresql://{user}:{password}@{host}:{port}/{dbname}"
 
-def apply_template_sql(dsn, template_file, template_data):
-    env = Environment(loader=FileSystemLoader("sql"))
-    template = env.get_template(template_file)
-    rendered_sql = template.render(template_data)
+def render_template(template_file, template_data):
+    return TEMPLATES.get_template(template_file).render(template_data)
 
-    logging.info(f"Подключение к БД: {dsn}")
-    conn = psycopg2.connect(dsn)
-    conn.autocommit = True
+def wait_for_postgres(dsn, name, timeout=READY_TIMEOUT_SECONDS):
+    """Ожидает, пока узел начнет принимать подключения; возвращает открытое соединение"""
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    while True:
+        try:
+            conn = psycopg2.connect(dsn, connect_timeout=5)
+            logging.info(f"{name} готов")
+            return conn
+        except psycopg2.OperationalError as e:
+            if time.monotonic() + delay > deadline:
+                raise TimeoutError(f"{name} не готов за {timeout:g}с: {e}")
+            logging.info(f"Ожидание {name} (повтор через {delay:.1f}с)...")
+            time.sleep(delay)
+            delay = min(READY_MAX_DELAY_SECONDS, delay * 2) * random.uniform(0.8, 1.0)
+
+def setup_node(name, dsn, steps):
+    """Выполняет шаги узла по порядку; каждый шаг - в своей транзакции"""
+    started = time.monotonic()
+    conn = wait_for_postgres(dsn, name)
     try:
-        with conn.cursor() as cur:
-            cur.execute(rendered_sql)
-        logging.info(f"SQL из шаблона {template_file} выполнен успешно!")
+        for template_file, rendered_sql in steps:
+            with conn, conn.cursor() as cur:
+                cur.execute(rendered_sql)
+            logging.info(f"[{name}] SQL из шаблона {template_file} выполнен успешно!")
     finally:
         conn.close()
+    logging.info(f"[{name}] Настройка завершена за {time.monotonic() - started:.1f}с")
 
-def main():
-    first_env_path = "pg_first.env"
-    second_env_path = "pg_second.env"
-
-    first_env = load_env(first_env_path)
-    second_env = load_env(second_env_path)
-
-    first_dsn = build_dsn(first_env)
-    second_dsn = build_dsn(second_env)
-
-    first_template_data = {
-        "LocalUser": first_env.get("LOCAL_USER"),
-        "LocalPass": first_env.get("LOCAL_PASS"),
-        "CrossUser": first_env.get("CROSS_USER"),
-        "CrossPass": first_env.get("CROSS_PASS"),
-        "DbName": first_env.get("POSTGRES_DB")
+def node_steps(node, env, remote_env):
+    """Шаги настройки узла: SQL узла, затем SQL перекрестного доступа (зависит от таблиц и ролей узла)"""
+    template_data = {
+        "LocalUser": env.get("LOCAL_USER"),
+        "LocalPass": env.get("LOCAL_PASS"),
+        "CrossUser": env.get("CROSS_USER"),
+        "CrossPass": env.get("CROSS_PASS"),
+        "DbName": env.get("POSTGRES_DB")
     }
-
-    second_template_data = {
-        "LocalUser": second_env.get("LOCAL_USER"),
-        "LocalPass": second_env.get("LOCAL_PASS"),
-        "CrossUser": second_env.get("CROSS_USER"),
-        "CrossPass": second_env.get("CROSS_PASS"),
-        "DbName": second_env.get("POSTGRES_DB")
+    cross_access_data = {
+        "RemoteCrossUser": remote_env.get("CROSS_USER"),
+        "RemoteCrossPass": remote_env.get("CROSS_PASS"),
+        "DbName": env.get("POSTGRES_DB")
     }
+    return [
+        (f"{node}.sql.tmpl", render_template(f"{node}.sql.tmpl", template_data)),
+        (f"{node}_cross_access.sql.tmpl", render_template(f"{node}_cross_access.sql.tmpl", cross_access_data)),
+    ]
 
-    logging.info("=== Настройка postgres_node1 ===")
-    apply_template_sql(first_dsn, "postgres_node1.sql.tmpl", first_template_data)
-    
-    first_cross_access_data = {
-        "RemoteCrossUser": second_env.get("CROSS_USER"),
-        "RemoteCrossPass": second_env.get("CROSS_PASS"),
-        "DbName": first_env.get("POSTGRES_DB")
-    }
-    apply_template_sql(first_dsn, "postgres_node1_cross_access.sql.tmpl", first_cross_access_data)
-
-    logging.info("=== Настройка postgres_node2 ===")
-    apply_template_sql(second_dsn, "postgres_node2.sql.tmpl", second_template_data)
-    
-    second_cross_access_data = {
-        "RemoteCrossUser": first_env.get("CROSS_USER"),
-        "RemoteCrossPass": first_env.get("CROSS_PASS"),
-        "DbName": second_env.get("POSTGRES_DB")
-    }
-    apply_template_sql(second_dsn, "postgres_node2_cross_access.sql.tmpl", second_cross_access_data)
+def main():
+    first_env = load_env("pg_first.env")
+    second_env = load_env("pg_second.env")
+
+    # Все шаблоны рендерятся до подключения: ошибка в шаблоне не оставит узлы настроенными наполовину
+    nodes = [
+        ("postgres_node1", build_dsn(first_env), node_steps("postgres_node1", first_env, second_env)),
+        ("postgres_node2", build_dsn(second_env), node_steps("postgres_node2", second_env, first_env)),
+    ]
+
+    started = time.monotonic()
+    logging.info("=== Настройка " + ", ".join(name for name, _, _ in nodes) + " ===")
+    with ThreadPoolExecutor(max_workers=len(nodes)) as pool:
+        for future in [pool.submit(setup_node, *node) for node in nodes]:
+            future.result()
+    logging.info(f"Все узлы настроены за {time.monotonic() - started:.1f}с")
 
 if __name__ == "__main__":
     main()
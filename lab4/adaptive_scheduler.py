@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Адаптивный планировщик циклов синхронизации (общий для заданий MongoDB и PostgreSQL):
+- Каждая пара источник -> приемник планируется независимо в своем потоке
+- Интервал подстраивается под поток изменений: сокращается, пока изменения есть, и растет в простое
+- Недоступный узел повторяется с экспоненциальной задержкой со случайным разбросом (jitter)
+- Интервал не превышает SLO по устареванию данных (MAX_STALENESS_SECONDS); нарушения SLO логируются
+"""
+
+import os
+import random
+import threading
+import time
+
+from replication_metrics import metrics
+
+MIN_INTERVAL_SECONDS = float(os.environ.get("SCHEDULER_MIN_INTERVAL_SECONDS", "1"))
+MAX_INTERVAL_SECONDS = float(os.environ.get("SCHEDULER_MAX_INTERVAL_SECONDS", "60"))
+# Максимально допустимое отставание реплики от источника
+MAX_STALENESS_SECONDS = float(os.environ.get("MAX_STALENESS_SECONDS", "30"))
+BACKOFF_BASE_SECONDS = float(os.environ.get("BACKOFF_BASE_SECONDS", "1"))
+BACKOFF_MAX_SECONDS = float(os.environ.get("BACKOFF_MAX_SECONDS", "60"))
+# Во сколько раз сокращается интервал при изменениях и растет без них
+SPEEDUP_FACTOR = 2.0
+SLOWDOWN_FACTOR = 1.5
+
+
+class Backoff:
+    """Экспоненциальная задержка с jitter: случайное значение из [cap/2, cap], cap = base * 2^(ошибок-1)"""
+
+    def __init__(self, base=BACKOFF_BASE_SECONDS, maximum=BACKOFF_MAX_SECONDS):
+        self.base = base
+        self.maximum = maximum
+        self.failures = 0
+
+    def next_delay(self):
+        self.failures += 1
+        cap = min(self.maximum, self.base * 2 ** (self.failures - 1))
+        return random.uniform(cap / 2, cap)
+
+    def reset(self):
+        self.failures = 0
+
+
+class ScheduledPair:
+    """Пара источник -> приемник и состояние ее расписания"""
+
+    def __init__(self, name, task, interval):
+        self.name = name
+        self.task = task
+        self.interval = interval
+        self.backoff = Backoff()
+        self.created = time.time()
+        self.last_success = None
+        self.last_duration = 0.0
+        self.slo_violated = False
+
+
+class AdaptiveScheduler:
+    """
+    Запускает задачи синхронизации по адаптивному расписанию.
+    Задача - функция без аргументов, возвращающая число примененных изменений; исключение - недоступный узел
+    """
+
+    def __init__(self, job, initial_interval=MIN_INTERVAL_SECONDS, min_interval=MIN_INTERVAL_SECONDS,
+                 max_interval=MAX_INTERVAL_SECONDS, max_staleness=MAX_STALENESS_SECONDS, log=print):
+        self.job = job
+        self.initial_interval = initial_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_staleness = max_staleness
+        self.log = log
+        self.pairs = []
+
+    def add(self, name, task):
+        pair = ScheduledPair(name, task, min(max(self.initial_interval, self.min_interval), self.max_interval))
+        self.pairs.append(pair)
+        metrics.set_function("replication_staleness_seconds", lambda: self.staleness(pair), job=self.job, pair=name)
+        return pair
+
+    def staleness(self, pair):
+        """Время с последнего успешного цикла (до первого успеха - с запуска)"""
+        return time.time() - (pair.last_success or pair.created)
+
+    def next_interval(self, pair, changes):
+        """Интервал до следующего цикла: короче при изменениях, длиннее в простое, в пределах SLO"""
+        if changes:
+            interval = pair.interval / SPEEDUP_FACTOR
+        else:
+            interval = pair.interval * SLOWDOWN_FACTOR
+        # Следующий цикл должен завершиться до истечения SLO с учетом длительности последнего цикла
+        slo_limit = self.max_staleness - pair.last_duration
+        return max(self.min_interval, min(interval, self.max_interval, slo_limit))
+
+    def run_once(self, pair):
+        """Выполняет один цикл пары; возвращает задержку до следующего запуска"""
+        started = time.time()
+        try:
+            changes = pair.task()
+        except Exception as e:
+            delay = pair.backoff.next_delay()
+            metrics.inc("replication_errors_total", job=self.job, pair=pair.name)
+            self.log(f"⚠ {pair.name}: ошибка синхронизации ({e}), повтор через {delay:.1f}с "
+                     f"(попытка {pair.backoff.failures})")
+            self.check_slo(pair)
+            return delay
+        pair.backoff.reset()
+        pair.last_success = started
+        pair.last_duration = time.time() - started
+        pair.interval = self.next_interval(pair, changes)
+        if pair.slo_violated:
+            self.log(f"✓ {pair.name}: отставание снова в пределах SLO ({self.max_staleness:g}с)")
+            pair.slo_violated = False
+        return pair.interval
+
+    def check_slo(self, pair):
+        staleness = self.staleness(pair)
+        if staleness > self.max_staleness and not pair.slo_violated:
+            pair.slo_violated = True
+            self.log(f"⚠ {pair.name}: данные устарели на {staleness:.0f}с, SLO {self.max_staleness:g}с нарушен")
+
+    def _run_pair(self, pair):
+        while True:
+            time.sleep(self.run_once(pair))
+
+    def run_forever(self):
+        """Запускает все пары в отдельных потоках и не возвращает управление"""
+        threads = []
+        for pair in self.pairs:
+            thread = threading.Thread(target=self._run_pair, args=(pair,), name=f"schedule-{pair.name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
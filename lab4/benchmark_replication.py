@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный замер путей репликации:
+- MongoDB: sync_collection (основной узел -> три реплики) и sync_between_replicas на локальных mongod
+  (--mongo-uris: источник и три реплики) или на mongomock в памяти процесса, если адреса не заданы
+- PostgreSQL: снимок через COPY (pg_snapshot) и задержка логической репликации (pg_logical_replication)
+  на локальных серверах (--pg-source с wal_level=logical, --pg-replica)
+- Перебираются размеры данных (--sizes) и доли измененных документов (--change-ratios)
+- Каждый замер выполняется в отдельном процессе, поэтому пиковый RSS относится только к нему
+- Время цикла, пропускная способность, пиковый RSS и задержка сохраняются в JSON для сравнения версий
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+BENCH_DB = "replication_bench"
+BENCH_COLLECTION = "users"
+BENCH_TABLE = "bench_rows"
+# Размер пачки при изменении документов и строк
+CHANGE_BATCH_SIZE = 10000
+# Переменные окружения, влияющие на пути синхронизации (сохраняются вместе с результатами)
+CONFIG_ENV = (
+    "ANTI_ENTROPY", "SYNC_STREAMING", "SYNC_CONCURRENCY", "SYNC_PARTITIONS", "PARTITION_WORKERS",
+    "WRITE_QUORUM", "WRITE_CONCERN_W", "WRITE_CONCERN_JOURNAL", "MERGE_BATCH_SIZE", "LOOKUP_BATCH_SIZE",
+    "SNAPSHOT_WORKERS",
+)
+MONGO_PATHS = ("sync_collection", "sync_between_replicas")
+POSTGRES_PATHS = ("pg_snapshot", "pg_logical")
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса в мегабайтах (ru_maxrss в Linux - в килобайтах)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measured(started, rss_before, documents, changed, written):
+    """Результат замера: время цикла, пропускная способность и память"""
+    elapsed = time.perf_counter() - started
+    return {
+        "cycle_seconds": round(elapsed, 4),
+        "documents": documents,
+        "changed": changed,
+        "written": written,
+        "throughput_docs_per_second": round(documents / elapsed, 1) if elapsed else None,
+        "changes_per_second": round(written / elapsed, 1) if elapsed else None,
+        # Для опроса задержка - от окончания изменений до завершения цикла, который их применил
+        "lag_seconds": round(elapsed, 4),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "cycle_rss_growth_mb": round(max(0.0, peak_rss_mb() - rss_before), 1),
+    }
+
+
+# --- MongoDB ---
+
+def mongo_clients(uris):
+    """Клиенты источника и трех реплик: локальные mongod или mongomock"""
+    if uris:
+        import pymongo
+        return [pymongo.MongoClient(uri) for uri in uris]
+    try:
+        import mongomock
+    except ImportError:
+        sys.exit("Нужен mongomock (pip install mongomock) или адреса mongod в --mongo-uris")
+    return [mongomock.MongoClient() for _ in range(4)]
+
+
+def change_documents(collection, count):
+    """
+    Меняет count документов (salary + 1) и обновляет created_at, как при правке приложением;
+    возвращает число измененных. Победителя при синхронизации определяет не created_at, а версия HLC
+    (_version): правку документа основного узла без версии is_source_update распознает по хешу содержимого
+    """
+    if count == 0:
+        return 0
+    ids = [doc["_id"] for doc in collection.find({}, {"_id": 1}).limit(count)]
+    update = {"$inc": {"salary": 1}, "$set": {"created_at": datetime.now().isoformat()}}
+    changed = 0
+    for start in range(0, len(ids), CHANGE_BATCH_SIZE):
+        batch = ids[start:start + CHANGE_BATCH_SIZE]
+        changed += collection.update_many({"_id": {"$in": batch}}, update).modified_count
+    return changed
+
+
+def mongo_case(path, size, ratio, uris):
+    from mongodb_bulk_seed import seed_collection
+    from sync_mongodb_replication import ensure_indexes, sync_between_replicas, sync_collection
+
+    source, *replicas = mongo_clients(uris)
+    for client in [source] + replicas:
+        client.drop_database(BENCH_DB)
+        ensure_indexes(client, BENCH_DB, BENCH_COLLECTION)
+    seed_collection(source[BENCH_DB][BENCH_COLLECTION], size, seed=size)
+    # Прогрев: реплики приводятся к источнику (включая запись версий), замеряется только следующий цикл
+    sync_collection(source, replicas, BENCH_DB, BENCH_COLLECTION)
+
+    if path == "sync_collection":
+        changed = change_documents(source[BENCH_DB][BENCH_COLLECTION], int(size * ratio))
+        rss_before, started = peak_rss_mb(), time.perf_counter()
+        written = sync_collection(source, replicas, BENCH_DB, BENCH_COLLECTION)
+    else:
+        sync_between_replicas(replicas, BENCH_DB, BENCH_COLLECTION)
+        changed = change_documents(replicas[0][BENCH_DB][BENCH_COLLECTION], int(size * ratio))
+        rss_before, started = peak_rss_mb(), time.perf_counter()
+        written = sync_between_replicas(replicas, BENCH_DB, BENCH_COLLECTION)
+    result = measured(started, rss_before, size, changed, written)
+    if uris:
+        for client in [source] + replicas:
+            client.drop_database(BENCH_DB)
+    return result
+
+
+# --- PostgreSQL ---
+
+def pg_execute(dsn, *statements):
+    import psycopg2
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement)
+            return cur.fetchone() if cur.description else None
+    finally:
+        conn.close()
+
+
+def pg_seed(source_dsn, replica_dsn, size):
+    """Создает в источнике таблицу из size строк (на сервере, generate_series) и удаляет ее в реплике"""
+    pg_execute(replica_dsn, f"DROP TABLE IF EXISTS {BENCH_TABLE}")
+    pg_execute(
+        source_dsn,
+        f"DROP TABLE IF EXISTS {BENCH_TABLE}",
+        f"CREATE TABLE {BENCH_TABLE} (id bigint PRIMARY KEY, value integer NOT NULL, payload text NOT NULL)",
+        f"INSERT INTO {BENCH_TABLE} SELECT i, 0, md5(i::text) FROM generate_series(1, {size}) AS i",
+        f"ANALYZE {BENCH_TABLE}",
+    )
+
+
+def pg_checksum(dsn):
+    return pg_execute(dsn, f"SELECT count(*), coalesce(sum(value), 0) FROM {BENCH_TABLE}")
+
+
+def wait_for_checksum(replica_dsn, expected, timeout):
+    """Ждет, пока реплика совпадет с источником; возвращает момент совпадения"""
+    import psycopg2
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if pg_checksum(replica_dsn) == expected:
+                return time.perf_counter()
+        except psycopg2.Error:
+            pass  # Таблица в реплике еще не создана
+        time.sleep(0.01)
+    raise TimeoutError(f"реплика не догнала источник за {timeout:g}с")
+
+
+def drop_slot(source_dsn, slot_name):
+    """Удаляет слот замера, чтобы он не удерживал WAL источника"""
+    pg_execute(source_dsn, f"SELECT pg_terminate_backend(active_pid) FROM pg_replication_slots "
+                           f"WHERE slot_name = '{slot_name}' AND active_pid IS NOT NULL")
+    for _ in range(50):
+        try:
+            pg_execute(source_dsn, f"SELECT pg_drop_replication_slot('{slot_name}')")
+            return
+        except Exception:
+            time.sleep(0.1)
+
+
+def postgres_case(path, size, ratio, source_dsn, replica_dsn, timeout):
+    pg_seed(source_dsn, replica_dsn, size)
+
+    if path == "pg_snapshot":
+        from pg_snapshot import snapshot_database
+
+        rss_before, started = peak_rss_mb(), time.perf_counter()
+        copied = snapshot_database(source_dsn, replica_dsn, [("public", BENCH_TABLE)])
+        return measured(started, rss_before, size, size, sum(copied.values()))
+
+    from pg_logical_replication import LogicalReplicator
+    from sync_state import SyncStateStore
+
+    state_dir = tempfile.mkdtemp(prefix="replication_bench_")
+    replicator = LogicalReplicator({"dsn": source_dsn, "db": "bench"}, replica_dsn,
+                                   SyncStateStore(os.path.join(state_dir, "state.db")))
+    threading.Thread(target=replicator.run, name="bench-replication", daemon=True).start()
+    try:
+        # Начальное копирование после создания слота не входит в замер
+        wait_for_checksum(replica_dsn, pg_checksum(source_dsn), timeout)
+        changed = int(size * ratio)
+        rss_before, started = peak_rss_mb(), time.perf_counter()
+        pg_execute(source_dsn, f"UPDATE {BENCH_TABLE} SET value = value + 1 WHERE id <= {changed}")
+        committed = time.perf_counter()
+        applied = wait_for_checksum(replica_dsn, pg_checksum(source_dsn), timeout)
+        result = measured(started, rss_before, size, changed, changed)
+        result["lag_seconds"] = round(applied - committed, 4)
+        result["changes_per_second"] = round(changed / (applied - committed), 1) if applied > committed else None
+        return result
+    finally:
+        drop_slot(source_dsn, replicator.slot_name)
+
+
+# --- Запуск ---
+
+def run_case(queue, case, args):
+    """Выполняет один замер в дочернем процессе и возвращает результат через очередь"""
+    try:
+        if case["path"] in MONGO_PATHS:
+            result = mongo_case(case["path"], case["size"], case["change_ratio"], args.mongo_uris)
+        else:
+            result = postgres_case(case["path"], case["size"], case["change_ratio"],
+                                   args.pg_source, args.pg_replica, args.timeout)
+    except BaseException as e:
+        result = {"error": f"{type(e).__name__}: {e}"}
+    queue.put(result)
+
+
+def run_isolated(case, args):
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    process = context.Process(target=run_case, args=(queue, case, args))
+    process.start()
+    try:
+        result = queue.get(timeout=args.timeout)
+    except Exception:
+        process.kill()
+        result = {"error": f"замер не завершился за {args.timeout:g}с"}
+    process.join()
+    return {**case, **result}
+
+
+def parse_list(text, kind):
+    return [kind(item) for item in text.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный замер путей репликации MongoDB и PostgreSQL")
+    parser.add_argument("--paths", default=",".join(MONGO_PATHS + POSTGRES_PATHS),
+                        help="пути через запятую: " + ", ".join(MONGO_PATHS + POSTGRES_PATHS))
+    parser.add_argument("--sizes", default="1000,10000,100000", help="размеры данных через запятую (до 10000000)")
+    parser.add_argument("--change-ratios", default="0,0.01,0.1", help="доли измененных документов через запятую")
+    parser.add_argument("--mongo-uris", default="",
+                        help="URI источника и трех реплик через запятую; по умолчанию - mongomock в памяти")
+    parser.add_argument("--pg-source", help="DSN исходной БД PostgreSQL (wal_level=logical)")
+    parser.add_argument("--pg-replica", help="DSN БД-реплики PostgreSQL")
+    parser.add_argument("--timeout", type=float, default=3600, help="максимальная длительность одного замера, с")
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    args.mongo_uris = parse_list(args.mongo_uris, str)
+    if args.mongo_uris and len(args.mongo_uris) != 4:
+        parser.error("--mongo-uris: нужны 4 адреса (источник и три реплики)")
+    paths = parse_list(args.paths, str)
+    if not (args.pg_source and args.pg_replica):
+        skipped = [path for path in paths if path in POSTGRES_PATHS]
+        paths = [path for path in paths if path not in POSTGRES_PATHS]
+        if skipped:
+            print(f"⚠ Пропущены {', '.join(skipped)}: не заданы --pg-source и --pg-replica")
+
+    cases = []
+    for path in paths:
+        for size in parse_list(args.sizes, int):
+            # Снимок копирует таблицу целиком, доля изменений на него не влияет
+            ratios = [1.0] if path == "pg_snapshot" else parse_list(args.change_ratios, float)
+            cases.extend({"path": path, "size": size, "change_ratio": ratio} for ratio in ratios)
+
+    report = {
+        "started_at": datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "mongo_backend": "mongod" if args.mongo_uris else "mongomock",
+        "config": {name: os.environ[name] for name in CONFIG_ENV if name in os.environ},
+        "results": [],
+    }
+    for case in cases:
+        print(f"=== {case['path']}: {case['size']} документов, изменено {case['change_ratio']:.0%} ===")
+        result = run_isolated(case, args)
+        report["results"].append(result)
+        if "error" in result:
+            print(f"⚠ {result['error']}")
+        else:
+            print(f"✓ цикл {result['cycle_seconds']:.3f}с, {result['throughput_docs_per_second']} док/с, "
+                  f"записано {result['written']}, задержка {result['lag_seconds']:.3f}с, "
+                  f"пиковый RSS {result['peak_rss_mb']} МБ")
+        # Результаты сохраняются после каждого замера: прерванный прогон не теряет уже сделанные
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✓ Результаты сохранены в {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,11 @@
+import pytest
+
+import mongodb_tombstones
+
+
+@pytest.fixture(autouse=True)
+def sync_state_path(tmp_path, monkeypatch):
+    """Состояние синхронизации каждого теста - во временном каталоге, а не в рабочем"""
+    path = str(tmp_path / "sync_state.db")
+    monkeypatch.setattr(mongodb_tombstones, 'SYNC_STATE_PATH', path)
+    return path
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Anti-entropy для реплик MongoDB на основе дерева хешей (Merkle tree):
+- Документы раскладываются по LEAF_BUCKETS корзинам по 32-битному хешу ключа name:email (или _id):
+  корзина - непрерывный диапазон хешей, поэтому узлы верхних уровней дерева - тоже диапазоны
+- Хеши содержимого считаются на сервере агрегацией ($function), клиенту передаются только суммы по узлам дерева
+- Сначала сравниваются корни, затем по уровню за раз спуск идет только в различающиеся поддеревья:
+  агрегация следующего уровня читает только документы этих поддеревьев и возвращает не больше FANOUT узлов
+  на каждое, листья запрашиваются только для различающихся поддеревьев предпоследнего уровня
+- Хеш ключа хранится в версии документа (_version.key_hash, индекс на репликах), поэтому документы
+  поддеревьев выбираются диапазонами по индексу. Документы без сохраненного хеша (записанные в обход
+  синхронизации) выбираются всегда - до тех пор, пока синхронизация не запишет им версию.
+  Источник синхронизацией не меняется и хеша ключа не хранит: его листья считаются последними,
+  и агрегация сразу возвращает _id его документов из корзин, которые отличаются от остальных узлов
+"""
+
+import os
+
+import pymongo
+from pymongo.errors import OperationFailure
+
+from mongodb_fanout import fan_out
+
+# Количество листовых корзин и ветвление дерева (LEAF_BUCKETS должно быть степенью FANOUT)
+FANOUT = int(os.environ.get("ANTI_ENTROPY_FANOUT", "16"))
+DEPTH = int(os.environ.get("ANTI_ENTROPY_DEPTH", "3"))
+LEAF_BUCKETS = FANOUT ** DEPTH
+# Больше различающихся документов источника выгоднее сравнить полным проходом, чем перечислять их _id в фильтре
+MAX_SOURCE_IDS = int(os.environ.get("ANTI_ENTROPY_MAX_SOURCE_IDS", "50000"))
+
+KEY_HASH_FIELD = "_version.key_hash"
+HASH_SPACE = 1 << 32
+
+# Ключ документа (как get_doc_key) и канонический вид содержимого без _id и _version, чтобы хеш не зависел
+# от порядка полей и от того, записана ли версия (в источнике ее нет); fnv1a совпадает с mongodb_versioning.key_hash
+_JS_HELPERS = """
+    function docKey(doc) {
+        if (doc.name && doc.email) { return 'k:' + doc.name + ':' + doc.email; }
+        var id = doc._id;
+        return 'id:' + (id && id.str !== undefined ? id.str : String(id));
+    }
+    function canon(v) {
+        if (v === null || v === undefined) { return 'null'; }
+        if (Array.isArray(v)) { return '[' + v.map(canon).join(',') + ']'; }
+        if (v instanceof Date) { return 'D' + v.getTime(); }
+        if (typeof v === 'object') {
+            if (typeof v.toString === 'function' && v.toString !== Object.prototype.toString) {
+                return 'O' + v.toString();
+            }
+            return '{' + Object.keys(v).sort().map(function (k) { return k + ':' + canon(v[k]); }).join(',') + '}';
+        }
+        return typeof v + ':' + String(v);
+    }
+    function fnv1a(s) {
+        var h = 0x811c9dc5;
+        for (var i = 0; i < s.length; i++) { h ^= s.charCodeAt(i); h = Math.imul(h, 0x01000193); }
+        return h >>> 0;
+    }
+    function djb2(s) {
+        var h = 5381;
+        for (var i = 0; i < s.length; i++) { h = (Math.imul(h, 33) + s.charCodeAt(i)) >>> 0; }
+        return h;
+    }
+"""
+
+KEY_HASH_JS = "function(doc) {" + _JS_HELPERS + """
+    return fnv1a(docKey(doc));
+}"""
+
+DOC_HASH_JS = "function(doc) {" + _JS_HELPERS + """
+    var content = {};
+    Object.keys(doc).forEach(function (k) { if (k !== '_id' && k !== '_version') { content[k] = doc[k]; } });
+    var body = docKey(doc) + '|' + canon(content);
+    return [fnv1a(docKey(doc)), fnv1a(body), djb2(body)];
+}"""
+
+
+def ensure_key_hashes(collection):
+    """
+    Индекс по хешу ключа и хеш ключа в версиях документов, записанных до его появления (только для реплик:
+    источник синхронизацией не меняется). Без $function хеши не записываются, и документы без хеша
+    выбираются в каждом сравнении, пока синхронизация не перезапишет их версию
+    """
+    collection.create_index([(KEY_HASH_FIELD, pymongo.ASCENDING)])
+    try:
+        collection.update_many(
+            {'_version.hash': {'$exists': True}, KEY_HASH_FIELD: {'$exists': False}},
+            [{'$set': {KEY_HASH_FIELD: {'$function': {'body': KEY_HASH_JS, 'args': ['$$ROOT'], 'lang': 'js'}}}}],
+        )
+    except OperationFailure as e:
+        print(f"⚠ {collection.full_name}: хеши ключей не записаны: {e}")
+
+
+def node_leaves(level, node):
+    """Листовые корзины [начало, конец), которые покрывает узел дерева на уровне level"""
+    span = FANOUT ** (DEPTH - level)
+    return node * span, (node + 1) * span
+
+
+def bucket_range(bucket):
+    """Диапазон хешей ключа [начало, конец), попадающих в листовую корзину"""
+    return -(-bucket * HASH_SPACE // LEAF_BUCKETS), -(-(bucket + 1) * HASH_SPACE // LEAF_BUCKETS)
+
+
+def key_hash_filter(leaf_ranges):
+    """
+    Фильтр документов из диапазонов листовых корзин [начало, конец): диапазоны хеша ключа по индексу
+    (соседние диапазоны объединяются) и документы без сохраненного хеша - их корзину знает только агрегация.
+    Устаревший хеш (name/email изменены в обход синхронизации) используется и при подсчете хешей, и в фильтре,
+    поэтому такой документ тоже выбирается, а слияние запишет ему версию с новым хешем
+    """
+    ranges = []
+    for first, last in sorted(leaf_ranges):
+        low, high = bucket_range(first)[0], bucket_range(last - 1)[1]
+        if ranges and ranges[-1][1] == low:
+            ranges[-1][1] = high
+        else:
+            ranges.append([low, high])
+    clauses = [{KEY_HASH_FIELD: {'$gte': low, '$lt': high}} for low, high in ranges]
+    clauses.append({KEY_HASH_FIELD: {'$exists': False}})
+    return {'$or': clauses}
+
+
+def level_hashes(collection, level, parents=None, query=None, expected=None):
+    """
+    Хеши узлов дерева на уровне level: {узел: (hash1, hash2, count)}.
+    Если заданы parents - считаются только потомки этих узлов предыдущего уровня (документы выбираются
+    по индексу хеша ключа), если задан query - дерево строится только по подходящим документам
+    (например, по разделу коллекции). Если задан expected ({листовая корзина: хеши остальных узлов}) -
+    возвращается пара (хеши листьев, _id документов из корзин, которые отличаются от expected)
+    """
+    span = FANOUT ** (DEPTH - level)
+    match = [query] if query else []
+    if parents is not None:
+        match.append(key_hash_filter(node_leaves(level - 1, parent) for parent in parents))
+    pipeline = [{"$match": match[0] if len(match) == 1 else {"$and": match}}] if match else []
+    pipeline += [
+        {"$project": {"k": "$" + KEY_HASH_FIELD, "v": {"$function": {
+            "body": DOC_HASH_JS, "args": ["$$ROOT"], "lang": "js"}}}},
+        {"$project": {
+            # Сохраненный хеш ключа не пересчитывается; корзина - номер диапазона, в который попал хеш
+            "b": {"$floor": {"$divide": [
+                {"$multiply": [{"$ifNull": ["$k", {"$arrayElemAt": ["$v", 0]}]}, LEAF_BUCKETS]}, HASH_SPACE]}},
+            "h1": {"$toLong": {"$arrayElemAt": ["$v", 1]}},
+            "h2": {"$toLong": {"$arrayElemAt": ["$v", 2]}},
+        }},
+    ]
+    if parents is not None:
+        # Документы без сохраненного хеша (и все документы источника) отбираются по вычисленной корзине
+        pipeline.append({"$match": {"$expr": {
+            "$in": [{"$floor": {"$divide": ["$b", span * FANOUT]}}, list(parents)]}}})
+    group = {
+        "_id": {"$floor": {"$divide": ["$b", span]}},
+        "h1": {"$sum": "$h1"},
+        "h2": {"$sum": "$h2"},
+        "n": {"$sum": 1},
+    }
+    if expected is None:
+        pipeline.append({"$group": group})
+        return {int(g["_id"]): (g["h1"], g["h2"], g["n"]) for g in collection.aggregate(pipeline)}
+
+    group["ids"] = {"$push": "$_id"}
+    same = [[bucket] + list(hashes) for bucket, hashes in expected.items()]
+    pipeline += [
+        {"$group": group},
+        # _id возвращаются только для корзин, отличающихся от остальных узлов
+        {"$project": {"h1": 1, "h2": 1, "n": 1, "ids": {"$cond": [
+            {"$in": [["$_id", "$h1", "$h2", "$n"], {"$literal": same}]}, "$$REMOVE", "$ids"]}}},
+    ]
+    hashes, ids = {}, []
+    for g in collection.aggregate(pipeline, allowDiskUse=True):
+        hashes[int(g["_id"])] = (g["h1"], g["h2"], g["n"])
+        ids.extend(g.get("ids", ()))
+    return hashes, ids
+
+
+def divergent_buckets(collections, query=None, source=None):
+    """
+    Сравнивает коллекции (или их части, подходящие под query) спуском по дереву хешей: на каждом уровне
+    узлы обмениваются хешами только потомков различающихся узлов предыдущего уровня.
+    source - коллекция источника (без сохраненных хешей ключей), сравниваемая с collections.
+    Возвращает пару (различающиеся листовые корзины, _id документов источника из них): ([], []) - коллекции
+    совпадают; None, если сервер не поддерживает $function (MongoDB < 4.4 или отключен JavaScript)
+    """
+    parents = None
+    source_ids = []
+    try:
+        for level in range(DEPTH + 1):
+            # Источник считается вместе с остальными узлами, кроме листьев: там ему нужны хеши остальных узлов
+            nodes = list(collections) + ([source] if source is not None and level < DEPTH else [])
+            hashes = []
+            for result in fan_out(lambda collection: level_hashes(collection, level, parents, query), nodes):
+                if isinstance(result, Exception):
+                    raise result
+                hashes.append(result)
+            if source is not None and level == DEPTH:
+                # Ожидаемые хеши - корзины, в которых остальные узлы совпадают между собой
+                expected = {bucket: node_hashes for bucket, node_hashes in hashes[0].items()
+                            if all(other.get(bucket) == node_hashes for other in hashes[1:])}
+                source_hashes, source_ids = level_hashes(source, level, parents, query, expected)
+                hashes.append(source_hashes)
+            tree_nodes = set().union(*hashes)
+            parents = sorted(node for node in tree_nodes if len({h.get(node) for h in hashes}) > 1)
+            if not parents:
+                return [], []
+    except OperationFailure as e:
+        print(f"⚠ Anti-entropy недоступна, используется полное сравнение: {e}")
+        return None
+    return parents, source_ids
+
+
+def bucket_query(buckets):
+    """Фильтр find() для реплик, выбирающий документы из указанных листовых корзин (key_hash_filter)"""
+    return key_hash_filter((bucket, bucket + 1) for bucket in buckets)
+
+
+def source_query(source_ids):
+    """
+    Фильтр find() для источника: только различающиеся документы по _id. Источник не хранит key_hash,
+    поэтому key_hash_filter выбрал бы в нем всю коллекцию
+    """
+    return {'_id': {'$in': list(source_ids)}}
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Снимки коллекций MongoDB на диске (формат snapshot_archive.py):
+- Коллекция делится на части по CHUNK_ROWS документов по _id; часть - документы диапазона _id в сыром BSON
+  (без разбора в dict и обратно), сжатые zstd/zlib
+- Снимок восстанавливается по частям параллельно (RESTORE_WORKERS): часть, совпадающая с приемником
+  по контрольной сумме, пропускается, остальные заменяются (удаление диапазона + вставка)
+- Индексы коллекции сохраняются в манифесте и создаются в приемнике
+
+Запуск: python3 mongodb_archive.py dump --db mongodb_db1 --dir snapshots/mongodb_db1
+"""
+
+import argparse
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bson
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import BulkWriteError
+
+from mongodb_quorum import with_write_concern
+from snapshot_archive import CHUNK_ROWS, RESTORE_WORKERS, SnapshotWriter, read_chunk, read_manifest, totals
+
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshots")
+RAW_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+DUPLICATE_KEY_ERROR = 11000
+
+
+def raw_collection(collection):
+    """Коллекция, возвращающая документы в сыром BSON"""
+    return collection.with_options(codec_options=RAW_OPTIONS)
+
+
+def range_filter(low, high):
+    """Фильтр диапазона _id [low, high); None - граница не задана"""
+    bounds = {}
+    if low is not None:
+        bounds['$gte'] = low
+    if high is not None:
+        bounds['$lt'] = high
+    return {'_id': bounds} if bounds else {}
+
+
+def index_specs(collection):
+    """Индексы коллекции (кроме _id) в виде, пригодном для create_index"""
+    specs = []
+    for name, info in collection.index_information().items():
+        if name == '_id_':
+            continue
+        options = {key: value for key, value in info.items() if key not in ('key', 'v', 'ns')}
+        specs.append({'name': name, 'keys': [list(key) for key in info['key']], 'options': options})
+    return specs
+
+
+def dump_collection(collection, writer):
+    """Пишет коллекцию в снимок частями по CHUNK_ROWS документов; возвращает число документов"""
+    item = writer.add_item(collection.name, collection=collection.name,
+                           indexes=json_util.dumps(index_specs(collection)))
+    # Диапазоны $gte/$lt сравнивают значения одного типа BSON: при _id разных типов - одна часть
+    single = collection.count_documents({'_id': {'$not': {'$type': 'objectId'}}}) > 0
+    documents, low, count = [], None, 0
+
+    def flush(high):
+        writer.write_chunk(item, b"".join(doc.raw for doc in documents), len(documents),
+                           range=json_util.dumps([low, high]))
+
+    for doc in raw_collection(collection).find({}, sort=[('_id', 1)], batch_size=1000):
+        if len(documents) >= CHUNK_ROWS and not single:
+            high = doc['_id']
+            flush(high)
+            documents, low = [], high
+        documents.append(doc)
+        count += 1
+    flush(None)
+    return count
+
+
+def dump_database(database, directory, collections=None):
+    """Пишет снимок коллекций БД в каталог (коллекции - параллельно); возвращает манифест"""
+    started = time.monotonic()
+    names = collections or sorted(database.list_collection_names())
+    writer = SnapshotWriter(directory, "mongodb", database.name)
+    with ThreadPoolExecutor(max_workers=max(1, min(RESTORE_WORKERS, len(names)))) as pool:
+        for future in [pool.submit(dump_collection, database[name], writer) for name in names]:
+            future.result()
+    manifest = writer.finish()
+    rows, raw_bytes, stored_bytes = totals(manifest)
+    print(f"✓ Снимок {database.name} -> {directory}: {len(names)} коллекций, {rows} документов, "
+          f"{raw_bytes} -> {stored_bytes} байт ({manifest['compression']}) за {time.monotonic() - started:.1f}с")
+    return manifest
+
+
+def ensure_collection_indexes(collection, item):
+    for spec in json_util.loads(item['indexes']):
+        collection.create_index([tuple(key) for key in spec['keys']], name=spec['name'], **spec['options'])
+
+
+def restore_chunk(directory, manifest, database, item, chunk):
+    """Заменяет диапазон _id части в приемнике; возвращает False, если приемник уже совпадает с частью"""
+    low, high = json_util.loads(chunk['range'])
+    collection = database[item['collection']]
+    target = hashlib.sha256()
+    for doc in raw_collection(collection).find(range_filter(low, high), sort=[('_id', 1)], batch_size=1000):
+        target.update(doc.raw)
+    if target.hexdigest() == chunk['sha256']:
+        return False
+    data = read_chunk(directory, manifest, chunk)
+    collection = with_write_concern(collection)
+    collection.delete_many(range_filter(low, high))
+    documents = bson.decode_all(data, RAW_OPTIONS)
+    if documents:
+        # Порядок не важен: при ошибке вставляются все остальные документы части
+        collection.insert_many(documents, ordered=False)
+    return True
+
+
+def restore_database(directory, database):
+    """
+    Восстанавливает снимок в БД приемника по частям параллельно; возвращает (восстановлено, пропущено) частей.
+    Часть, упавшая на уникальном индексе (документ с тем же name/email лежит в приемнике в другом
+    диапазоне _id, который еще не заменен), повторяется после остальных частей
+    """
+    started = time.monotonic()
+    manifest = read_manifest(directory)
+    for item in manifest['items']:
+        ensure_collection_indexes(database[item['collection']], item)
+    tasks = [(item, chunk) for item in manifest['items'] for chunk in item['chunks']]
+
+    def restore(task):
+        try:
+            return restore_chunk(directory, manifest, database, *task)
+        except BulkWriteError as e:
+            if any(error.get('code') != DUPLICATE_KEY_ERROR for error in e.details.get('writeErrors', [])):
+                raise
+            return None
+
+    with ThreadPoolExecutor(max_workers=RESTORE_WORKERS) as pool:
+        results = list(pool.map(restore, tasks))
+    for index, result in enumerate(results):
+        if result is None:
+            results[index] = restore_chunk(directory, manifest, database, *tasks[index])
+    restored = sum(results)
+    print(f"✓ {database.name}: восстановлено частей: {restored}, совпадают с приемником: "
+          f"{len(results) - restored} (за {time.monotonic() - started:.1f}с)")
+    return restored, len(results) - restored
+
+
+def main():
+    from mongodb_clients import get_client, registry
+
+    parser = argparse.ArgumentParser(description="Снимки коллекций MongoDB на диске: запись и восстановление")
+    parser.add_argument("command", choices=["dump", "restore"])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=27017)
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="adminpass")
+    parser.add_argument("--db", default="mongodb_db1")
+    parser.add_argument("--collection", action="append", help="коллекция (по умолчанию - все коллекции БД)")
+    parser.add_argument("--dir", help="каталог снимка (по умолчанию SNAPSHOT_DIR/<БД>)")
+    args = parser.parse_args()
+
+    client = get_client(args.host, args.port, args.user, args.password, maxPoolSize=RESTORE_WORKERS + 2)
+    directory = args.dir or os.path.join(SNAPSHOT_DIR, args.db)
+    try:
+        if args.command == "dump":
+            dump_database(client[args.db], directory, args.collection)
+        else:
+            restore_database(directory, client[args.db])
+    finally:
+        registry.close_all()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Массовая генерация тестовых документов MongoDB для нагрузочной проверки синхронизации:
+- Документы генерируются пачками векторизованно через NumPy (имена, email, возраст, зарплата, теги)
+- Генерация воспроизводима: пачка i всегда строится из seed и своего номера, независимо от числа потоков,
+  created_at отсчитывается от фиксированного SEED_EPOCH
+- Пачки вставляются неупорядоченным insert_many в несколько потоков
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from pymongo.errors import BulkWriteError
+
+ALPHABET = np.array(list("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"))
+CITIES = np.array(["Moscow", "Saint Petersburg", "Novosibirsk", "Yekaterinburg", "Kazan"])
+STATUSES = np.array(["active", "inactive", "pending"])
+MAX_TAGS = 5
+TAG_LENGTH = 5
+# Разброс created_at: документы "созданы" за 30 дней до SEED_EPOCH (фиксированный момент, а не текущее время,
+# чтобы один и тот же seed давал одинаковые документы при любом запуске)
+CREATED_AT_SPREAD_SECONDS = 30 * 24 * 3600
+SEED_EPOCH = datetime.fromisoformat(os.environ.get("SEED_EPOCH", "2024-01-01T00:00:00"))
+
+SEED_BATCH_SIZE = int(os.environ.get("SEED_BATCH_SIZE", "10000"))
+SEED_WORKERS = int(os.environ.get("SEED_WORKERS", "4"))
+DUPLICATE_KEY_ERROR = 11000
+
+
+def random_strings(rng, count, length):
+    """count случайных строк длины length из букв и цифр"""
+    codes = rng.integers(0, len(ALPHABET), size=(count, length))
+    return ALPHABET[codes].view(f"<U{length}").ravel()
+
+
+def generate_batch(rng, size, now=SEED_EPOCH):
+    """Генерирует пачку документов той же структуры, что и generate_random_document в setup_mongodb.py"""
+    now = np.datetime64(now, "us")
+    names = random_strings(rng, size, 8)
+    emails = np.char.add(random_strings(rng, size, 6), "@example.com")
+    ages = rng.integers(18, 81, size=size)
+    cities = CITIES[rng.integers(0, len(CITIES), size=size)]
+    salaries = rng.integers(30000, 200001, size=size)
+    offsets = rng.integers(0, CREATED_AT_SPREAD_SECONDS * 10**6, size=size).astype("timedelta64[us]")
+    created_at = np.datetime_as_string(now - offsets, unit="us")
+    statuses = STATUSES[rng.integers(0, len(STATUSES), size=size)]
+    tags = random_strings(rng, size * MAX_TAGS, TAG_LENGTH).reshape(size, MAX_TAGS).tolist()
+    tag_counts = rng.integers(1, MAX_TAGS + 1, size=size).tolist()
+
+    # Преобразование в Python-типы делается целыми столбцами (tolist), а не поэлементно
+    return [
+        {
+            "name": name,
+            "email": email,
+            "age": age,
+            "city": city,
+            "salary": salary,
+            "created_at": created,
+            "status": status,
+            "tags": row_tags[:tag_count],
+        }
+        for name, email, age, city, salary, created, status, row_tags, tag_count in zip(
+            names.tolist(), emails.tolist(), ages.tolist(), cities.tolist(), salaries.tolist(),
+            created_at.tolist(), statuses.tolist(), tags, tag_counts)
+    ]
+
+
+def insert_batch(collection, seed, index, size, now):
+    """Генерирует и вставляет пачку с номером index; возвращает число вставленных документов"""
+    docs = generate_batch(np.random.default_rng([seed, index]), size, now)
+    try:
+        return len(collection.insert_many(docs, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        # Совпадения по уникальному индексу name/email пропускаются, остальные ошибки пробрасываются
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        return e.details.get("nInserted", 0)
+
+
+def seed_collection(collection, count, seed=0, batch_size=SEED_BATCH_SIZE, workers=SEED_WORKERS):
+    """
+    Вставляет count сгенерированных документов параллельными пачками.
+    Возвращает (число вставленных документов, документов в секунду)
+    """
+    now = SEED_EPOCH
+    sizes = [min(batch_size, count - start) for start in range(0, count, batch_size)]
+    started = time.monotonic()
+    inserted = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Пачки генерируются внутри потоков, поэтому в памяти одновременно не больше workers пачек
+        futures = [pool.submit(insert_batch, collection, seed, i, size, now) for i, size in enumerate(sizes)]
+        for i, future in enumerate(futures, 1):
+            inserted += future.result()
+            if i % 10 == 0 or i == len(futures):
+                elapsed = time.monotonic() - started
+                print(f"  {inserted}/{count} документов, {inserted / elapsed if elapsed else 0:.0f} док/с")
+    elapsed = time.monotonic() - started
+    rate = inserted / elapsed if elapsed else 0.0
+    return inserted, rate
+
+
+def main():
+    from mongodb_clients import get_client, registry
+
+    parser = argparse.ArgumentParser(description="Массовая генерация документов MongoDB")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=27017)
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="adminpass")
+    parser.add_argument("--db", default="mongodb_db1")
+    parser.add_argument("--collection", default="users")
+    parser.add_argument("--count", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=SEED_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=SEED_WORKERS)
+    parser.add_argument("--drop", action="store_true", help="очистить коллекцию перед генерацией")
+    args = parser.parse_args()
+
+    # Размер пула соединений должен покрывать все потоки вставки
+    client = get_client(args.host, args.port, args.user, args.password, maxPoolSize=max(args.workers, 1) + 2)
+    collection = client[args.db][args.collection]
+    try:
+        if args.drop:
+            collection.delete_many({})
+        print(f"Генерация {args.count} документов в {args.db}.{args.collection} (seed={args.seed})...")
+        inserted, rate = seed_collection(collection, args.count, args.seed, args.batch_size, args.workers)
+        print(f"✓ Вставлено {inserted} документов, {rate:.0f} док/с")
+    finally:
+        registry.close_all()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Инкрементальная синхронизация MongoDB через change streams:
+- Следит за изменениями в основных узлах и в каждой из реплик
+- Применяет в остальных репликах только вставленные, обновленные и удаленные документы
+- Сохраняет resume token'ы локально, чтобы после перезапуска продолжить с места остановки
+- Если узлы не поддерживают change streams (standalone mongod), откатывается на опрос
+"""
+
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime
+
+import bson
+from pymongo.errors import OperationFailure, PyMongoError
+
+import mongodb_tombstones
+import mongodb_versioning
+from adaptive_scheduler import Backoff
+from mongodb_quorum import with_write_concern
+from replication_metrics import metrics
+from sync_mongodb_replication import COLLECTION_NAME, document_ops, get_doc_filter, node_label
+from sync_state import open_store
+
+SYNC_STATE_PATH = os.environ.get("SYNC_STATE_PATH", "sync_state.db")
+# Сколько ждать новых событий в одном запросе getMore
+MAX_AWAIT_TIME_MS = int(os.environ.get("CHANGE_STREAM_MAX_AWAIT_MS", "500"))
+# Как часто сохранять resume token при непрерывном потоке событий
+TOKEN_FLUSH_INTERVAL_SECONDS = float(os.environ.get("RESUME_TOKEN_FLUSH_SECONDS", "1"))
+# Периодическая полная сверка как страховка от расхождений при конкурентных правках
+FULL_SYNC_INTERVAL_SECONDS = float(os.environ.get("FULL_SYNC_INTERVAL_SECONDS", "300"))
+# Интервал опроса, если change streams недоступны
+POLL_INTERVAL_SECONDS = float(os.environ.get("REPLICATION_INTERVAL_SECONDS", "10"))
+
+# Коды ошибок MongoDB
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+RESUME_TOKEN_LOST_CODES = {260, 280, 286}  # InvalidResumeToken, ChangeStreamFatalError, ChangeStreamHistoryLost
+RESYNC_OPERATIONS = {"drop", "dropDatabase", "rename", "invalidate"}
+
+
+class ChangeStreamsNotSupported(Exception):
+    """Узел не поддерживает change streams (не является членом replica set)"""
+
+
+class ResyncRequired(Exception):
+    """Поток изменений прерван, требуется полная пересинхронизация"""
+
+
+class WatcherStopped(Exception):
+    """Поток чтения change stream'а завершился - процесс останавливается, чтобы его перезапустили"""
+
+
+def log(message):
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}")
+
+
+def fingerprint(doc):
+    """Отпечаток содержимого документа без _id (для подавления эха собственных записей)"""
+    if doc is None:
+        return None
+    content = {k: v for k, v in doc.items() if k != '_id'}
+    return hashlib.sha1(bson.encode(content)).hexdigest()
+
+
+class EchoFilter:
+    """Запоминает записи, сделанные синхронизатором, чтобы не пересылать их обратно"""
+
+    def __init__(self, max_size=100000):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._max_size = max_size
+
+    def remember(self, node_name, doc_id, doc):
+        with self._lock:
+            if len(self._pending) >= self._max_size:
+                self._pending.clear()
+            self._pending[(node_name, str(doc_id))] = fingerprint(doc)
+
+    def is_echo(self, node_name, doc_id, doc):
+        with self._lock:
+            key = (node_name, str(doc_id))
+            if key in self._pending and self._pending[key] == fingerprint(doc):
+                del self._pending[key]
+                return True
+            return False
+
+
+def is_newer_or_same(incoming, existing):
+    """Входящая версия не старше существующей (по HLC, как в полном цикле)"""
+    return mongodb_versioning.version_key(incoming) >= mongodb_versioning.version_key(existing)
+
+
+class WatchedCollection:
+    """Change stream одной коллекции на одном узле и узлы, куда применяются изменения"""
+
+    def __init__(self, name, client, db_name, targets, source=False):
+        self.name = name
+        self.client = client
+        self.db_name = db_name
+        self.targets = targets  # {имя узла: клиент}
+        self.source = source  # основной узел: синхронизация его не меняет
+        self.stream = None
+        self.saved_token = None
+
+    @property
+    def token_key(self):
+        return f"resume_token:{self.name}:{self.db_name}.{COLLECTION_NAME}"
+
+
+class ChangeStreamSync:
+    """Применяет изменения из change stream'ов узлов к репликам"""
+
+    def __init__(self, watched, full_sync, state):
+        self.watched = watched
+        self.full_sync = full_sync
+        self.state = state
+        self.echo = EchoFilter()
+        self._resync_lock = threading.Lock()
+        self._resync_requested = threading.Event()
+
+    def open_stream(self, watched):
+        """Открывает change stream, продолжая с сохраненного resume token (если он есть)"""
+        token = self.state.get(watched.token_key)
+        collection = watched.client[watched.db_name][COLLECTION_NAME]
+        kwargs = {"full_document": "updateLookup", "max_await_time_ms": MAX_AWAIT_TIME_MS}
+        if token:
+            kwargs["resume_after"] = token
+        try:
+            watched.stream = collection.watch(**kwargs)
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAM_NOT_SUPPORTED:
+                raise ChangeStreamsNotSupported(str(e))
+            if token and e.code in RESUME_TOKEN_LOST_CODES:
+                log(f"⚠ Resume token для {watched.name}/{watched.db_name} устарел, нужна полная синхронизация")
+                self.state.delete(watched.token_key)
+                watched.stream = collection.watch(full_document="updateLookup", max_await_time_ms=MAX_AWAIT_TIME_MS)
+                return False
+            raise
+        watched.saved_token = token
+        return token is not None
+
+    def save_token(self, watched):
+        token = watched.stream.resume_token
+        if token is not None and token != watched.saved_token:
+            self.state.set(watched.token_key, token)
+            watched.saved_token = token
+
+    def apply_change(self, watched, change):
+        """Применяет одно событие изменения ко всем целевым узлам"""
+        operation = change["operationType"]
+        if operation in RESYNC_OPERATIONS:
+            raise ResyncRequired(f"{operation} в {watched.name}/{watched.db_name}")
+
+        metrics.inc("replication_documents_read_total", job="mongodb", node=node_label(watched.client))
+        if "clusterTime" in change:
+            # Отставание - время от записи в источнике до применения события
+            metrics.set("replication_lag_seconds", max(0.0, time.time() - change["clusterTime"].time),
+                        job="mongodb", source=node_label(watched.client), db=watched.db_name)
+
+        doc_id = change["documentKey"]["_id"]
+        if operation == "delete":
+            if self.echo.is_echo(watched.name, doc_id, None):
+                return
+            # Надгробие с одной отметкой HLC на всех репликах: синхронизация не восстановит документ,
+            # а пропущенные здесь узлы получат удаление в следующем цикле. В основном узле надгробия не хранятся
+            source = node_label(watched.client)
+            hlc = mongodb_versioning.clock.now()
+            if not watched.source:
+                mongodb_tombstones.record(watched.client, watched.db_name, COLLECTION_NAME, doc_id, source, hlc=hlc,
+                                          acks=[source])
+            for target_name, target_client in watched.targets.items():
+                collection = with_write_concern(target_client[watched.db_name][COLLECTION_NAME])
+                if collection.delete_one({'_id': doc_id}).deleted_count:
+                    self.echo.remember(target_name, doc_id, None)
+                    metrics.inc("replication_documents_written_total", job="mongodb", node=node_label(target_client))
+                mongodb_tombstones.record(target_client, watched.db_name, COLLECTION_NAME, doc_id, source, hlc=hlc,
+                                          acks=[node_label(target_client)])
+            return
+
+        doc = change.get("fullDocument")
+        # Документ мог быть удален до lookup - удаление придет отдельным событием
+        if doc is None or self.echo.is_echo(watched.name, doc_id, doc):
+            return
+        # Правка в обход синхронизации получает версию HLC узла, на котором она сделана
+        doc = mongodb_versioning.observe(doc, node_label(watched.client))
+        for target_name, target_client in watched.targets.items():
+            collection = with_write_concern(target_client[watched.db_name][COLLECTION_NAME])
+            self.upsert_document(target_name, collection, doc)
+
+    def upsert_document(self, target_name, collection, doc):
+        """Вставляет или обновляет документ в целевой коллекции по ключу name:email, сохраняя _id"""
+        existing = collection.find_one(get_doc_filter(doc))
+        if existing is not None:
+            current = mongodb_versioning.observe(existing, node_label(collection.database.client))
+            if mongodb_versioning.is_source_update(doc, current):
+                doc = mongodb_versioning.source_update(doc)
+            elif not is_newer_or_same(doc, current):
+                return
+        ops = document_ops(existing, doc)
+        if ops:
+            self.echo.remember(target_name, doc['_id'], doc)
+            collection.bulk_write(ops, ordered=True)
+            metrics.inc("replication_documents_written_total", job="mongodb",
+                        node=node_label(collection.database.client))
+
+    def watch_loop(self, watched):
+        """Цикл чтения change stream'а одного узла"""
+        last_flush = time.monotonic()
+        backoff = Backoff()
+        while True:
+            try:
+                if watched.stream is None:
+                    self.open_stream(watched)
+                change = watched.stream.try_next()
+                backoff.reset()
+                if change is not None:
+                    self.apply_change(watched, change)
+                if change is None or time.monotonic() - last_flush >= TOKEN_FLUSH_INTERVAL_SECONDS:
+                    self.save_token(watched)
+                    last_flush = time.monotonic()
+            except ResyncRequired as e:
+                log(f"⚠ Поток изменений прерван ({e}), выполняется полная синхронизация")
+                self._restart(watched)
+            except PyMongoError as e:
+                # Недоступный узел переподключается с растущей задержкой, не нагружая его повторами
+                delay = backoff.next_delay()
+                log(f"⚠ Ошибка change stream {watched.name}/{watched.db_name}: {e}, повтор через {delay:.1f}с")
+                self._close(watched)
+                time.sleep(delay)
+            except Exception as e:
+                # Событие, которое не удалось применить, не повторяется: поток открывается заново без
+                # resume token, а пропущенные изменения переносит полная синхронизация
+                delay = backoff.next_delay()
+                log(f"⚠ Сбой обработки change stream {watched.name}/{watched.db_name}: {e!r}, "
+                    f"полная синхронизация через {delay:.1f}с")
+                metrics.inc("replication_errors_total", job="mongodb", node=node_label(watched.client))
+                time.sleep(delay)
+                self._restart(watched)
+
+    def _restart(self, watched):
+        """Сбрасывает resume token и поток узла и запрашивает полную синхронизацию"""
+        self.state.delete(watched.token_key)
+        self._close(watched)
+        self._resync_requested.set()
+
+    def _close(self, watched):
+        if watched.stream is not None:
+            try:
+                watched.stream.close()
+            except PyMongoError:
+                pass
+        watched.stream = None
+
+    def resync(self):
+        with self._resync_lock:
+            log("Полная синхронизация...")
+            self.full_sync()
+            log("✓ Полная синхронизация завершена")
+
+    def run_forever(self):
+        """Открывает все потоки и применяет изменения до остановки процесса"""
+        resumed = True
+        for watched in self.watched:
+            resumed = self.open_stream(watched) and resumed
+        # Потоки открыты до полной синхронизации, поэтому изменения во время нее не теряются
+        if not resumed:
+            self.resync()
+
+        threads = []
+        for watched in self.watched:
+            thread = threading.Thread(target=self.watch_loop, args=(watched,), daemon=True,
+                                      name=f"change-stream-{watched.name}-{watched.db_name}")
+            thread.start()
+            threads.append(thread)
+        log(f"✓ Запущено {len(self.watched)} change stream'ов")
+
+        last_full_sync = time.monotonic()
+        while True:
+            # Потоки работают бесконечно: завершившийся поток означает фатальную ошибку (как в pg_logical_replication)
+            stopped = [thread.name for thread in threads if not thread.is_alive()]
+            if stopped:
+                raise WatcherStopped(", ".join(stopped))
+            triggered = self._resync_requested.wait(timeout=1)
+            if triggered or time.monotonic() - last_full_sync >= FULL_SYNC_INTERVAL_SECONDS:
+                self._resync_requested.clear()
+                self.resync()
+                last_full_sync = time.monotonic()
+
+
+def build_watched(node_clients, replica_clients, sources):
+    """Строит список наблюдаемых коллекций: основные узлы -> все реплики, каждая реплика -> остальные"""
+    watched = []
+    for node_name, db_name in sources.items():
+        watched.append(WatchedCollection(node_name, node_clients[node_name], db_name, dict(replica_clients),
+                                         source=True))
+    for db_name in sources.values():
+        for replica_name, replica_client in replica_clients.items():
+            others = {name: client for name, client in replica_clients.items() if name != replica_name}
+            watched.append(WatchedCollection(replica_name, replica_client, db_name, others))
+    return watched
+
+
+def run_change_stream_sync(node_clients, replica_clients, sources, full_sync, poll=None):
+    """
+    Запускает инкрементальную синхронизацию; при отсутствии change streams - опрос
+    (poll - долгоживущий цикл опроса, по умолчанию full_sync каждые POLL_INTERVAL_SECONDS)
+    """
+    state = open_store(SYNC_STATE_PATH)
+    engine = ChangeStreamSync(build_watched(node_clients, replica_clients, sources), full_sync, state)
+    try:
+        engine.run_forever()
+    except ChangeStreamsNotSupported as e:
+        log(f"⚠ Change streams недоступны ({e}), переход на опрос")
+        if poll is not None:
+            poll()
+        while True:
+            full_sync()
+            time.sleep(POLL_INTERVAL_SECONDS)
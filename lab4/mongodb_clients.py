@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Общий реестр подключений к MongoDB:
+- Один MongoClient на узел (host/port/учетные данные/настройки) на весь процесс, без повторных рукопожатий
+- Настроенный пул соединений (maxPoolSize/minPoolSize) держит теплые соединения между циклами
+- Клиенты с разными настройками (readPreference, таймауты) не подменяют друг друга
+- Состояние узлов отслеживается по heartbeat'ам драйвера: операции с недоступным узлом не отправляются,
+  состояние экспортируется метрикой replication_node_up
+"""
+
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from pymongo import monitoring
+
+from replication_metrics import metrics
+
+MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "20"))
+MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "2"))
+SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+HEARTBEAT_FREQUENCY_MS = int(os.environ.get("MONGO_HEARTBEAT_FREQUENCY_MS", "10000"))
+# Таймаут одной операции с узлом (ожидание ответа на запрос или очередную пачку курсора)
+NODE_TIMEOUT_SECONDS = float(os.environ.get("NODE_TIMEOUT_SECONDS", "30"))
+# Сколько ждать готовности узла при развертывании
+READY_TIMEOUT_SECONDS = float(os.environ.get("SETUP_READY_TIMEOUT_SECONDS", "120"))
+READY_MAX_DELAY_SECONDS = 5.0
+
+
+class NodeUnavailable(Exception):
+    """Узел недоступен по последнему heartbeat'у - операция с ним не выполняется"""
+
+
+class NodeHealth:
+    """Состояние узла по последним heartbeat'ам"""
+
+    def __init__(self):
+        self.healthy = None
+        self.last_check = None
+        self.last_error = None
+        self.latency_ms = None
+        self.failures = 0
+
+    def __repr__(self):
+        return (f"NodeHealth(healthy={self.healthy}, latency_ms={self.latency_ms}, "
+                f"failures={self.failures}, last_error={self.last_error!r})")
+
+
+class _HealthListener(monitoring.ServerHeartbeatListener):
+    """Обновляет NodeHealth по событиям heartbeat драйвера"""
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        health = self.registry.health_of(event.connection_id)
+        health.healthy = True
+        health.last_check = time.time()
+        health.latency_ms = round(event.duration * 1000, 2)
+        health.last_error = None
+        health.failures = 0
+
+    def failed(self, event):
+        health = self.registry.health_of(event.connection_id)
+        health.healthy = False
+        health.last_check = time.time()
+        health.last_error = str(event.reply)
+        health.failures += 1
+
+
+class MongoClientRegistry:
+    """Реестр долгоживущих клиентов MongoDB, ключ - (host, port, user, password, authSource, настройки клиента)"""
+
+    def __init__(self):
+        self._clients = {}
+        self._health = {}
+        self._lock = threading.Lock()
+        self._listener = _HealthListener(self)
+
+    def get(self, host, port, username=None, password=None, auth_source='admin', **options):
+        """Возвращает клиента для узла с заданными настройками, создавая его при первом обращении"""
+        key = (host, int(port), username, password, auth_source, tuple(sorted((name, repr(value)) for name, value in options.items())))
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                settings = {
+                    "maxPoolSize": MAX_POOL_SIZE,
+                    "minPoolSize": MIN_POOL_SIZE,
+                    "serverSelectionTimeoutMS": SERVER_SELECTION_TIMEOUT_MS,
+                    "heartbeatFrequencyMS": HEARTBEAT_FREQUENCY_MS,
+                    "socketTimeoutMS": int(NODE_TIMEOUT_SECONDS * 1000),
+                    "event_listeners": [self._listener],
+                }
+                if username:
+                    settings.update(username=username, password=password, authSource=auth_source)
+                settings.update(options)
+                client = pymongo.MongoClient(host=host, port=int(port), **settings)
+                self._clients[key] = client
+            return client
+
+    def health_of(self, address):
+        """Возвращает состояние узла по адресу (host, port)"""
+        address = tuple(address)
+        with self._lock:
+            health = self._health.get(address)
+            if health is None:
+                health = self._health[address] = NodeHealth()
+                # 1 - узел доступен, 0 - недоступен; пока heartbeat'ов не было, значение не экспортируется
+                metrics.set_function("replication_node_up",
+                                     lambda: None if health.healthy is None else int(health.healthy),
+                                     job="mongodb", node=f"{address[0]}:{address[1]}")
+            return health
+
+    def is_healthy(self, host, port):
+        """Узел доступен по последнему heartbeat (неизвестное состояние считается доступным)"""
+        return self.health_of((host, int(port))).healthy is not False
+
+    def health(self):
+        """Снимок состояния всех известных узлов"""
+        with self._lock:
+            return {f"{host}:{port}": health for (host, port), health in self._health.items()}
+
+    def close_all(self):
+        """Закрывает все клиенты (при завершении процесса)"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+
+
+registry = MongoClientRegistry()
+
+
+def get_client(host, port, username=None, password=None, **options):
+    """Клиент из общего реестра процесса"""
+    return registry.get(host, port, username, password, **options)
+
+
+def is_available(client):
+    """
+    Доступен ли узел клиента по heartbeat'ам (для клиента набора реплик - хотя бы один его узел).
+    Клиенты без мониторинга pymongo (например, mongomock в тестах) считаются доступными
+    """
+    if not isinstance(client, pymongo.MongoClient):
+        return True
+    addresses = client.topology_description.server_descriptions()
+    return not addresses or any(registry.is_healthy(host, port) for host, port in addresses)
+
+
+def ensure_available(client):
+    """Сразу выбрасывает NodeUnavailable для узла, недоступного по последнему heartbeat'у"""
+    if not is_available(client):
+        address = ", ".join(f"{host}:{port}" for host, port in client.topology_description.server_descriptions())
+        raise NodeUnavailable(f"узел {address} недоступен по последнему heartbeat'у")
+
+
+def wait_for_mongodb(host, port, username=None, password=None, timeout=READY_TIMEOUT_SECONDS):
+    """
+    Ожидает готовности MongoDB, опрашивая узел с экспоненциальной задержкой.
+    С учетными данными узел считается готовым, когда проходит аутентификация: пока образ mongo
+    создает пользователей, временный mongod еще не принимает внешних подключений
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    while True:
+        # Отдельный временный клиент: настройки опроса не должны попасть в реестр
+        settings = {"serverSelectionTimeoutMS": 2000, "connectTimeoutMS": 2000}
+        if username:
+            settings.update(username=username, password=password, authSource='admin')
+        client = pymongo.MongoClient(host=host, port=int(port), **settings)
+        try:
+            client.admin.command('ping')
+            print(f"✓ MongoDB {host}:{port} готов")
+            return True
+        except Exception as e:
+            if time.monotonic() + delay > deadline:
+                print(f"✗ Не удалось подключиться к MongoDB {host}:{port}: {e}")
+                return False
+        finally:
+            client.close()
+        time.sleep(delay)
+        delay = min(READY_MAX_DELAY_SECONDS, delay * 2) * random.uniform(0.8, 1.0)
+
+
+def wait_for_nodes(nodes, username=None, password=None, timeout=READY_TIMEOUT_SECONDS):
+    """Ожидает готовности всех узлов [(host, port)] параллельно; True - если готовы все"""
+    with ThreadPoolExecutor(max_workers=max(1, len(nodes))) as pool:
+        ready = list(pool.map(lambda node: wait_for_mongodb(*node, username, password, timeout), nodes))
+    return all(ready)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Пополевая разница документов MongoDB:
+- Вместо замены всего документа реплике отправляются только изменившиеся поля ($set / $unset),
+  вложенные документы сравниваются рекурсивно (пути через точку)
+- Массивы: дописанные в конец элементы - $push с $each, изменившиеся элементы того же массива - $set по индексу,
+  иначе массив заменяется целиком
+- Если патч не меньше самого документа (или поле нельзя адресовать путем), используется полная замена
+"""
+
+import bson
+
+
+class _NotPatchable(Exception):
+    """Поле нельзя адресовать путем через точку (имя с '.' или '$')"""
+
+
+def same_value(a, b):
+    """Значения совпадают с учетом типов BSON: True, 1 и 1.0 - разные значения"""
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same_value(a[key], b[key]) for key in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(same_value(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def _path(prefix, key):
+    if not isinstance(key, str) or not key or '.' in key or key.startswith('$'):
+        raise _NotPatchable(key)
+    return f"{prefix}{key}"
+
+
+def _diff_array(path, old, new, patch):
+    if len(new) >= len(old) and all(same_value(x, y) for x, y in zip(old, new)):
+        # Элементы только дописаны в конец
+        patch['$push'][path] = {'$each': new[len(old):]}
+    elif len(new) == len(old):
+        for index, (x, y) in enumerate(zip(old, new)):
+            if not same_value(x, y):
+                patch['$set'][f"{path}.{index}"] = y
+    else:
+        patch['$set'][path] = new
+
+
+def _diff_fields(prefix, old, new, patch):
+    for key, value in new.items():
+        path = _path(prefix, key)
+        if key not in old:
+            patch['$set'][path] = value
+        elif same_value(old[key], value):
+            continue
+        elif isinstance(value, dict) and isinstance(old[key], dict) and value:
+            _diff_fields(f"{path}.", old[key], value, patch)
+        elif isinstance(value, list) and isinstance(old[key], list):
+            _diff_array(path, old[key], value, patch)
+        else:
+            patch['$set'][path] = value
+    for key in old:
+        if key not in new:
+            patch['$unset'][_path(prefix, key)] = ""
+
+
+def document_patch(existing, desired):
+    """
+    Операторы обновления, приводящие existing к desired (без _id); {} - документы совпадают,
+    None - патч построить нельзя
+    """
+    patch = {'$set': {}, '$unset': {}, '$push': {}}
+    try:
+        _diff_fields("", {k: v for k, v in existing.items() if k != '_id'},
+                     {k: v for k, v in desired.items() if k != '_id'}, patch)
+    except _NotPatchable:
+        return None
+    return {operator: fields for operator, fields in patch.items() if fields}
+
+
+def smaller_patch(existing, desired):
+    """Патч, если он меньше документа desired (в байтах BSON); иначе None - выгоднее полная замена"""
+    patch = document_patch(existing, desired)
+    if not patch:
+        return patch
+    if len(bson.encode(patch)) >= len(bson.encode(desired)):
+        return None
+    return patch
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Параллельное выполнение операций синхронизации MongoDB:
+- Чтения и записи в реплики выполняются одновременно в пуле потоков
+- Базы данных синхронизируются параллельно в отдельном пуле
+- Таймаут задан на каждую операцию с узлом (socketTimeoutMS клиентов из mongodb_clients), а не на весь шаг:
+  зависшая реплика отваливается по таймауту операции, а долгий, но идущий шаг не прерывается
+- В режиме кворума (fan_out_quorum) шаг ждет только первых подтверждений, остальные узлы догоняют в фоне
+- Узлы, недоступные по последнему heartbeat'у, не ждут таймаута: вместо результата сразу NodeUnavailable
+"""
+
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from mongodb_clients import ensure_available
+
+# "threads" - параллельное выполнение, "serial" - последовательное (как раньше)
+SYNC_CONCURRENCY = os.environ.get("SYNC_CONCURRENCY", "threads")
+MAX_NODE_WORKERS = int(os.environ.get("MAX_NODE_WORKERS", "16"))
+
+_node_pool = ThreadPoolExecutor(max_workers=MAX_NODE_WORKERS, thread_name_prefix="mongo-node")
+_db_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="mongo-db")
+_local = threading.local()
+
+
+class QuorumNotReached(Exception):
+    """Операцию подтвердило меньше узлов, чем требует кворум"""
+
+
+def _call_in_worker(fn, item):
+    nested = getattr(_local, "in_worker", False)
+    _local.in_worker = True
+    try:
+        ensure_available(item)
+        return fn(item)
+    finally:
+        _local.in_worker = nested
+
+
+def _call_safely(fn, item):
+    try:
+        return _call_in_worker(fn, item)
+    except Exception as e:
+        return e
+
+
+def fan_out(fn, items):
+    """
+    Выполняет fn(item) для каждого узла параллельно (каждая операция ограничена таймаутом клиента).
+    Возвращает результаты в порядке items; для упавших узлов вместо результата - исключение
+    """
+    items = list(items)
+    # Вложенные вызовы (из уже работающего потока пула) выполняются последовательно, чтобы не исчерпать пул
+    if SYNC_CONCURRENCY != "threads" or len(items) <= 1 or getattr(_local, "in_worker", False):
+        return [_call_safely(fn, item) for item in items]
+
+    futures = [_node_pool.submit(_call_in_worker, fn, item) for item in items]
+    wait(futures)
+    return [future.exception() if future.exception() is not None else future.result() for future in futures]
+
+
+def fan_out_quorum(fn, items, quorum, on_lagging):
+    """
+    Выполняет fn(item) для всех узлов параллельно, но ждет только первых quorum успешных результатов.
+    Для упавших узлов и для узлов, не успевших к кворуму и затем завершившихся ошибкой, вызывается on_lagging(item).
+    Возвращает результаты в порядке items (None - узел не подтвердил); если кворум не набран - QuorumNotReached
+    """
+    items = list(items)
+    quorum = min(quorum, len(items))
+    acked = {}
+    errors = []
+    if SYNC_CONCURRENCY != "threads" or len(items) <= 1 or getattr(_local, "in_worker", False):
+        for i, item in enumerate(items):
+            result = _call_safely(fn, item)
+            if isinstance(result, Exception):
+                errors.append(result)
+                on_lagging(item)
+            else:
+                acked[i] = result
+    else:
+        futures = {_node_pool.submit(_call_in_worker, fn, item): i for i, item in enumerate(items)}
+        pending = set(futures)
+        while pending and len(acked) < quorum:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = futures[future]
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    on_lagging(items[i])
+                else:
+                    acked[i] = future.result()
+        # Оставшиеся узлы не ждем: их запись продолжается, а при ошибке они догонят остальных в фоне
+        for future in pending:
+            item = items[futures[future]]
+            future.add_done_callback(lambda f, item=item: f.exception() is not None and on_lagging(item))
+    if len(acked) < quorum:
+        raise QuorumNotReached(f"подтвердили {len(acked)} из {quorum} узлов: {errors[0]}")
+    return [acked.get(i) for i in range(len(items))]
+
+
+def run_parallel(tasks):
+    """Выполняет независимые задачи (например, синхронизацию разных БД) параллельно и дожидается всех"""
+    if SYNC_CONCURRENCY != "threads" or len(tasks) <= 1:
+        for task in tasks:
+            task()
+        return
+    futures = [_db_pool.submit(task) for task in tasks]
+    for future in futures:
+        future.result()
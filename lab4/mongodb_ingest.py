@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Шлюз записи новых данных в MongoDB:
+- Принимает вставки и обновления документов по HTTP (POST /<БД>, JSON-документ или массив, Extended JSON)
+- Записи копятся в микропакеты (group commit): пакет отправляется, когда набрано INGEST_BATCH_SIZE документов
+  или прошло INGEST_BATCH_WAIT_MS с первой записи; повторные записи ключа в пакете схлопываются в последнюю
+- Пакет пишется в основной узел БД и во все реплики одновременно; клиент получает ответ после подтверждения
+  INGEST_QUORUM узлов (0 - всех), отставшие узлы догоняют остальные в фоне (очередь catch_up)
+- Документ ищется по ключу name:email и сохраняет свой _id и created_at на всех узлах (created_at ставится
+  только новому документу). В основной узел документ пишется без _version, а в реплики - с новой отметкой HLC,
+  отмеченной как версия из источника: запись шлюза новее прежних правок реплик, а последующие правки основного
+  узла в обход шлюза синхронизация распознает по хешу содержимого (mongodb_versioning.is_source_update)
+
+Запуск: python3 mongodb_ingest.py (порт INGEST_PORT)
+Запись: curl -X POST localhost:8088/mongodb_db1 -d '{"name": "a", "email": "a@example.com", "age": 30}'
+Чтение: curl 'localhost:8088/mongodb_db1?name=a&email=a@example.com' (из реплик, mongodb_read_router.py)
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from bson import ObjectId, json_util
+from pymongo import monitoring
+from pymongo.errors import PyMongoError
+
+import mongodb_raw
+import mongodb_read_router
+import mongodb_versioning
+from mongodb_clients import get_client, registry
+from mongodb_fanout import QuorumNotReached, fan_out_quorum
+from mongodb_quorum import catch_up
+from mongodb_read_router import ReadRouter, get_read_client
+from replication_metrics import metrics, start_metrics_server
+from sync_mongodb_replication import (
+    COLLECTION_NAME, CommandLatencyListener, bulk_apply, ensure_all_indexes, find_by_keys,
+    get_doc_key, key_ops, node_label, schedule_catch_up,
+)
+
+INGEST_PORT = int(os.environ.get("INGEST_PORT", "8088"))
+# Размер микропакета и сколько ждать его заполнения после первой записи
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "500"))
+INGEST_BATCH_WAIT_MS = float(os.environ.get("INGEST_BATCH_WAIT_MS", "5"))
+# Сколько узлов (основной + реплики) должны подтвердить пакет; 0 - все узлы
+INGEST_QUORUM = int(os.environ.get("INGEST_QUORUM", "0"))
+INGEST_ACK_TIMEOUT_SECONDS = float(os.environ.get("INGEST_ACK_TIMEOUT_SECONDS", "30"))
+
+
+class InvalidDocument(ValueError):
+    """Документ нельзя записать через шлюз"""
+
+
+def prepare(doc):
+    """Проверяет документ и убирает из него _version; ключ name:email обязателен"""
+    if not isinstance(doc, dict):
+        raise InvalidDocument("ожидается JSON-объект")
+    if not doc.get('name') or not doc.get('email'):
+        raise InvalidDocument("нужны непустые поля name и email")
+    return {key: value for key, value in doc.items() if key != mongodb_versioning.VERSION_FIELD}
+
+
+class GroupCommitter:
+    """
+    Очередь записей одной БД: поток записи забирает накопленные записи пакетом и пишет пакет на все узлы.
+    clients - основной узел БД и реплики; submit возвращает Future, который завершается после кворума
+    """
+
+    def __init__(self, db_name, clients, quorum=INGEST_QUORUM, batch_size=INGEST_BATCH_SIZE,
+                 batch_wait_ms=INGEST_BATCH_WAIT_MS):
+        self.db_name = db_name
+        self.clients = list(clients)
+        self.quorum = min(quorum or len(self.clients), len(self.clients))
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self._pending = []
+        self._pending_docs = 0
+        self._cond = threading.Condition()
+        # Документы, которые основной узел не подтвердил: дописываются в фоне (очередь catch_up)
+        self._primary_backlog = {}
+        self._backlog_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name=f"ingest-{db_name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, docs):
+        future = Future()
+        with self._cond:
+            self._pending.append((docs, future))
+            self._pending_docs += len(docs)
+            self._cond.notify()
+        return future
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            # Пакет закрывается по размеру или по времени с первой записи
+            deadline = time.monotonic() + self.batch_wait
+            while self._pending_docs < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, self._pending, self._pending_docs = self._pending, [], 0
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                acked = self.commit([doc for docs, _ in batch for doc in docs])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for _, future in batch:
+                future.set_result(acked)
+
+    def resolve_existing(self, desired):
+        """
+        Документам без _id назначается _id уже записанного документа с тем же ключом (с первого доступного узла),
+        новым документам - новый ObjectId; так документ получает один _id на всех узлах.
+        created_at без значения в записи ставится только новым документам (как $setOnInsert): обновление
+        сохраняет время создания. Значение нужно до записи - оно входит в хеш версии реплик
+        """
+        missing = [doc for doc in desired.values() if '_id' not in doc or 'created_at' not in doc]
+        if not missing:
+            return
+        errors = []
+        for client in self.clients:
+            try:
+                existing = find_by_keys(client, self.db_name, COLLECTION_NAME, missing)
+                break
+            except Exception as e:
+                errors.append(e)
+        else:
+            raise errors[0]
+        found = {get_doc_key(doc): doc for doc in existing}
+        created_at = datetime.now().isoformat()
+        for doc in missing:
+            current = found.get(get_doc_key(doc))
+            if current is None:
+                doc.setdefault('_id', ObjectId())
+                doc.setdefault('created_at', created_at)
+                continue
+            doc.setdefault('_id', current['_id'])
+            if 'created_at' in current:
+                doc.setdefault('created_at', current['created_at'])
+
+    def commit(self, docs):
+        """Пишет пакет на все узлы параллельно; возвращает число узлов, подтвердивших запись до кворума"""
+        started = time.monotonic()
+        # Последняя запись ключа в пакете побеждает
+        desired = {}
+        for doc in docs:
+            desired[get_doc_key(doc)] = dict(doc)
+        self.resolve_existing(desired)
+        primary_docs = list(desired.values())
+        # Новая отметка HLC: запись шлюза побеждает прежние правки реплик при слиянии
+        replica_docs = [mongodb_versioning.stamp(doc, "", source=True) for doc in primary_docs]
+
+        def write(client):
+            docs = primary_docs if client is self.clients[0] else replica_docs
+            self.write_docs(client, docs)
+            return True
+
+        def lagging(client):
+            if client is self.clients[0]:
+                self.schedule_primary(primary_docs)
+                return
+            others = [other for other in self.clients if other is not client]
+            schedule_catch_up(client, others, self.db_name, COLLECTION_NAME)
+
+        try:
+            results = fan_out_quorum(write, self.clients, self.quorum, on_lagging=lagging)
+        finally:
+            # Чтения через шлюз сразу видят его записи (кэш ReadRouter живет в этом же процессе)
+            mongodb_read_router.cache.invalidate_keys(self.db_name, COLLECTION_NAME, list(desired))
+        metrics.observe("replication_ingest_commit_seconds", time.monotonic() - started,
+                        job="mongodb", db=self.db_name)
+        metrics.inc("replication_ingest_documents_total", len(docs), job="mongodb", db=self.db_name)
+        return sum(1 for result in results if result)
+
+    def write_docs(self, client, docs):
+        existing = {}
+        for doc in find_by_keys(client, self.db_name, COLLECTION_NAME, docs):
+            existing.setdefault(get_doc_key(doc), []).append(mongodb_raw.inflate(doc))
+        ops = [op for doc in docs for op in key_ops(existing.get(get_doc_key(doc), []), doc)]
+        if ops:
+            bulk_apply(client[self.db_name][COLLECTION_NAME], ops)
+            metrics.inc("replication_documents_written_total", len(ops), job="mongodb", node=node_label(client))
+
+    def schedule_primary(self, docs):
+        """
+        Дописывает в основной узел документы пакета, которые он не подтвердил. Догоняющая синхронизация
+        из реплик записала бы в основной узел _version, поэтому пишутся сами документы пакета (без версии)
+        """
+        with self._backlog_lock:
+            for doc in docs:
+                self._primary_backlog[get_doc_key(doc)] = doc
+
+        def task():
+            with self._backlog_lock:
+                pending = dict(self._primary_backlog)
+            self.write_docs(self.clients[0], list(pending.values()))
+            with self._backlog_lock:
+                for key, doc in pending.items():
+                    if self._primary_backlog.get(key) is doc:
+                        del self._primary_backlog[key]
+
+        node = node_label(self.clients[0])
+        print(f"⚠ {node} {self.db_name}.{COLLECTION_NAME}: основной узел не подтвердил запись, "
+              f"поставлен в очередь догоняющей записи")
+        metrics.inc("replication_errors_total", job="mongodb", db=self.db_name)
+        catch_up.enqueue((node, f"{self.db_name}.{COLLECTION_NAME}"), task)
+
+
+class _IngestServer(ThreadingHTTPServer):
+    # Очередь входящих соединений под всплески записей от многих клиентов
+    request_queue_size = 1024
+
+
+class _IngestHandler(BaseHTTPRequestHandler):
+    committers = {}
+    router = None
+
+    def do_GET(self):
+        """Чтение по ключу: GET /<БД>?name=...&email=... (через ReadRouter и его кэш)"""
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        db_name = url.path.strip("/")
+        if self.router is None or db_name not in self.committers:
+            self.reply(404, {'error': f"неизвестная БД: {url.path}"})
+            return
+        if not params.get('name') or not params.get('email'):
+            self.reply(400, {'error': "нужны параметры name и email"})
+            return
+        try:
+            doc = self.router.find_by_key(db_name, params['name'][0], params['email'][0])
+        except PyMongoError as e:
+            self.reply(503, {'error': f"реплики недоступны для чтения: {e}"})
+            return
+        if doc is None:
+            self.reply(404, {'error': "документ не найден"})
+            return
+        self.reply(200, doc)
+
+    def do_POST(self):
+        committer = self.committers.get(self.path.strip("/"))
+        if committer is None:
+            self.reply(404, {'error': f"неизвестная БД: {self.path}"})
+            return
+        try:
+            payload = json_util.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            docs = [prepare(doc) for doc in (payload if isinstance(payload, list) else [payload])]
+        except (ValueError, TypeError) as e:
+            self.reply(400, {'error': str(e)})
+            return
+        if not docs:
+            self.reply(200, {'accepted': 0, 'acked_nodes': 0})
+            return
+        try:
+            acked = committer.submit(docs).result(timeout=INGEST_ACK_TIMEOUT_SECONDS)
+        except (QuorumNotReached, TimeoutError) as e:
+            self.reply(503, {'error': f"запись не подтверждена кворумом: {e}"})
+            return
+        except Exception as e:
+            self.reply(500, {'error': str(e)})
+            return
+        self.reply(200, {'accepted': len(docs), 'acked_nodes': acked})
+
+    def reply(self, status, body):
+        body = json_util.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(sources, replica_clients, port=INGEST_PORT, router=None):
+    """
+    Запускает шлюз: sources - пары (основной узел, БД); router - ReadRouter для чтений по ключу
+    (его кэш сбрасывают записи шлюза и change stream'ы rs1). Блокирует поток до остановки
+    """
+    committers = {}
+    for source_client, db_name in sources:
+        ensure_all_indexes(source_client, replica_clients, db_name)
+        committers[db_name] = GroupCommitter(db_name, [source_client] + list(replica_clients))
+    if router is not None:
+        router.watch_invalidations(committers)
+    handler = type("IngestHandler", (_IngestHandler,), {'committers': committers, 'router': router})
+    server = _IngestServer(("0.0.0.0", port), handler)
+    print(f"✓ Шлюз записи слушает порт {port}: {', '.join(committers)} "
+          f"(пакет {INGEST_BATCH_SIZE} / {INGEST_BATCH_WAIT_MS:g}мс, кворум {INGEST_QUORUM or 'все узлы'})")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main():
+    ADMIN_USER = "admin"
+    ADMIN_PASS = "adminpass"
+
+    monitoring.register(CommandLatencyListener())
+    start_metrics_server()
+
+    try:
+        node1_client = get_client("mongodb_node1", 27017, ADMIN_USER, ADMIN_PASS)
+        node2_client = get_client("mongodb_node2", 27017, ADMIN_USER, ADMIN_PASS)
+        replica_clients = [
+            get_client(host, 27017, ADMIN_USER, ADMIN_PASS)
+            for host in ("mongodb_replica1", "mongodb_replica2", "mongodb_replica3")
+        ]
+        # Чтения идут в replica set реплик по readPreference, горячие ключи - из кэша процесса
+        router = ReadRouter(get_read_client(ADMIN_USER, ADMIN_PASS))
+        serve([(node1_client, "mongodb_db1"), (node2_client, "mongodb_db2")], replica_clients, router=router)
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        print(f"⚠ Ошибка шлюза записи: {e}")
+        return 1
+    finally:
+        registry.close_all()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Параллельная синхронизация коллекции MongoDB по разделам:
+- Коллекция делится на SYNC_PARTITIONS диапазонов по полю name и отдельный раздел для документов без ключа;
+  все версии документа с ключом name:email на всех узлах попадают в один раздел, поэтому разделы независимы
+- Разделы синхронизируются в пуле из PARTITION_WORKERS потоков, у каждого раздела свои запросы и bulk_write
+- Завершенные разделы отмечаются в хранилище состояния: после падения процесса цикл продолжается с незавершенных
+- Упавший раздел повторяется с задержкой (до PARTITION_ATTEMPTS попыток), остальные разделы не переделываются
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from adaptive_scheduler import Backoff
+from sync_mongodb_replication import (
+    COLLECTION_NAME, KEY_INDEX_FILTER, SYNC_PARTITIONS, ensure_all_indexes, sync_database_steps,
+)
+from sync_state import open_store
+
+SYNC_STATE_PATH = os.environ.get("SYNC_STATE_PATH", "sync_state.db")
+PARTITION_WORKERS = int(os.environ.get("PARTITION_WORKERS", "4"))
+PARTITION_ATTEMPTS = int(os.environ.get("PARTITION_ATTEMPTS", "3"))
+# Сколько значений name выбирать случайно на раздел для поиска границ
+SAMPLE_PER_PARTITION = 100
+# Документы без ключа name:email сопоставляются по _id (как в get_doc_key)
+KEYLESS_FILTER = {'$nor': [KEY_INDEX_FILTER]}
+
+_partition_pool = ThreadPoolExecutor(max_workers=PARTITION_WORKERS, thread_name_prefix="mongo-partition")
+
+
+def partition_bounds(collection, count):
+    """
+    Границы разделов - значения name, делящие документы с ключом на count примерно равных частей.
+    Считаются по случайной выборке ($sample первой стадией читает случайные документы, а не всю коллекцию)
+    """
+    sample = collection.aggregate([
+        {'$sample': {'size': count * SAMPLE_PER_PARTITION}},
+        {'$project': {'_id': 0, 'name': 1, 'email': 1}},
+    ])
+    names = sorted(doc['name'] for doc in sample
+                   if isinstance(doc.get('name'), str) and doc['name'] and doc.get('email'))
+    bounds = []
+    for i in range(1, count):
+        if not names:
+            break
+        name = names[len(names) * i // count]
+        if not bounds or name > bounds[-1]:
+            bounds.append(name)
+    return bounds
+
+
+def partition_filters(bounds):
+    """Фильтры разделов: диапазоны name между соседними границами и последний раздел - документы без ключа"""
+    edges = [None] + list(bounds) + [None]
+    filters = []
+    for low, high in zip(edges, edges[1:]):
+        name = dict(KEY_INDEX_FILTER['name'])
+        if low is not None:
+            name['$gte'] = low
+        if high is not None:
+            name['$lt'] = high
+        filters.append({**KEY_INDEX_FILTER, 'name': name})
+    filters.append(KEYLESS_FILTER)
+    return filters
+
+
+def checkpoint_key(db_name):
+    return f"partitions:{db_name}.{COLLECTION_NAME}"
+
+
+def sync_partitioned(source_client, replica_clients, db_name):
+    """
+    Цикл синхронизации БД по разделам коллекции. Возвращает число измененных документов.
+    Если предыдущий цикл был прерван, синхронизируются только его незавершенные разделы (с прежними границами)
+    """
+    state = open_store(SYNC_STATE_PATH)
+    key = checkpoint_key(db_name)
+    ensure_all_indexes(source_client, replica_clients, db_name)
+
+    checkpoint = state.get(key)
+    if checkpoint is None:
+        bounds = partition_bounds(source_client[db_name][COLLECTION_NAME], SYNC_PARTITIONS)
+        checkpoint = {'bounds': bounds, 'done': []}
+        state.set(key, checkpoint)
+    filters = partition_filters(checkpoint['bounds'])
+    done = set(checkpoint['done'])
+    if done:
+        print(f"Продолжение прерванного цикла {db_name}.{COLLECTION_NAME}: "
+              f"уже синхронизировано {len(done)} из {len(filters)} разделов")
+    lock = threading.Lock()
+
+    def run_partition(index):
+        backoff = Backoff()
+        for attempt in range(1, PARTITION_ATTEMPTS + 1):
+            try:
+                written = sync_database_steps(source_client, replica_clients, db_name, filters[index])
+            except Exception as e:
+                if attempt == PARTITION_ATTEMPTS:
+                    print(f"⚠ {db_name}.{COLLECTION_NAME}: раздел {index + 1}/{len(filters)} не синхронизирован "
+                          f"за {PARTITION_ATTEMPTS} попыток: {e}")
+                    return None
+                delay = backoff.next_delay()
+                print(f"⚠ {db_name}.{COLLECTION_NAME}: ошибка в разделе {index + 1}/{len(filters)} ({e}), "
+                      f"повтор через {delay:.1f}с")
+                time.sleep(delay)
+                continue
+            # Отметка сохраняется сразу: после падения процесса раздел не будет синхронизироваться повторно
+            with lock:
+                done.add(index)
+                state.set(key, {'bounds': checkpoint['bounds'], 'done': sorted(done)})
+            return written
+
+    pending = [index for index in range(len(filters)) if index not in done]
+    results = list(_partition_pool.map(run_partition, pending))
+    failed = [index + 1 for index, result in zip(pending, results) if result is None]
+    if failed:
+        # Отметки остаются: следующий цикл начнется с упавших разделов
+        print(f"⚠ {db_name}.{COLLECTION_NAME}: разделы {', '.join(map(str, failed))} будут повторены в следующем цикле")
+    else:
+        state.delete(key)
+    return sum(result for result in results if result is not None)
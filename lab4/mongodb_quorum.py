@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Запись в реплики MongoDB с кворумом:
+- Пакет записи отправляется во все реплики одновременно, шаг синхронизации ждет подтверждения
+  WRITE_QUORUM реплик (например, 2 из 3), а не самой медленной
+- Каждая запись выполняется с write concern из WRITE_CONCERN_W / WRITE_CONCERN_WTIMEOUT_MS / WRITE_CONCERN_JOURNAL
+- Реплики, которые не успели или не смогли записать, догоняют остальные в фоне (очередь catch_up)
+"""
+
+import os
+import threading
+import time
+
+from pymongo.write_concern import WriteConcern
+
+from adaptive_scheduler import Backoff
+from replication_metrics import metrics
+
+# Сколько реплик должны подтвердить запись; 0 - ждать все реплики (как раньше)
+WRITE_QUORUM = int(os.environ.get("WRITE_QUORUM", "0"))
+# w для каждого узла: число или "majority"; пусто - настройки клиента по умолчанию
+WRITE_CONCERN_W = os.environ.get("WRITE_CONCERN_W", "")
+WRITE_CONCERN_WTIMEOUT_MS = int(os.environ.get("WRITE_CONCERN_WTIMEOUT_MS", "0"))
+# Подтверждение только после записи в журнал (j=true)
+WRITE_CONCERN_JOURNAL = os.environ.get("WRITE_CONCERN_JOURNAL", "0") == "1"
+
+
+def build_write_concern():
+    """Write concern для записей синхронизации; None - если ничего не задано"""
+    if not (WRITE_CONCERN_W or WRITE_CONCERN_WTIMEOUT_MS or WRITE_CONCERN_JOURNAL):
+        return None
+    w = int(WRITE_CONCERN_W) if WRITE_CONCERN_W.isdigit() else (WRITE_CONCERN_W or None)
+    return WriteConcern(w=w, wtimeout=WRITE_CONCERN_WTIMEOUT_MS or None, j=WRITE_CONCERN_JOURNAL or None)
+
+
+WRITE_CONCERN = build_write_concern()
+
+
+def with_write_concern(collection):
+    """Коллекция с write concern синхронизации"""
+    if WRITE_CONCERN is None:
+        return collection
+    return collection.with_options(write_concern=WRITE_CONCERN)
+
+
+class CatchUpQueue:
+    """
+    Фоновая догоняющая синхронизация отставших реплик.
+    Задача - функция без аргументов; на реплику и коллекцию хранится одна задача (новая заменяет старую),
+    упавшая задача повторяется с экспоненциальной задержкой, не задерживая задачи других реплик
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self._backoffs = {}
+        self._cond = threading.Condition()
+        self._thread = None
+        metrics.set_function("replication_catchup_pending", self.pending, job="mongodb")
+
+    def pending(self):
+        with self._cond:
+            return len(self._tasks)
+
+    def enqueue(self, key, task, delay=0.0):
+        with self._cond:
+            self._tasks[key] = (task, time.monotonic() + delay)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="mongo-catchup", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _next_task(self):
+        """Ждет ближайшую готовую задачу и забирает ее из очереди"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                ready = [(not_before, key) for key, (_, not_before) in self._tasks.items()]
+                if ready:
+                    not_before, key = min(ready)
+                    if not_before <= now:
+                        return key, self._tasks.pop(key)[0]
+                    self._cond.wait(not_before - now)
+                else:
+                    self._cond.wait()
+
+    def _run(self):
+        while True:
+            key, task = self._next_task()
+            node, collection = key
+            try:
+                task()
+            except Exception as e:
+                backoff = self._backoffs.setdefault(key, Backoff())
+                delay = backoff.next_delay()
+                print(f"⚠ {node} {collection}: догоняющая синхронизация не удалась ({e}), повтор через {delay:.1f}с")
+                metrics.inc("replication_errors_total", job="mongodb", node=node)
+                with self._cond:
+                    # Задача, поставленная заново за время выполнения, новее - ее не заменяем
+                    if key not in self._tasks:
+                        self._tasks[key] = (task, time.monotonic() + delay)
+                continue
+            self._backoffs.pop(key, None)
+            print(f"✓ {node} {collection}: реплика догнала остальные")
+
+
+catch_up = CatchUpQueue()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Быстрый путь сравнения документов MongoDB в сыром BSON:
+- Документы читаются как RawBSONDocument: для ключа (name, email, _id) разбирается только верхний
+  уровень документа, вложенные документы остаются в BSON
+- Ключ, документы которого на всех узлах совпадают побайтно и уже имеют версию, исключается
+  из слияния сразу: без разбора, вычисления хеша содержимого, сравнения и операций записи
+- Разбираются только различающиеся документы (RawBackedDoc - dict со ссылкой на исходные байты);
+  документ, который победил без изменений, записывается в реплики теми же байтами, без повторного кодирования
+"""
+
+import os
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from mongodb_versioning import VERSION_FIELD
+
+SYNC_RAW_BSON = os.environ.get("SYNC_RAW_BSON", "1") == "1"
+RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+
+class RawBackedDoc(dict):
+    """Документ, разобранный из сырого BSON; raw - исходные байты (пока документ не изменен)"""
+
+    __slots__ = ("raw",)
+
+
+def raw_collection(collection):
+    """
+    Коллекция, возвращающая RawBSONDocument; None - если клиент не поддерживает document_class
+    (например, mongomock в нагрузочном замере)
+    """
+    if not SYNC_RAW_BSON:
+        return None
+    try:
+        return collection.with_options(codec_options=RAW_CODEC_OPTIONS)
+    except NotImplementedError:
+        return None
+
+
+def find(collection, query=None, **kwargs):
+    """collection.find в сыром BSON, если он доступен (иначе - обычные документы)"""
+    return (raw_collection(collection) or collection).find(query or {}, **kwargs)
+
+
+def doc_size(doc):
+    """Размер документа в BSON (для сырого документа - без кодирования)"""
+    if isinstance(doc, RawBSONDocument):
+        return len(doc.raw)
+    return len(bson.encode(doc))
+
+
+def inflate(doc):
+    """Разбирает сырой документ в RawBackedDoc; обычный документ возвращается как есть"""
+    if not isinstance(doc, RawBSONDocument):
+        return doc
+    inflated = RawBackedDoc(bson.decode(doc.raw))
+    inflated.raw = doc.raw
+    return inflated
+
+
+def as_raw(doc):
+    """Документ для записи: сырые байты, если документ не менялся после чтения"""
+    if isinstance(doc, RawBackedDoc):
+        return RawBSONDocument(doc.raw)
+    return doc
+
+
+def in_sync(docs, nodes):
+    """У ключа ровно по одному документу на каждом из nodes узлов, побайтно одинаковых и с версией"""
+    if len(docs) != nodes or not isinstance(docs[0], RawBSONDocument):
+        return False
+    raw = docs[0].raw
+    return all(doc.raw == raw for doc in docs) and VERSION_FIELD in docs[0]
+
+
+def split_in_sync(docs_per_node, key):
+    """
+    Исключает ключи, совпадающие на всех узлах (in_sync), и разбирает оставшиеся документы.
+    docs_per_node - списки документов узлов (None - узел недоступен и не участвует);
+    возвращает такие же списки только с различающимися ключами и число исключенных ключей
+    """
+    nodes = [docs for docs in docs_per_node if docs is not None]
+    if not any(docs and isinstance(docs[0], RawBSONDocument) for docs in nodes):
+        return docs_per_node, 0
+    keyed = [None if docs is None else [(key(doc), doc) for doc in docs] for docs in docs_per_node]
+    by_key = {}
+    for pairs in keyed:
+        for doc_key, doc in pairs or ():
+            by_key.setdefault(doc_key, []).append(doc)
+    skipped = {doc_key for doc_key, docs in by_key.items() if in_sync(docs, len(nodes))}
+    result = [
+        None if pairs is None else [inflate(doc) for doc_key, doc in pairs if doc_key not in skipped]
+        for pairs in keyed
+    ]
+    return result, len(skipped)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Чтение из реплик MongoDB:
+- Клиент подключается к реплике rs1 как к replica set (READ_HOSTS) и распределяет чтения по READ_PREFERENCE
+  (nearest, secondaryPreferred, ...) с ограничением отставания READ_MAX_STALENESS_SECONDS.
+  Если узлы не инициализированы как replica set (hello без setName), клиент подключается напрямую
+  к первому ответившему узлу
+- Поиск по ключу name:email идет через локальный LRU-кэш с TTL: горячие ключи не доходят до узлов
+- Кэш живет в процессе читателя, поэтому записи других процессов (синхронизации, change stream'ов) он узнает
+  из change stream'ов rs1 (watch_invalidations): измененные и удаленные документы сбрасываются по _id.
+  Если change streams недоступны (узлы не инициализированы как replica set), свежесть кэша ограничена только
+  READ_CACHE_TTL_SECONDS. Шлюз записи сбрасывает ключи своих записей сразу (invalidate_keys)
+
+Запуск: python3 mongodb_read_router.py --db mongodb_db1 --name a --email a@example.com
+"""
+
+import argparse
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pymongo
+from bson import json_util
+from pymongo.errors import OperationFailure, PyMongoError
+
+from adaptive_scheduler import Backoff
+from mongodb_clients import get_client, registry
+from replication_metrics import metrics
+
+READ_REPLICA_SET = os.environ.get("READ_REPLICA_SET", "rs1")
+READ_HOSTS = os.environ.get("READ_HOSTS", "mongodb_replica1:27017,mongodb_replica2:27017,mongodb_replica3:27017")
+# primary, primaryPreferred, secondary, secondaryPreferred, nearest
+READ_PREFERENCE = os.environ.get("READ_PREFERENCE", "nearest")
+# Максимальное отставание узла, с которого можно читать (MongoDB требует не меньше 90с); -1 - без ограничения
+READ_MAX_STALENESS_SECONDS = int(os.environ.get("READ_MAX_STALENESS_SECONDS", "90"))
+READ_CACHE_SIZE = int(os.environ.get("READ_CACHE_SIZE", "10000"))
+READ_CACHE_TTL_SECONDS = float(os.environ.get("READ_CACHE_TTL_SECONDS", "5"))
+# Код ошибки MongoDB: узел не в replica set, change streams недоступны
+CHANGE_STREAM_NOT_SUPPORTED = 40573
+
+
+class LookupCache:
+    """
+    LRU-кэш документов по ключу (БД, коллекция, name:email) с TTL.
+    Индекс по _id позволяет сбрасывать документы по операциям записи, в фильтрах которых есть только _id
+    """
+
+    def __init__(self, max_size=READ_CACHE_SIZE, ttl=READ_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._by_id = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            doc, expires = entry
+            if expires < time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return doc
+
+    def put(self, key, doc):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (doc, time.monotonic() + self.ttl)
+            self._by_id[key[:2] + (doc['_id'],)] = key
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate_keys(self, db_name, collection_name, keys):
+        """Сбрасывает документы с указанными ключами name:email"""
+        with self._lock:
+            for doc_key in keys:
+                self._drop((db_name, collection_name, doc_key))
+
+    def invalidate_ids(self, db_name, collection_name, ids):
+        """Сбрасывает документы с указанными _id; возвращает число сброшенных"""
+        dropped = 0
+        with self._lock:
+            for doc_id in ids:
+                key = self._by_id.get((db_name, collection_name, doc_id))
+                if key is not None:
+                    self._drop(key)
+                    dropped += 1
+        return dropped
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_id.clear()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._by_id.pop(key[:2] + (entry[0]['_id'],), None)
+
+
+cache = LookupCache()
+
+
+def read_options(preference=READ_PREFERENCE, max_staleness=READ_MAX_STALENESS_SECONDS, replica_set=READ_REPLICA_SET):
+    """Настройки клиента для чтения: readPreference и maxStalenessSeconds (для primary не задается)"""
+    options = {'replicaset': replica_set, 'readPreference': preference}
+    if preference != "primary" and max_staleness > 0:
+        options['maxStalenessSeconds'] = max_staleness
+    return options
+
+
+def hello(host, port, username=None, password=None):
+    """Ответ узла на hello через временный клиент (настройки проверки не должны попасть в реестр)"""
+    settings = {"directConnection": True, "serverSelectionTimeoutMS": 2000, "connectTimeoutMS": 2000}
+    if username:
+        settings.update(username=username, password=password, authSource='admin')
+    client = pymongo.MongoClient(host=host, port=int(port), **settings)
+    try:
+        return client.admin.command('hello')
+    finally:
+        client.close()
+
+
+def get_read_client(username=None, password=None, hosts=READ_HOSTS):
+    """
+    Клиент реплик из общего реестра: клиент replica set (pymongo принимает список узлов через запятую),
+    если первый ответивший узел состоит в наборе, иначе - прямое подключение к этому узлу
+    """
+    for address in hosts.split(","):
+        host, _, port = address.strip().partition(":")
+        try:
+            reply = hello(host, port or 27017, username, password)
+        except PyMongoError as e:
+            print(f"⚠ Узел чтения {address} недоступен: {e}")
+            continue
+        if reply.get('setName'):
+            return get_client(hosts, 27017, username, password, **read_options(replica_set=reply['setName']))
+        print(f"⚠ Узлы чтения не инициализированы как replica set, чтение напрямую из {address}")
+        return get_client(host, port or 27017, username, password, directConnection=True)
+    # Ни один узел пока не ответил - клиент replica set найдет узлы, когда они поднимутся
+    return get_client(hosts, 27017, username, password, **read_options())
+
+
+class ReadRouter:
+    """Чтения коллекции через клиент replica set; поиск по ключу name:email - через кэш"""
+
+    def __init__(self, client, collection_name="users", lookup_cache=cache):
+        self.client = client
+        self.collection_name = collection_name
+        self.cache = lookup_cache
+
+    def find_by_key(self, db_name, name, email):
+        """Документ с ключом name:email или None (отсутствие документа не кэшируется)"""
+        key = (db_name, self.collection_name, f"{name}:{email}")
+        doc = self.cache.get(key)
+        if doc is not None:
+            metrics.inc("replication_read_cache_total", job="mongodb", db=db_name, result="hit")
+            return doc
+        metrics.inc("replication_read_cache_total", job="mongodb", db=db_name, result="miss")
+        doc = self.client[db_name][self.collection_name].find_one({'name': name, 'email': email})
+        if doc is not None:
+            self.cache.put(key, doc)
+        return doc
+
+    def find(self, db_name, query=None, **kwargs):
+        """Произвольный запрос к коллекции по readPreference клиента (без кэша)"""
+        return self.client[db_name][self.collection_name].find(query or {}, **kwargs)
+
+    def watch_invalidations(self, db_names):
+        """Запускает фоновый сброс кэша по change stream'ам коллекции в каждой из БД"""
+        for db_name in db_names:
+            threading.Thread(target=self._watch, args=(db_name,), name=f"cache-watch-{db_name}", daemon=True).start()
+
+    def _watch(self, db_name):
+        collection = self.client[db_name][self.collection_name]
+        backoff = Backoff()
+        while True:
+            try:
+                with collection.watch([{'$project': {'documentKey': 1}}]) as stream:
+                    # События, пропущенные до открытия потока, неизвестны - кэш начинается заново
+                    self.cache.clear()
+                    backoff.reset()
+                    for change in stream:
+                        if 'documentKey' in change:
+                            self.cache.invalidate_ids(db_name, self.collection_name, [change['documentKey']['_id']])
+                        else:
+                            # drop, rename, invalidate - затронута вся коллекция
+                            self.cache.clear()
+            except PyMongoError as e:
+                if isinstance(e, OperationFailure) and e.code == CHANGE_STREAM_NOT_SUPPORTED:
+                    print(f"⚠ {db_name}.{self.collection_name}: change streams недоступны, "
+                          f"кэш чтения обновляется только по TTL ({self.cache.ttl:g}с)")
+                    return
+                delay = backoff.next_delay()
+                print(f"⚠ Ошибка сброса кэша {db_name}.{self.collection_name}: {e}, повтор через {delay:.1f}с")
+                time.sleep(delay)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Чтение документа из реплик MongoDB по ключу name:email")
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="adminpass")
+    parser.add_argument("--db", default="mongodb_db1")
+    parser.add_argument("--name", required=True)
+    parser.add_argument("--email", required=True)
+    parser.add_argument("--repeat", type=int, default=1, help="сколько раз повторить чтение (проверка кэша)")
+    args = parser.parse_args()
+
+    router = ReadRouter(get_read_client(args.user, args.password))
+    try:
+        started = time.monotonic()
+        for _ in range(args.repeat):
+            doc = router.find_by_key(args.db, args.name, args.email)
+        elapsed = time.monotonic() - started
+        print(json_util.dumps(doc, ensure_ascii=False) if doc is not None else "⚠ Документ не найден")
+        print(f"✓ Чтений: {args.repeat} за {elapsed:.3f}с ({READ_PREFERENCE}, {READ_REPLICA_SET})")
+    finally:
+        registry.close_all()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
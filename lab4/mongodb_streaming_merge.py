@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Потоковое слияние коллекций MongoDB с ограниченной памятью:
+- На всех узлах открываются курсоры, отсортированные по (name, email, _id)
+- k-way merge-join группирует документы с одинаковым ключом name:email; документы читаются в сыром BSON,
+  и группы, побайтно совпадающие на всех узлах, пропускаются без разбора (mongodb_raw.py)
+- Операции записи копятся пачками и отправляются по мере заполнения пачки,
+  поэтому пиковая память зависит от размера пачки, а не от размера коллекции
+"""
+
+import heapq
+import itertools
+import os
+from numbers import Number
+
+import mongodb_raw
+import mongodb_tombstones
+import mongodb_versioning
+from sync_mongodb_replication import bulk_apply, key_ops, node_label
+
+MERGE_BATCH_SIZE = int(os.environ.get("MERGE_BATCH_SIZE", "1000"))
+SORT_ORDER = [('name', 1), ('email', 1), ('_id', 1)]
+
+
+def _sort_value(value):
+    """Значение поля в виде, сравнимом так же, как при сортировке MongoDB (null < числа < строки < прочее)"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (4, value)
+    if isinstance(value, Number):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, str(value))
+
+
+def merge_key(doc):
+    """
+    Ключ слияния в порядке сортировки курсора (name, email, _id).
+    Документы с name и email сравниваются только по ним (как в get_doc_key), остальные - еще и по _id
+    """
+    name = doc.get('name')
+    email = doc.get('email')
+    key = (_sort_value(name), _sort_value(email))
+    if name and email:
+        return key + ('',)
+    return key + (str(doc.get('_id', '')),)
+
+
+def _tagged(cursor, index):
+    for doc in cursor:
+        yield merge_key(doc), index, doc
+
+
+class BatchWriter:
+    """Копит операции для коллекции и отправляет их пачками через bulk_write"""
+
+    def __init__(self, collection, batch_size=MERGE_BATCH_SIZE):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.ops = []
+        self.written = 0
+
+    def add(self, ops):
+        self.ops.extend(ops)
+        if len(self.ops) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.ops:
+            bulk_apply(self.collection, self.ops)
+            self.written += len(self.ops)
+            self.ops = []
+
+
+def streaming_merge(collections, writable, choose, query=None, batch_size=MERGE_BATCH_SIZE, tombstones=None,
+                    source=None, queries=None):
+    """
+    Сливает коллекции потоково.
+    collections - коллекции-участники; writable - индексы коллекций, в которые выполняется запись;
+    choose(current, candidate) - выбирает победившую версию документа из двух;
+    tombstones - надгробия коллекции (mongodb_tombstones.load): удаленные документы не побеждают;
+    source - индекс коллекции основного узла (его документы сверяются с надгробиями по содержимому);
+    queries - свои фильтры для каждой коллекции (по умолчанию query для всех).
+    Возвращает число отправленных операций для каждой записываемой коллекции
+    """
+    queries = queries or [query] * len(collections)
+    cursors = [
+        mongodb_raw.find(collection, collection_query, sort=SORT_ORDER, batch_size=batch_size, allow_disk_use=True)
+        for collection, collection_query in zip(collections, queries)
+    ]
+    writers = {i: BatchWriter(collections[i], batch_size) for i in writable}
+    nodes = [node_label(collection.database.client) for collection in collections]
+    try:
+        merged = heapq.merge(*[_tagged(cursor, i) for i, cursor in enumerate(cursors)], key=lambda item: item[0])
+        for _, group in itertools.groupby(merged, key=lambda item: item[0]):
+            group = list(group)
+            # Побайтно одинаковые документы на всех узлах не разбираются и не сравниваются
+            if mongodb_raw.in_sync([doc for _, _, doc in group], len(collections)):
+                continue
+            docs_by_node = {}
+            winner = None
+            # heapq.merge стабилен: при равных ключах документы идут в порядке коллекций
+            for _, index, doc in group:
+                doc = mongodb_raw.inflate(doc)
+                docs_by_node.setdefault(index, []).append(doc)
+                # Выбор идет по версиям; документ без действительной версии получает ее (копия, исходный не меняется)
+                doc = mongodb_versioning.observe(doc, nodes[index])
+                if tombstones and index == source:
+                    doc = mongodb_tombstones.resolve_source(doc, tombstones)
+                    if doc is None:
+                        continue
+                elif tombstones and mongodb_tombstones.killed(doc, tombstones):
+                    continue
+                winner = doc if winner is None else choose(winner, doc)
+            if winner is None:
+                continue
+
+            for index, writer in writers.items():
+                ops = key_ops(docs_by_node.get(index, []), winner)
+                if ops:
+                    writer.add(ops)
+
+        for writer in writers.values():
+            writer.flush()
+    finally:
+        for cursor in cursors:
+            cursor.close()
+    return {i: writer.written for i, writer in writers.items()}
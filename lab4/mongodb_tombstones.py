@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Надгробия (tombstones) для удалений в MongoDB:
+- Удаление документа записывается в служебную коллекцию _tombstones той же БД на репликах: _id удаленного
+  документа, отметка HLC и узел, а также узлы, подтвердившие удаление (acks). Основной узел синхронизацией
+  не меняется, и надгробия в нем не хранятся
+- В каждом цикле надгробия собираются с реплик (их немного - работа пропорциональна числу удалений,
+  а не размеру коллекции) и применяются к репликам: документ удаляется, если его версия не новее надгробия;
+  документ, измененный после удаления, побеждает (last write wins, как и для обновлений)
+- У документа основного узла нет своей версии (отметка по created_at всегда старше надгробия), поэтому
+  надгробие запоминает хеш его содержимого (source_hash): документ основного узла, изменившийся после
+  удаления, восстанавливается с отметкой сразу после надгробия
+- Слияние пропускает документы, закрытые надгробием, поэтому удаленный документ не восстанавливается
+  из других реплик или из основного узла
+- Удаление в реплике в обход delete_document и change stream'ов (обычный deleteOne в режиме опроса) надгробия
+  не оставляет. Поэтому в конце цикла запоминаются _id документов каждой реплики (remember_ids), а в начале
+  следующего для пропавших из реплики документов записываются надгробия (detect_deletes)
+- Надгробие удаляется с реплик, когда его подтвердили все узлы БД. Основной узел подтверждает,
+  когда в нем нет закрытого надгробием документа (удаление в реплике не переносится в основной узел,
+  поэтому надгробие живет, пока основной узел не удалит или не изменит документ)
+
+Удаление в обход change stream'ов: python3 mongodb_tombstones.py --db mongodb_db1 --filter '{"name": "x"}'
+(при удалении в основном узле надгробия пишутся в реплики: --tombstone-hosts mongodb_replica1:27017,...)
+"""
+
+import argparse
+import os
+from datetime import datetime, timezone
+
+from bson import json_util
+from pymongo import DeleteOne, UpdateOne
+
+import mongodb_versioning
+from mongodb_fanout import fan_out
+from replication_metrics import metrics
+from sync_state import open_store
+
+TOMBSTONE_COLLECTION = "_tombstones"
+SYNC_STATE_PATH = os.environ.get("SYNC_STATE_PATH", "sync_state.db")
+# Поиск удалений в обход delete_document по _id реплик (0 - все удаления идут через delete_document/change stream)
+TRACK_DELETES = os.environ.get("TRACK_DELETES", "1") == "1"
+
+
+def tombstone_id(collection_name, doc_id):
+    return {'collection': collection_name, 'id': doc_id}
+
+
+def record(client, db_name, collection_name, doc_id, node, hlc=None, acks=()):
+    """
+    Записывает надгробие в узел client (если оно там уже есть - только добавляет подтверждения).
+    hlc - отметка удаления, по умолчанию текущее время HLC; возвращает отметку
+    """
+    hlc = mongodb_versioning.clock.now() if hlc is None else hlc
+    client[db_name][TOMBSTONE_COLLECTION].update_one(
+        {'_id': tombstone_id(collection_name, doc_id)},
+        {
+            '$setOnInsert': {'hlc': hlc, 'node': node, 'deleted_at': datetime.now(timezone.utc)},
+            '$addToSet': {'acks': {'$each': list(acks)}},
+        },
+        upsert=True,
+    )
+    return hlc
+
+
+def delete_document(client, db_name, collection_name, doc_filter, node, tombstone_clients=None):
+    """
+    Удаляет документы по фильтру и записывает для них надгробия в tombstone_clients (по умолчанию - в тот же узел;
+    для основного узла - реплики); возвращает число удаленных
+    """
+    collection = client[db_name][collection_name]
+    deleted = 0
+    for doc in collection.find(doc_filter, {'_id': 1}):
+        # Надгробие пишется до удаления: если процесс упадет между ними, удаление выполнит синхронизация
+        hlc = mongodb_versioning.clock.now()
+        for tombstone_client in tombstone_clients or [client]:
+            record(tombstone_client, db_name, collection_name, doc['_id'], node, hlc=hlc)
+        deleted += collection.delete_one({'_id': doc['_id']}).deleted_count
+    return deleted
+
+
+def _ids_key(node, db_name, collection_name):
+    return f"ids:{node}/{db_name}.{collection_name}"
+
+
+def _current_ids(client, db_name, collection_name):
+    """_id документов коллекции в Extended JSON (подходят для хранилища состояния при любом типе _id)"""
+    return {json_util.dumps(doc['_id']) for doc in client[db_name][collection_name].find({}, {'_id': 1})}
+
+
+def detect_deletes(replica_clients, db_name, collection_name, node_label):
+    """
+    Записывает надгробия для документов, пропавших из реплики с конца прошлого цикла (remember_ids):
+    их удалили в обход delete_document. Возвращает число найденных удалений
+    """
+    state = open_store(SYNC_STATE_PATH)
+    labels = [node_label(client) for client in replica_clients]
+
+    def detect(index):
+        client, node = replica_clients[index], labels[index]
+        previous = state.get(_ids_key(node, db_name, collection_name))
+        if previous is None:
+            return 0
+        missing = set(previous) - _current_ids(client, db_name, collection_name)
+        for doc_id in missing:
+            record(client, db_name, collection_name, json_util.loads(doc_id), node)
+        if missing:
+            print(f"  {db_name}.{collection_name}: удаления в обход надгробий: {len(missing)} ({node})")
+        return len(missing)
+
+    deleted = 0
+    for index, result in enumerate(fan_out(detect, range(len(replica_clients)))):
+        if isinstance(result, Exception):
+            print(f"⚠ {labels[index]} {db_name}.{collection_name}: удаления не проверены ({result})")
+            metrics.inc("replication_errors_total", job="mongodb", node=labels[index], db=db_name)
+            continue
+        deleted += result
+    return deleted
+
+
+def remember_ids(replica_clients, db_name, collection_name, node_label):
+    """Запоминает _id документов каждой реплики после цикла - с ними сравнит detect_deletes"""
+    state = open_store(SYNC_STATE_PATH)
+    keys = [_ids_key(node_label(client), db_name, collection_name) for client in replica_clients]
+
+    def remember(index):
+        state.set(keys[index], sorted(_current_ids(replica_clients[index], db_name, collection_name)))
+
+    for index, result in enumerate(fan_out(remember, range(len(replica_clients)))):
+        if isinstance(result, Exception):
+            # Устаревшая отметка приняла бы удаления самой синхронизации за новые - реплика пропустит проверку
+            print(f"⚠ {keys[index]}: _id реплики не сохранены ({result})")
+            state.delete(keys[index])
+
+
+def load(clients, db_name, collection_name):
+    """
+    Надгробия коллекции со всех доступных реплик: {_id документа: {'hlc', 'node', 'acks'[, 'source_hash']}};
+    для одного документа берется самое позднее удаление, подтверждения объединяются
+    """
+    def read(client):
+        return list(client[db_name][TOMBSTONE_COLLECTION].find({'_id.collection': collection_name}))
+
+    tombstones = {}
+    for result in fan_out(read, clients):
+        if isinstance(result, Exception):
+            continue
+        for entry in result:
+            doc_id = entry['_id']['id']
+            merged = tombstones.setdefault(doc_id, {'hlc': entry['hlc'], 'node': entry['node'], 'acks': set()})
+            if (entry['hlc'], entry['node']) > (merged['hlc'], merged['node']):
+                merged['hlc'], merged['node'] = entry['hlc'], entry['node']
+            merged['acks'].update(entry.get('acks', []))
+            if 'source_hash' in entry:
+                merged['source_hash'] = entry['source_hash']
+    return tombstones
+
+
+def killed(doc, tombstones):
+    """Документ реплики (прошедший observe) закрыт надгробием: удален не раньше своей последней версии"""
+    tombstone = tombstones.get(doc['_id'])
+    return tombstone is not None and mongodb_versioning.version_key(doc)[0] <= tombstone['hlc']
+
+
+def resolve_source(doc, tombstones):
+    """
+    Документ основного узла (прошедший observe) с учетом надгробий: None - закрыт надгробием.
+    Документ без своей версии сравнивается с содержимым на момент удаления (source_hash): измененный или
+    созданный заново документ восстанавливается с отметкой сразу после надгробия - она новее удаления
+    на всех узлах и одинакова в каждом цикле. Пока source_hash не записан, документ считается удаленным
+    """
+    tombstone = tombstones.get(doc['_id'])
+    if tombstone is None:
+        return doc
+    version = doc.get(mongodb_versioning.VERSION_FIELD) or {}
+    if version.get('node') != '':
+        return None if killed(doc, tombstones) else doc
+    if 'source_hash' not in tombstone or tombstone['source_hash'] == version.get('hash'):
+        return None
+    return mongodb_versioning.stamp(doc, '', hlc=tombstone['hlc'] + 1, source=True)
+
+
+def _source_victims(collection, tombstones, node):
+    """
+    Документы основного узла, закрытые надгробиями. Надгробиям без source_hash записывается хеш содержимого
+    документа (None - документа нет: появившийся позже документ создан после удаления)
+    """
+    docs = {doc['_id']: doc for doc in collection.find({'_id': {'$in': list(tombstones)}})}
+    for doc_id, tombstone in tombstones.items():
+        if 'source_hash' not in tombstone:
+            doc = docs.get(doc_id)
+            tombstone['source_hash'] = None if doc is None else mongodb_versioning.content_hash(doc)
+    return [doc for doc in docs.values() if resolve_source(mongodb_versioning.observe(doc, node), tombstones) is None]
+
+
+def _killed_docs(collection, tombstones, node):
+    """Документы реплики, закрытые надгробиями (поиск по _id - по числу надгробий, а не по коллекции)"""
+    docs = collection.find({'_id': {'$in': list(tombstones)}})
+    return [doc for doc in docs if killed(mongodb_versioning.observe(doc, node), tombstones)]
+
+
+def process(source_client, replica_clients, db_name, collection_name, node_label):
+    """
+    Применяет надгробия БД: удаляет закрытые ими документы в репликах, рассылает надгробия
+    с подтверждениями на все реплики и удаляет надгробия, подтвержденные всеми узлами (включая основной).
+    Возвращает надгробия, оставшиеся после сборки мусора
+    """
+    nodes = [source_client] + list(replica_clients)
+    labels = [node_label(client) for client in nodes]
+    tombstones = load(replica_clients, db_name, collection_name)
+    if not tombstones:
+        metrics.set("replication_tombstones", 0, job="mongodb", db=db_name)
+        return {}
+
+    def apply(index):
+        collection = nodes[index][db_name][collection_name]
+        if index == 0:
+            # Основной узел не меняется: он подтверждает только надгробия, которым не противоречит
+            blocked = {doc['_id'] for doc in _source_victims(collection, tombstones, labels[index])}
+        else:
+            victims = _killed_docs(collection, tombstones, labels[index])
+            # Удаление - только если документ не изменился после чтения (та же версия)
+            ops = [DeleteOne({'_id': doc['_id'], mongodb_versioning.VERSION_FIELD: doc.get(mongodb_versioning.VERSION_FIELD)})
+                   for doc in victims]
+            if ops:
+                deleted = collection.bulk_write(ops, ordered=False).deleted_count
+                metrics.inc("replication_documents_written_total", deleted, job="mongodb", node=labels[index])
+                print(f"  {db_name}.{collection_name}: удалено по надгробиям -{deleted} ({labels[index]})")
+            blocked = set()
+        return {doc_id for doc_id in tombstones if doc_id not in blocked}
+
+    acked_by = {}
+    for index, result in enumerate(fan_out(apply, range(len(nodes)))):
+        if isinstance(result, Exception):
+            print(f"⚠ {labels[index]} {db_name}.{collection_name}: надгробия не применены ({result})")
+            metrics.inc("replication_errors_total", job="mongodb", node=labels[index])
+            continue
+        acked_by[index] = result
+        for doc_id in result:
+            tombstones[doc_id]['acks'].add(labels[index])
+
+    # Надгробия с подтверждениями рассылаются на все доступные реплики (переживают потерю любой из них)
+    ops = [
+        UpdateOne(
+            {'_id': tombstone_id(collection_name, doc_id)},
+            {'$set': {key: tombstone[key] for key in ('hlc', 'node', 'source_hash') if key in tombstone},
+             '$setOnInsert': {'deleted_at': datetime.now(timezone.utc)},
+             '$addToSet': {'acks': {'$each': sorted(tombstone['acks'])}}},
+            upsert=True,
+        )
+        for doc_id, tombstone in tombstones.items()
+    ]
+    collected = [doc_id for doc_id, tombstone in tombstones.items() if tombstone['acks'].issuperset(labels)]
+    collected_ids = [tombstone_id(collection_name, doc_id) for doc_id in collected]
+
+    def publish(index):
+        tombstone_collection = nodes[index][db_name][TOMBSTONE_COLLECTION]
+        tombstone_collection.bulk_write(ops, ordered=False)
+        if collected_ids:
+            tombstone_collection.delete_many({'_id': {'$in': collected_ids}})
+
+    for result in fan_out(publish, [index for index in sorted(acked_by) if index > 0]):
+        if isinstance(result, Exception):
+            print(f"⚠ {db_name}.{TOMBSTONE_COLLECTION}: надгробия не сохранены ({result})")
+    if collected:
+        print(f"  {db_name}.{TOMBSTONE_COLLECTION}: удалено подтвержденных надгробий: {len(collected)}")
+    for doc_id in collected:
+        del tombstones[doc_id]
+    metrics.set("replication_tombstones", len(tombstones), job="mongodb", db=db_name)
+    return tombstones
+
+
+def main():
+    from mongodb_clients import get_client, registry
+
+    parser = argparse.ArgumentParser(description="Удаление документов MongoDB с надгробиями")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=27017)
+    parser.add_argument("--user", default="admin")
+    parser.add_argument("--password", default="adminpass")
+    parser.add_argument("--db", default="mongodb_db1")
+    parser.add_argument("--collection", default="users")
+    parser.add_argument("--filter", required=True, help="фильтр документов в Extended JSON")
+    parser.add_argument("--tombstone-hosts", default="",
+                        help="узлы host:port через запятую, куда записать надгробия (по умолчанию - --host; "
+                             "для основного узла - реплики)")
+    args = parser.parse_args()
+
+    client = get_client(args.host, args.port, args.user, args.password)
+    tombstone_clients = [
+        get_client(*address.rsplit(":", 1), args.user, args.password)
+        for address in args.tombstone_hosts.split(",") if address
+    ]
+    try:
+        deleted = delete_document(client, args.db, args.collection, json_util.loads(args.filter),
+                                  f"{args.host}:{args.port}", tombstone_clients)
+        print(f"✓ Удалено документов: {deleted}")
+    finally:
+        registry.close_all()
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
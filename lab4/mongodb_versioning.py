@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Версии документов MongoDB на гибридных логических часах (HLC):
+- Каждая версия документа хранит в поле _version отметку HLC, узел записи, хеш содержимого и хеш ключа
+  (по нему anti-entropy выбирает документы корзины через индекс)
+- Слияние выбирает последнюю запись по HLC (last-writer-wins), а не по строке created_at
+- Совпадающие версии сравниваются без сравнения содержимого
+- Документы без версии (записанные в обход синхронизации) получают версию при первом чтении:
+  по created_at, если версии нет совсем, или текущим временем HLC, если содержимое изменилось после отметки
+- Версия, записанная в реплики из источника без версии, отмечена source: правка источника после нее
+  распознается по хешу содержимого и получает новую отметку HLC
+"""
+
+import hashlib
+import threading
+import time
+from datetime import datetime
+
+import bson
+from bson import ObjectId
+
+VERSION_FIELD = "_version"
+# Младшие биты отметки - логический счетчик HLC, старшие - физическое время в миллисекундах
+LOGICAL_BITS = 16
+LOGICAL_MASK = (1 << LOGICAL_BITS) - 1
+
+
+def encode(wall_ms, logical=0):
+    return (wall_ms << LOGICAL_BITS) | logical
+
+
+def decode(hlc):
+    return hlc >> LOGICAL_BITS, hlc & LOGICAL_MASK
+
+
+class HybridLogicalClock:
+    """Гибридные логические часы: монотонны и не отстают от отметок, полученных от других узлов"""
+
+    def __init__(self):
+        self.wall_ms = 0
+        self.logical = 0
+        self._lock = threading.Lock()
+
+    def now(self):
+        """Отметка для новой записи"""
+        physical = int(time.time() * 1000)
+        with self._lock:
+            if physical > self.wall_ms:
+                self.wall_ms, self.logical = physical, 0
+            else:
+                self.logical += 1
+            return encode(self.wall_ms, self.logical)
+
+    def update(self, remote):
+        """Учитывает отметку, увиденную в документе другого узла"""
+        remote_wall, remote_logical = decode(remote)
+        physical = int(time.time() * 1000)
+        with self._lock:
+            wall = max(self.wall_ms, remote_wall, physical)
+            if wall == self.wall_ms == remote_wall:
+                self.logical = max(self.logical, remote_logical) + 1
+            elif wall == self.wall_ms:
+                self.logical += 1
+            elif wall == remote_wall:
+                self.logical = remote_logical + 1
+            else:
+                self.logical = 0
+            self.wall_ms = wall
+            return encode(self.wall_ms, self.logical)
+
+
+clock = HybridLogicalClock()
+
+
+def content_hash(doc):
+    """Хеш содержимого документа без _id и _version (порядок полей верхнего уровня не важен)"""
+    content = {key: doc[key] for key in sorted(doc) if key not in ('_id', VERSION_FIELD)}
+    return hashlib.sha1(bson.encode(content)).hexdigest()[:16]
+
+
+def key_hash(doc):
+    """
+    32-битный FNV-1a ключа документа (как get_doc_key) по кодовым единицам UTF-16 -
+    то же значение, что считает JavaScript в mongodb_anti_entropy
+    """
+    name, email = doc.get('name'), doc.get('email')
+    key = f"k:{name}:{email}" if name and email else f"id:{doc.get('_id')}"
+    data = key.encode('utf-16-le')
+    h = 0x811c9dc5
+    for i in range(0, len(data), 2):
+        h = ((h ^ (data[i] | data[i + 1] << 8)) * 0x01000193) & 0xFFFFFFFF
+    return h
+
+
+def stamp(doc, node, hlc=None, source=False):
+    """
+    Копия документа с новой версией (по умолчанию - текущее время HLC).
+    source - содержимое совпадает с документом источника без версии (запись шлюза или правка источника):
+    по хешу такой версии видно, изменился ли источник после нее (is_source_update)
+    """
+    stamped = {key: value for key, value in doc.items() if key != VERSION_FIELD}
+    stamped[VERSION_FIELD] = {
+        'hlc': clock.now() if hlc is None else hlc,
+        'node': node,
+        'hash': content_hash(doc),
+        'key_hash': key_hash(doc),
+    }
+    if source:
+        stamped[VERSION_FIELD]['source'] = True
+    return stamped
+
+
+def legacy_hlc(doc):
+    """Отметка для документа, записанного без версии: по created_at, иначе по времени создания _id"""
+    try:
+        created = datetime.fromisoformat(doc.get('created_at', ''))
+        return encode(int(created.timestamp() * 1000))
+    except (TypeError, ValueError):
+        pass
+    if isinstance(doc.get('_id'), ObjectId):
+        return encode(int(doc['_id'].generation_time.timestamp() * 1000))
+    return 0
+
+
+def observe(doc, node):
+    """
+    Возвращает документ с действительной версией: сам документ, если версия соответствует содержимому,
+    иначе копию с новой версией. Исходный документ не меняется - его сравнение с результатом покажет,
+    что версию нужно записать и на этот узел
+    """
+    version = doc.get(VERSION_FIELD)
+    if isinstance(version, dict):
+        if version.get('hash') == content_hash(doc):
+            clock.update(version.get('hlc', 0))
+            return doc
+        # Документ изменен после отметки в обход синхронизации - это новая запись
+        return stamp(doc, node)
+    # Узел в версии пустой, чтобы одинаковые документы без версии на разных узлах получили одну версию
+    return stamp(doc, "", legacy_hlc(doc))
+
+
+def version_key(doc):
+    """Ключ упорядочивания версий: HLC, затем узел, затем хеш (для однозначного выбора при равенстве)"""
+    version = doc.get(VERSION_FIELD) or {}
+    return version.get('hlc', 0), version.get('node', ''), version.get('hash', '')
+
+
+def is_source_update(source, replica):
+    """
+    Документ источника без собственной версии (узел '' - отметка по created_at) изменен после версии,
+    записанной в реплику из источника: его правка - новая запись, хотя отметка по created_at старше
+    (документы должны пройти observe). Версия из источника - либо отмеченная source (ее отметка HLC новее
+    created_at), либо такая же отметка по created_at с узлом ''
+    """
+    incoming = source.get(VERSION_FIELD) or {}
+    recorded = replica.get(VERSION_FIELD) or {}
+    if incoming.get('node') != '' or incoming.get('hash') == recorded.get('hash'):
+        return False
+    if recorded.get('source'):
+        return True
+    return recorded.get('node') == '' and incoming.get('hlc', 0) >= recorded.get('hlc', 0)
+
+
+def source_update(doc):
+    """
+    Версия для правки источника, победившей по is_source_update: новая отметка HLC, чтобы реплики,
+    еще хранящие прежнюю версию, не вернули ее при слиянии по HLC
+    """
+    return stamp(doc, '', source=True)
+
+
+def same_version(a, b):
+    """Версии документов совпадают (содержимое тогда тоже совпадает и сравнивать его не нужно)"""
+    version = a.get(VERSION_FIELD)
+    return version is not None and version == b.get(VERSION_FIELD)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Снимки PostgreSQL на диске (формат snapshot_archive.py) вместо текстового pg_dump:
+- Таблица делится на части по CHUNK_ROWS строк по первичному ключу, часть - COPY binary диапазона ключей
+- Снимок каждого источника пишется в свой каталог (SNAPSHOT_DIR/<БД>), источники и таблицы - параллельно
+- Восстановление выполняется по частям параллельно (RESTORE_WORKERS); часть, совпадающая с приемником
+  по контрольной сумме, пропускается, остальные заменяются (DELETE диапазона + COPY) в своей транзакции
+
+Запуск: python3 pg_archive.py dump [sourcedb1 ...]; python3 pg_archive.py restore [sourcedb1 ...]
+"""
+
+import argparse
+import hashlib
+import io
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2 import sql
+
+from pg_snapshot import (
+    SNAPSHOT_WORKERS, create_table_sql, primary_key, secondary_indexes, source_tables, table_columns,
+)
+from snapshot_archive import CHUNK_ROWS, RESTORE_WORKERS, SnapshotWriter, read_chunk, read_manifest, totals
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshots")
+
+
+def chunk_bounds(cur, schema, table, key_columns):
+    """Нижние границы частей (кроме первой) - значения ключа каждой CHUNK_ROWS-й строки, в текстовом виде"""
+    keys = sql.SQL(", ").join(map(sql.Identifier, key_columns))
+    cur.execute(sql.SQL(
+        "SELECT {} FROM (SELECT {}, row_number() OVER (ORDER BY {}) AS rn FROM {}) s "
+        "WHERE rn > 1 AND rn %% %s = 1 ORDER BY rn"
+    ).format(
+        sql.SQL(", ").join(sql.SQL("{}::text").format(sql.Identifier(column)) for column in key_columns),
+        keys, keys, sql.Identifier(schema, table),
+    ), (CHUNK_ROWS,))
+    return [list(row) for row in cur.fetchall()]
+
+
+def range_condition(key_columns, key_types, low, high):
+    """Условие WHERE для диапазона ключей [low, high) и его параметры (границы приводятся к типам ключа)"""
+    if not key_columns:
+        return sql.SQL("TRUE"), []
+    keys = sql.SQL("({})").format(sql.SQL(", ").join(map(sql.Identifier, key_columns)))
+    values = sql.SQL("({})").format(sql.SQL(", ").join(
+        sql.SQL("%s::{}").format(sql.SQL(key_type)) for key_type in key_types))
+    conditions, params = [], []
+    if low is not None:
+        conditions.append(sql.SQL("{} >= {}").format(keys, values))
+        params.extend(low)
+    if high is not None:
+        conditions.append(sql.SQL("{} < {}").format(keys, values))
+        params.extend(high)
+    if not conditions:
+        return sql.SQL("TRUE"), []
+    return sql.SQL(" AND ").join(conditions), params
+
+
+def chunk_query(cur, item, low, high):
+    """SQL выгрузки части в COPY binary (строки в порядке ключа, чтобы контрольная сумма была воспроизводимой)"""
+    columns = sql.SQL(", ").join(sql.Identifier(column) for column, _, _ in item["columns"])
+    condition, params = range_condition(item["key"], item["key_types"], low, high)
+    order = sql.SQL(" ORDER BY {}").format(sql.SQL(", ").join(map(sql.Identifier, item["key"]))) \
+        if item["key"] else sql.SQL("")
+    query = sql.SQL("COPY (SELECT {} FROM {} WHERE {}{}) TO STDOUT WITH (FORMAT binary)").format(
+        columns, sql.Identifier(item["schema"], item["table"]), condition, order)
+    return cur.mogrify(query, params).decode()
+
+
+def dump_table(source_dsn, writer, schema, table):
+    """Записывает таблицу в снимок по частям; возвращает число строк"""
+    conn = psycopg2.connect(source_dsn)
+    try:
+        # Все части таблицы читаются из одного согласованного снимка REPEATABLE READ
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with conn.cursor() as cur:
+            columns = table_columns(cur, schema, table)
+            key_columns = primary_key(cur, schema, table)
+            types = dict((column, col_type) for column, col_type, _ in columns)
+            item = writer.add_item(
+                f"{schema}.{table}", schema=schema, table=table, columns=[list(column) for column in columns],
+                key=key_columns, key_types=[types[column] for column in key_columns],
+                indexes=secondary_indexes(cur, schema, table),
+            )
+            cur.execute(sql.SQL("SELECT count(*) FROM {}").format(sql.Identifier(schema, table)))
+            rows = cur.fetchone()[0]
+            edges = [None] + (chunk_bounds(cur, schema, table, key_columns) if key_columns else []) + [None]
+            for index, (low, high) in enumerate(zip(edges, edges[1:])):
+                buffer = io.BytesIO()
+                cur.copy_expert(chunk_query(cur, item, low, high), buffer)
+                # Все части, кроме последней, содержат ровно CHUNK_ROWS строк
+                chunk_rows = CHUNK_ROWS if high is not None else rows - CHUNK_ROWS * index
+                writer.write_chunk(item, buffer.getvalue(), chunk_rows, range=[low, high])
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+
+def dump_source(source, directory):
+    """Пишет снимок одного источника в каталог; возвращает манифест"""
+    started = time.monotonic()
+    conn = psycopg2.connect(source["dsn"])
+    try:
+        with conn.cursor() as cur:
+            tables = source_tables(cur)
+    finally:
+        conn.close()
+    writer = SnapshotWriter(directory, "postgres", source["db"])
+    with ThreadPoolExecutor(max_workers=max(1, min(SNAPSHOT_WORKERS, len(tables)))) as pool:
+        for future in [pool.submit(dump_table, source["dsn"], writer, schema, table) for schema, table in tables]:
+            future.result()
+    manifest = writer.finish()
+    rows, raw_bytes, stored_bytes = totals(manifest)
+    logging.info(f"[{source['db']}] Снимок {directory}: {len(tables)} таблиц, {rows} строк, "
+                 f"{raw_bytes} -> {stored_bytes} байт ({manifest['compression']}) за {time.monotonic() - started:.1f}с")
+    return manifest
+
+
+def ensure_table(replica_dsn, item):
+    """Создает таблицу в приемнике по описанию из манифеста; индексы строятся только для новой таблицы"""
+    conn = psycopg2.connect(replica_dsn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s)", (f'"{item["schema"]}"."{item["table"]}"',))
+            if cur.fetchone()[0] is None:
+                cur.execute(create_table_sql(sql.Identifier(item["schema"], item["table"]),
+                                             [tuple(column) for column in item["columns"]], item["key"]))
+                for index_definition in item["indexes"]:
+                    cur.execute(index_definition)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def restore_chunk(directory, manifest, replica_dsn, item, chunk):
+    """Заменяет диапазон ключей части в приемнике; возвращает False, если приемник уже совпадает с частью"""
+    low, high = chunk["range"]
+    conn = psycopg2.connect(replica_dsn)
+    try:
+        with conn.cursor() as cur:
+            target = hashlib.sha256()
+            cur.copy_expert(chunk_query(cur, item, low, high), _HashWriter(target))
+            if target.hexdigest() == chunk["sha256"]:
+                conn.rollback()
+                return False
+            data = read_chunk(directory, manifest, chunk)
+            condition, params = range_condition(item["key"], item["key_types"], low, high)
+            cur.execute(sql.SQL("DELETE FROM {} WHERE {}").format(
+                sql.Identifier(item["schema"], item["table"]), condition), params)
+            columns = sql.SQL(", ").join(sql.Identifier(column) for column, _, _ in item["columns"])
+            cur.copy_expert(sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT binary)").format(
+                sql.Identifier(item["schema"], item["table"]), columns).as_string(cur), io.BytesIO(data))
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+class _HashWriter:
+    """Файлоподобный объект для copy_expert, считающий хеш без сохранения данных"""
+
+    def __init__(self, digest):
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        return len(data)
+
+
+def restore_source(directory, replica_dsn):
+    """Восстанавливает снимок в приемник по частям параллельно; возвращает (восстановлено, пропущено) частей"""
+    started = time.monotonic()
+    manifest = read_manifest(directory)
+    for item in manifest["items"]:
+        ensure_table(replica_dsn, item)
+    tasks = [(item, chunk) for item in manifest["items"] for chunk in item["chunks"]]
+    with ThreadPoolExecutor(max_workers=RESTORE_WORKERS) as pool:
+        results = list(pool.map(lambda task: restore_chunk(directory, manifest, replica_dsn, *task), tasks))
+    restored = sum(results)
+    logging.info(f"[{manifest['source']}] Восстановлено частей: {restored}, совпадают с приемником: "
+                 f"{len(results) - restored} (за {time.monotonic() - started:.1f}с)")
+    return restored, len(results) - restored
+
+
+def main():
+    from pg_logical_replication import load_sources
+
+    parser = argparse.ArgumentParser(description="Снимки PostgreSQL на диске: запись и восстановление")
+    parser.add_argument("command", choices=["dump", "restore"])
+    parser.add_argument("databases", nargs="*", help="имена исходных БД (по умолчанию - все источники)")
+    parser.add_argument("--dir", default=SNAPSHOT_DIR, help="каталог снимков (снимок источника - в <dir>/<БД>)")
+    args = parser.parse_args()
+
+    sources, replica_dsn = load_sources()
+    sources = [source for source in sources if not args.databases or source["db"] in args.databases]
+    if args.command == "dump":
+        # Каждый источник пишется в свой каталог, поэтому снимки источников выполняются одновременно
+        with ThreadPoolExecutor(max_workers=max(1, len(sources))) as pool:
+            for future in [pool.submit(dump_source, source, os.path.join(args.dir, source["db"]))
+                           for source in sources]:
+                future.result()
+    else:
+        # Источники восстанавливаются по очереди: их таблицы попадают в одну БД-реплику
+        for source in sources:
+            restore_source(os.path.join(args.dir, source["db"]), replica_dsn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""
+Инкрементальная репликация PostgreSQL через логическое декодирование:
+- На исходных БД создаются публикация и логический слот репликации (pgoutput)
+- Изменения строк (INSERT/UPDATE/DELETE/TRUNCATE) применяются в реплике транзакциями
+- Подтвержденный LSN отправляется серверу и сохраняется локально, после перезапуска репликация продолжается с него
+- При первом запуске таблицы копируются в реплику целиком через COPY (pg_snapshot.py) из снимка, экспортированного
+  при создании слота: изменения после снимка доигрываются из слота ровно один раз
+"""
+
+import logging
+import os
+import struct
+import threading
+import time
+
+import psycopg2
+import psycopg2.extras
+from psycopg2 import sql
+
+from adaptive_scheduler import Backoff
+from pg_snapshot import ensure_replica_table, primary_key, snapshot_database
+from replication_metrics import metrics, start_metrics_server
+from sync_state import open_store
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+PUBLICATION_NAME = os.environ.get("PUBLICATION_NAME", "replication_pub")
+STATE_PATH = os.environ.get("REPLICATION_STATE_PATH", "pg_replication_state.db")
+RETRY_INTERVAL_SECONDS = float(os.environ.get("REPLICATION_RETRY_SECONDS", "5"))
+# Начало отсчета времени PostgreSQL (2000-01-01 UTC) в секундах Unix
+PG_EPOCH = 946684800
+
+
+def build_dsn(host, port, dbname, user, password):
+    return f"postgresql://{user}:{password}@{host}:{port}/{dbname}"
+
+
+def load_sources():
+    """Параметры источников и реплики - те же переменные окружения, что и в replicate.sh"""
+    sources = []
+    for prefix, host, db in (("SRC1", "postgres_node1", "sourcedb1"), ("SRC2", "postgres_node2", "sourcedb2")):
+        sources.append({
+            "dsn": build_dsn(
+                os.environ.get(f"{prefix}_HOST", host),
+                os.environ.get(f"{prefix}_PORT", "5432"),
+                os.environ.get(f"{prefix}_DB", db),
+                os.environ.get(f"{prefix}_USER", "admin"),
+                os.environ.get(f"{prefix}_PASSWORD", "adminpass"),
+            ),
+            "db": os.environ.get(f"{prefix}_DB", db),
+        })
+    replica_dsn = build_dsn(
+        os.environ.get("DEST_HOST", "postgres_replica"),
+        os.environ.get("DEST_PORT", "5432"),
+        os.environ.get("DEST_DB", "replicadb"),
+        os.environ.get("DEST_USER", "replica"),
+        os.environ.get("DEST_PASSWORD", "replicapass"),
+    )
+    return sources, replica_dsn
+
+
+def format_lsn(lsn):
+    return f"{lsn >> 32:X}/{lsn & 0xFFFFFFFF:X}"
+
+
+def parse_lsn(text):
+    high, low = text.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+class Relation:
+    """Описание таблицы из сообщения Relation протокола pgoutput"""
+
+    def __init__(self, schema, name, columns, key_columns, primary_key=()):
+        self.schema = schema
+        self.name = name
+        self.columns = columns
+        # Столбцы replica identity (по ним приходят старые значения UPDATE/DELETE)
+        self.key_columns = key_columns
+        # Первичный ключ таблицы - цель ON CONFLICT; у таблицы без ключа вставки не идемпотентны
+        self.primary_key = list(primary_key)
+
+    @property
+    def identifier(self):
+        return sql.Identifier(self.schema, self.name)
+
+
+class PgOutputReader:
+    """Разбор бинарных сообщений протокола pgoutput (версия 1)"""
+
+    def __init__(self, payload):
+        self.data = payload
+        self.pos = 0
+
+    def byte(self):
+        value = self.data[self.pos:self.pos + 1].decode()
+        self.pos += 1
+        return value
+
+    def int8(self):
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def int16(self):
+        (value,) = struct.unpack_from("!h", self.data, self.pos)
+        self.pos += 2
+        return value
+
+    def int32(self):
+        (value,) = struct.unpack_from("!i", self.data, self.pos)
+        self.pos += 4
+        return value
+
+    def int64(self):
+        (value,) = struct.unpack_from("!q", self.data, self.pos)
+        self.pos += 8
+        return value
+
+    def string(self):
+        end = self.data.index(b"\0", self.pos)
+        value = self.data[self.pos:end].decode()
+        self.pos = end + 1
+        return value
+
+    def tuple_data(self):
+        """Значения столбцов в текстовом виде; UNCHANGED - неизмененное TOAST-значение"""
+        values = []
+        for _ in range(self.int16()):
+            kind = self.byte()
+            if kind == "n":
+                values.append(None)
+            elif kind == "u":
+                values.append(UNCHANGED)
+            else:
+                length = self.int32()
+                values.append(self.data[self.pos:self.pos + length].decode())
+                self.pos += length
+        return values
+
+
+UNCHANGED = object()
+
+
+class LogicalReplicator:
+    """Применяет поток изменений одной исходной БД к реплике"""
+
+    def __init__(self, source, replica_dsn, state):
+        self.source_dsn = source["dsn"]
+        self.db = source["db"]
+        self.replica_dsn = replica_dsn
+        self.state = state
+        self.slot_name = f"replica_slot_{self.db}"
+        self.relations = {}
+        self.pending = []
+        self.pending_bytes = 0
+        self.replica_conn = None
+
+    @property
+    def lsn_key(self):
+        return f"confirmed_lsn:{self.db}"
+
+    @property
+    def initial_copy_key(self):
+        return f"initial_copy:{self.db}"
+
+    def ensure_publication(self):
+        """Создает публикацию, если ее нет. Возвращает True, если слот репликации уже существует"""
+        conn = psycopg2.connect(self.source_dsn)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1 FROM pg_publication WHERE pubname = %s", (PUBLICATION_NAME,))
+                if cur.fetchone() is None:
+                    cur.execute(sql.SQL("CREATE PUBLICATION {} FOR ALL TABLES").format(sql.Identifier(PUBLICATION_NAME)))
+                    logging.info(f"[{self.db}] Создана публикация {PUBLICATION_NAME}")
+                cur.execute("SELECT 1 FROM pg_replication_slots WHERE slot_name = %s", (self.slot_name,))
+                return cur.fetchone() is not None
+        finally:
+            conn.close()
+
+    def create_slot(self):
+        """
+        Создает слот репликации и экспортирует снимок на момент его создания. Возвращает (соединение, имя снимка):
+        снимок действует, пока соединение открыто и не выполняет других команд
+        """
+        conn = psycopg2.connect(self.source_dsn, connection_factory=psycopg2.extras.LogicalReplicationConnection)
+        try:
+            cur = conn.cursor()
+            cur.execute(sql.SQL("CREATE_REPLICATION_SLOT {} LOGICAL pgoutput EXPORT_SNAPSHOT").format(
+                sql.Identifier(self.slot_name)))
+            snapshot = cur.fetchone()[2]
+        except Exception:
+            conn.close()
+            raise
+        logging.info(f"[{self.db}] Создан слот репликации {self.slot_name} (снимок {snapshot})")
+        return conn, snapshot
+
+    def drop_slot(self):
+        conn = psycopg2.connect(self.source_dsn)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_drop_replication_slot(%s)", (self.slot_name,))
+        finally:
+            conn.close()
+        logging.info(f"[{self.db}] Удален слот репликации {self.slot_name}")
+
+    def published_tables(self, source_cur):
+        source_cur.execute(
+            "SELECT schemaname, tablename FROM pg_publication_tables WHERE pubname = %s ORDER BY 1, 2",
+            (PUBLICATION_NAME,))
+        return source_cur.fetchall()
+
+    def initial_copy(self, slot_exists):
+        """
+        Начальное копирование таблиц. Новый слот экспортирует снимок, и таблицы копируются из него: изменения
+        после снимка доиграются из слота ровно один раз (для таблиц без первичного ключа повтор вставки дублирует строку).
+        Скопированные таблицы отмечаются в состоянии: если процесс упадет, после перезапуска (слот уже существует,
+        снимка больше нет) оставшиеся таблицы с первичным ключом копируются из текущего состояния - изменения
+        доиграются из слота идемпотентно. Если среди оставшихся есть таблица без ключа, слот пересоздается
+        и копирование начинается заново
+        """
+        progress = self.state.get(self.initial_copy_key)
+        source_conn = psycopg2.connect(self.source_dsn)
+        try:
+            with source_conn.cursor() as source_cur:
+                tables = self.published_tables(source_cur)
+                remaining = [(schema, table) for schema, table in tables if f"{schema}.{table}" not in (progress or [])]
+                keyless = [f"{schema}.{table}" for schema, table in remaining if not primary_key(source_cur, schema, table)]
+        finally:
+            source_conn.close()
+        if slot_exists and progress is not None and keyless:
+            logging.warning(f"[{self.db}] Копирование прервано, у таблиц {', '.join(keyless)} нет первичного ключа: "
+                            f"слот пересоздается, копирование начинается заново")
+            self.drop_slot()
+            slot_exists = False
+        slot_conn = snapshot = None
+        if not slot_exists:
+            self.state.delete(self.lsn_key)
+            # Пустой список - копирование начато, но ни одна таблица еще не скопирована
+            progress, remaining = [], tables
+            self.state.set(self.initial_copy_key, progress)
+            slot_conn, snapshot = self.create_slot()
+        elif progress is None:
+            return
+        elif progress:
+            logging.info(f"[{self.db}] Продолжение начального копирования: осталось таблиц {len(remaining)}")
+        lock = threading.Lock()
+
+        def mark_copied(schema, table):
+            with lock:
+                progress.append(f"{schema}.{table}")
+                self.state.set(self.initial_copy_key, progress)
+
+        try:
+            copied = snapshot_database(self.source_dsn, self.replica_dsn, remaining, on_copied=mark_copied,
+                                       snapshot=snapshot)
+        finally:
+            # Снимок нужен только на время копирования
+            if slot_conn is not None:
+                slot_conn.close()
+        self.state.delete(self.initial_copy_key)
+        logging.info(f"[{self.db}] Начальное копирование завершено: {sum(copied.values())} строк")
+
+    def handle_relation(self, reader):
+        relid = reader.int32()
+        schema = reader.string()
+        name = reader.string()
+        reader.int8()  # replica identity
+        columns = []
+        key_columns = []
+        for _ in range(reader.int16()):
+            flags = reader.int8()
+            column = reader.string()
+            reader.int32()  # oid типа
+            reader.int32()  # typmod
+            columns.append(column)
+            if flags & 1:
+                key_columns.append(column)
+        # Новая таблица в источнике - создаем ее и в реплике (в текущей транзакции применения)
+        source_conn = psycopg2.connect(self.source_dsn)
+        try:
+            with source_conn.cursor() as source_cur, self.replica_conn.cursor() as replica_cur:
+                ensure_replica_table(source_cur, replica_cur, schema, name)
+                key = primary_key(source_cur, schema, name)
+        finally:
+            source_conn.close()
+        if not key:
+            logging.warning(f"[{self.db}] У таблицы {schema}.{name} нет первичного ключа: вставки применяются без ON CONFLICT")
+        self.relations[relid] = Relation(schema, name, columns, key_columns, key)
+
+    def upsert_statement(self, relation, values):
+        present = [(col, val) for col, val in zip(relation.columns, values) if val is not UNCHANGED]
+        columns = [col for col, _ in present]
+        insert = sql.SQL("INSERT INTO {} ({}) VALUES ({})").format(
+            relation.identifier,
+            sql.SQL(", ").join(map(sql.Identifier, columns)),
+            sql.SQL(", ").join(sql.Placeholder() * len(columns)),
+        )
+        if not relation.primary_key:
+            return insert, [val for _, val in present]
+        updates = [col for col in columns if col not in relation.primary_key]
+        query = sql.SQL("{} ON CONFLICT ({}) DO {}").format(
+            insert,
+            sql.SQL(", ").join(map(sql.Identifier, relation.primary_key)),
+            sql.SQL("UPDATE SET {}").format(sql.SQL(", ").join(
+                sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(col)) for col in updates
+            )) if updates else sql.SQL("NOTHING"),
+        )
+        return query, [val for _, val in present]
+
+    def delete_statement(self, relation, values):
+        old = {col: val for col, val in zip(relation.columns, values) if val is not UNCHANGED}
+        if relation.primary_key and all(col in relation.key_columns for col in relation.primary_key):
+            # Строка однозначно находится по первичному ключу (при REPLICA IDENTITY FULL остальные столбцы не нужны)
+            keys = [(col, old[col]) for col in relation.primary_key]
+            query = sql.SQL("DELETE FROM {} WHERE {}").format(
+                relation.identifier,
+                sql.SQL(" AND ").join(sql.SQL("{} = %s").format(sql.Identifier(col)) for col, _ in keys))
+            return query, [val for _, val in keys]
+        # Иначе старая строка сравнивается по столбцам replica identity, включая NULL
+        keys = [(col, old[col]) for col in relation.key_columns if col in old]
+        condition = sql.SQL(" AND ").join(
+            sql.SQL("{} IS NOT DISTINCT FROM %s").format(sql.Identifier(col)) for col, _ in keys)
+        if relation.primary_key:
+            query = sql.SQL("DELETE FROM {} WHERE {}").format(relation.identifier, condition)
+        else:
+            # Без первичного ключа одинаковые строки неразличимы: удаляется ровно одна, как в источнике
+            query = sql.SQL("DELETE FROM {0} WHERE ctid = (SELECT ctid FROM {0} WHERE {1} LIMIT 1)").format(
+                relation.identifier, condition)
+        return query, [val for _, val in keys]
+
+    def handle_message(self, msg):
+        """Обработчик сообщений потока: копит изменения транзакции и применяет их при COMMIT"""
+        reader = PgOutputReader(msg.payload)
+        kind = reader.byte()
+        self.pending_bytes += len(msg.payload)
+        if kind == "B":
+            self.pending = []
+            self.pending_bytes = len(msg.payload)
+        elif kind == "R":
+            self.handle_relation(reader)
+        elif kind == "I":
+            relation = self.relations[reader.int32()]
+            reader.byte()  # 'N'
+            self.pending.append(self.upsert_statement(relation, reader.tuple_data()))
+        elif kind == "U":
+            relation = self.relations[reader.int32()]
+            marker = reader.byte()
+            if marker in ("K", "O"):
+                # Изменился ключ - удаляем строку со старым ключом
+                self.pending.append(self.delete_statement(relation, reader.tuple_data()))
+                reader.byte()  # 'N'
+            self.pending.append(self.upsert_statement(relation, reader.tuple_data()))
+        elif kind == "D":
+            relation = self.relations[reader.int32()]
+            reader.byte()  # 'K' или 'O'
+            self.pending.append(self.delete_statement(relation, reader.tuple_data()))
+        elif kind == "T":
+            count = reader.int32()
+            reader.int8()  # опции
+            tables = [self.relations[reader.int32()].identifier for _ in range(count)]
+            self.pending.append((sql.SQL("TRUNCATE {}").format(sql.SQL(", ").join(tables)), []))
+        elif kind == "C":
+            reader.int8()  # флаги
+            reader.int64()  # LSN коммита
+            end_lsn = reader.int64()
+            commit_time = PG_EPOCH + reader.int64() / 1e6
+            self.commit(msg, end_lsn, commit_time)
+
+    def commit(self, msg, end_lsn, commit_time):
+        """Применяет накопленные изменения одной транзакцией и подтверждает LSN"""
+        with metrics.timer("replication_cycle_duration_seconds", job="postgres", db=self.db):
+            with self.replica_conn.cursor() as cur:
+                for query, params in self.pending:
+                    cur.execute(query, params)
+            self.replica_conn.commit()
+        metrics.inc("replication_documents_read_total", len(self.pending), job="postgres", node=self.db)
+        metrics.inc("replication_documents_written_total", len(self.pending), job="postgres", node="replica")
+        metrics.inc("replication_bytes_transferred_total", self.pending_bytes,
+                    job="postgres", node=self.db, direction="read")
+        # Отставание - время от коммита в источнике до применения в реплике
+        metrics.set("replication_lag_seconds", max(0.0, time.time() - commit_time), job="postgres", db=self.db)
+        if self.pending:
+            logging.info(f"[{self.db}] Применено изменений: {len(self.pending)} (LSN {format_lsn(end_lsn)})")
+        self.pending = []
+        msg.cursor.send_feedback(flush_lsn=end_lsn)
+        self.state.set(self.lsn_key, format_lsn(end_lsn))
+
+    def run(self):
+        """Подключается к слоту и применяет изменения; при ошибках переподключается с растущей задержкой"""
+        backoff = Backoff(base=RETRY_INTERVAL_SECONDS)
+        while True:
+            conn = None
+            try:
+                self.initial_copy(self.ensure_publication())
+                self.replica_conn = psycopg2.connect(self.replica_dsn)
+                conn = psycopg2.connect(self.source_dsn, connection_factory=psycopg2.extras.LogicalReplicationConnection)
+                cur = conn.cursor()
+                saved_lsn = self.state.get(self.lsn_key)
+                cur.start_replication(
+                    slot_name=self.slot_name,
+                    decode=False,
+                    start_lsn=parse_lsn(saved_lsn) if saved_lsn else 0,
+                    options={"proto_version": "1", "publication_names": PUBLICATION_NAME},
+                )
+                logging.info(f"[{self.db}] Репликация из слота {self.slot_name} с LSN {saved_lsn or 'слота'}")
+                backoff.reset()
+                cur.consume_stream(self.handle_message)
+            except psycopg2.Error as e:
+                logging.error(f"[{self.db}] Ошибка логической репликации: {e}")
+                metrics.inc("replication_errors_total", job="postgres", db=self.db)
+            except Exception:
+                # Ошибка разбора потока повторится на том же сообщении - поток завершается,
+                # main() завершает процесс с ошибкой, и контейнер перезапускается
+                logging.exception(f"[{self.db}] Необрабатываемая ошибка логической репликации")
+                metrics.inc("replication_errors_total", job="postgres", db=self.db)
+                return
+            finally:
+                if conn is not None:
+                    conn.close()
+                if self.replica_conn is not None:
+                    self.replica_conn.close()
+                    self.replica_conn = None
+            delay = backoff.next_delay()
+            logging.info(f"[{self.db}] Повторное подключение через {delay:.1f}с")
+            time.sleep(delay)
+
+
+def main():
+    sources, replica_dsn = load_sources()
+    state = open_store(STATE_PATH)
+    start_metrics_server()
+    threads = []
+    for source in sources:
+        replicator = LogicalReplicator(source, replica_dsn, state)
+        thread = threading.Thread(target=replicator.run, name=f"replication-{source['db']}", daemon=True)
+        thread.start()
+        threads.append(thread)
+    # Потоки работают бесконечно: завершившийся поток означает фатальную ошибку
+    while all(thread.is_alive() for thread in threads):
+        threads[0].join(timeout=1)
+    stopped = [thread.name for thread in threads if not thread.is_alive()]
+    logging.error(f"Репликация остановлена ({', '.join(stopped)}), процесс завершается")
+    return 1
+
+
+if __name__ == "__main__":
+    exit(main())
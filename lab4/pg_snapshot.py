@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+Снимок (полная пересинхронизация) PostgreSQL через COPY:
+- Каждая таблица передается потоком COPY ... TO STDOUT -> COPY ... FROM STDIN напрямую между соединениями,
+  без промежуточного файла (бинарный формат COPY)
+- Таблицы копируются параллельно, по одному потоку на таблицу
+- Существующая таблица реплики очищается (TRUNCATE) и загружается заново в одной транзакции: ее внешние ключи,
+  индексы и права сохраняются. Новая таблица загружается без индексов, первичный ключ и индексы строятся после загрузки
+- Копируются только изменившиеся таблицы: счетчики pg_stat_user_tables сохраняются между циклами
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2 import sql
+
+from adaptive_scheduler import AdaptiveScheduler
+from replication_metrics import metrics, start_metrics_server
+from sync_state import open_store
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+
+SNAPSHOT_WORKERS = int(os.environ.get("SNAPSHOT_WORKERS", "4"))
+STATE_PATH = os.environ.get("REPLICATION_STATE_PATH", "pg_replication_state.db")
+# 0 - копировать все таблицы в каждом цикле, без определения изменений
+CHANGE_DETECTION = os.environ.get("SNAPSHOT_CHANGE_DETECTION", "1") != "0"
+
+
+def source_tables(source_cur, schema="public"):
+    """Пользовательские таблицы схемы: [(схема, таблица)]"""
+    source_cur.execute("""
+        SELECT table_schema, table_name FROM information_schema.tables
+        WHERE table_schema = %s AND table_type = 'BASE TABLE'
+        ORDER BY table_name
+    """, (schema,))
+    return source_cur.fetchall()
+
+
+def table_columns(source_cur, schema, table):
+    """Столбцы таблицы: [(имя, тип, NOT NULL)]"""
+    source_cur.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum
+    """, (schema, table))
+    return source_cur.fetchall()
+
+
+def primary_key(source_cur, schema, table):
+    """Столбцы первичного ключа таблицы"""
+    source_cur.execute("""
+        SELECT a.attname
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND i.indisprimary
+    """, (f'"{schema}"."{table}"',))
+    return [row[0] for row in source_cur.fetchall()]
+
+
+def secondary_indexes(source_cur, schema, table):
+    """Определения индексов таблицы, кроме первичного ключа"""
+    source_cur.execute("""
+        SELECT pg_get_indexdef(i.indexrelid)
+        FROM pg_index i
+        WHERE i.indrelid = %s::regclass AND NOT i.indisprimary
+    """, (f'"{schema}"."{table}"',))
+    return [row[0] for row in source_cur.fetchall()]
+
+
+def create_table_sql(name, columns, key_columns=None):
+    """CREATE TABLE по описанию столбцов (первичный ключ - по желанию)"""
+    parts = [
+        sql.SQL("{} {}{}").format(sql.Identifier(column), sql.SQL(col_type), sql.SQL(" NOT NULL" if not_null else ""))
+        for column, col_type, not_null in columns
+    ]
+    if key_columns:
+        parts.append(sql.SQL("PRIMARY KEY ({})").format(sql.SQL(", ").join(map(sql.Identifier, key_columns))))
+    return sql.SQL("CREATE TABLE IF NOT EXISTS {} ({})").format(name, sql.SQL(", ").join(parts))
+
+
+def ensure_replica_table(source_cur, replica_cur, schema, table):
+    """Создает таблицу в реплике по описанию столбцов и первичного ключа источника"""
+    replica_cur.execute(create_table_sql(
+        sql.Identifier(schema, table),
+        table_columns(source_cur, schema, table),
+        primary_key(source_cur, schema, table)))
+
+
+def table_markers(source_cur, schema="public"):
+    """
+    Отметки изменений таблиц: {таблица: [n_tup_ins, n_tup_upd, n_tup_del, filenode]}.
+    TRUNCATE не меняет счетчики строк, но создает новый файл таблицы (filenode)
+    """
+    source_cur.execute("""
+        SELECT relname, n_tup_ins, n_tup_upd, n_tup_del, pg_relation_filenode(relid)
+        FROM pg_stat_user_tables
+        WHERE schemaname = %s
+    """, (schema,))
+    return {row[0]: list(row[1:]) for row in source_cur.fetchall()}
+
+
+def missing_tables(replica_cur, tables):
+    """Таблицы, которых еще нет в реплике"""
+    missing = []
+    for schema, table in tables:
+        replica_cur.execute("SELECT to_regclass(%s)", (f'"{schema}"."{table}"',))
+        if replica_cur.fetchone()[0] is None:
+            missing.append((schema, table))
+    return missing
+
+
+class _CountingWriter:
+    """Обертка над файлом, считающая записанные байты"""
+
+    def __init__(self, file):
+        self.file = file
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        return self.file.write(data)
+
+
+def _stream_copy(source_conn, replica_cur, source_query, target):
+    """
+    Передает данные COPY из источника в реплику через канал (pipe), без промежуточного файла.
+    Возвращает число переданных байт
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+    counter = None
+
+    def produce():
+        nonlocal counter
+        try:
+            with os.fdopen(write_fd, "wb") as writer, source_conn.cursor() as source_cur:
+                counter = _CountingWriter(writer)
+                source_cur.copy_expert(
+                    sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT binary)").format(source_query).as_string(source_cur),
+                    counter)
+        except Exception as e:
+            errors.append(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    with os.fdopen(read_fd, "rb") as reader:
+        replica_cur.copy_expert(
+            sql.SQL("COPY {} FROM STDIN WITH (FORMAT binary)").format(target).as_string(replica_cur), reader)
+    producer.join()
+    if errors:
+        raise errors[0]
+    return counter.bytes
+
+
+def copy_table(source_dsn, replica_dsn, schema, table, snapshot=None):
+    """
+    Копирует одну таблицу в одной транзакции: TRUNCATE и COPY в существующую таблицу реплики (зависимые объекты
+    сохраняются) или создание таблицы, COPY и построение индексов для новой.
+    snapshot - имя экспортированного снимка источника (pg_export_snapshot, слот репликации), из которого читаются данные
+    """
+    started = time.monotonic()
+    source_conn = psycopg2.connect(source_dsn)
+    replica_conn = psycopg2.connect(replica_dsn)
+    try:
+        # Снимок источника согласован в рамках одной транзакции REPEATABLE READ
+        source_conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with source_conn.cursor() as source_cur:
+            if snapshot is not None:
+                # Первая команда транзакции: все таблицы читаются из одного снимка
+                source_cur.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+            columns = table_columns(source_cur, schema, table)
+            key_columns = primary_key(source_cur, schema, table)
+            indexes = secondary_indexes(source_cur, schema, table)
+
+        target = sql.Identifier(schema, table)
+        with replica_conn.cursor() as replica_cur:
+            created = bool(missing_tables(replica_cur, [(schema, table)]))
+            if created:
+                replica_cur.execute(create_table_sql(target, columns))
+            else:
+                # Данные заменяются в одной транзакции: читатели видят прежние строки до COMMIT
+                replica_cur.execute(sql.SQL("TRUNCATE {}").format(target))
+            column_list = sql.SQL(", ").join(sql.Identifier(column) for column, _, _ in columns)
+            transferred = _stream_copy(
+                source_conn, replica_cur,
+                sql.SQL("SELECT {} FROM {}").format(column_list, target),
+                sql.SQL("{} ({})").format(target, column_list))
+
+            if created:
+                if key_columns:
+                    replica_cur.execute(sql.SQL("ALTER TABLE {} ADD PRIMARY KEY ({})").format(
+                        target, sql.SQL(", ").join(map(sql.Identifier, key_columns))))
+                for index_definition in indexes:
+                    replica_cur.execute(index_definition)
+            replica_cur.execute(sql.SQL("SELECT count(*) FROM {}").format(target))
+            rows = replica_cur.fetchone()[0]
+        replica_conn.commit()
+        source_conn.commit()
+        metrics.observe("replication_cycle_duration_seconds", time.monotonic() - started,
+                        job="postgres_snapshot", table=f"{schema}.{table}")
+        metrics.inc("replication_documents_written_total", rows, job="postgres_snapshot", table=f"{schema}.{table}")
+        metrics.inc("replication_bytes_transferred_total", transferred,
+                    job="postgres_snapshot", table=f"{schema}.{table}", direction="copy")
+        logging.info(f"Скопирована таблица {schema}.{table}: {rows} строк, {transferred} байт")
+        return rows
+    except Exception:
+        replica_conn.rollback()
+        metrics.inc("replication_errors_total", job="postgres_snapshot", table=f"{schema}.{table}")
+        raise
+    finally:
+        source_conn.close()
+        replica_conn.close()
+
+
+def snapshot_database(source_dsn, replica_dsn, tables=None, on_copied=None, snapshot=None):
+    """
+    Копирует таблицы источника в реплику параллельно, по потоку на таблицу.
+    tables - список (схема, таблица); по умолчанию все таблицы схемы public.
+    on_copied(schema, table) вызывается сразу после замены каждой таблицы (для отметок прогресса).
+    snapshot - имя экспортированного снимка источника, общего для всех таблиц.
+    Возвращает число скопированных строк по таблицам
+    """
+    if tables is None:
+        conn = psycopg2.connect(source_dsn)
+        try:
+            with conn.cursor() as cur:
+                tables = source_tables(cur)
+        finally:
+            conn.close()
+    if not tables:
+        return {}
+    def copy(schema, table):
+        rows = copy_table(source_dsn, replica_dsn, schema, table, snapshot)
+        if on_copied is not None:
+            on_copied(schema, table)
+        return rows
+
+    with ThreadPoolExecutor(max_workers=min(SNAPSHOT_WORKERS, len(tables))) as pool:
+        futures = {(schema, table): pool.submit(copy, schema, table) for schema, table in tables}
+        return {key: future.result() for key, future in futures.items()}
+
+
+def snapshot_changed(source, replica_dsn, state, schema="public"):
+    """
+    Копирует только таблицы, изменившиеся с прошлого цикла (или отсутствующие в реплике).
+    Отметки читаются до копирования, поэтому изменения во время копирования попадут в следующий цикл.
+    Отметка таблицы сохраняется сразу после ее замены: после падения процесса копируются только оставшиеся таблицы
+    """
+    key = f"table_stats:{source['db']}"
+    source_conn = psycopg2.connect(source["dsn"])
+    replica_conn = psycopg2.connect(replica_dsn)
+    try:
+        with source_conn.cursor() as source_cur, replica_conn.cursor() as replica_cur:
+            tables = source_tables(source_cur, schema)
+            markers = table_markers(source_cur, schema)
+            missing = set(missing_tables(replica_cur, tables))
+    finally:
+        source_conn.close()
+        replica_conn.close()
+
+    saved = state.get(key, {})
+    changed = [
+        (table_schema, table) for table_schema, table in tables
+        if (table_schema, table) in missing or saved.get(table) != markers.get(table)
+    ]
+    skipped = len(tables) - len(changed)
+    lock = threading.Lock()
+
+    def mark_copied(table_schema, table):
+        with lock:
+            saved[table] = markers.get(table)
+            state.set(key, saved)
+
+    if changed:
+        snapshot_database(source["dsn"], replica_dsn, changed, on_copied=mark_copied)
+    # Удаленные из источника таблицы больше не отслеживаются
+    state.set(key, markers)
+    logging.info(f"[{source['db']}] Скопировано таблиц: {len(changed)}, без изменений: {skipped}")
+    return changed
+
+
+def snapshot_source(source, replica_dsn, state):
+    """Один цикл снимка источника; возвращает число скопированных таблиц"""
+    if CHANGE_DETECTION:
+        return len(snapshot_changed(source, replica_dsn, state))
+    return len(snapshot_database(source["dsn"], replica_dsn))
+
+
+def run_scheduled(sources, replica_dsn, state):
+    """Адаптивное расписание: каждый источник копируется в реплику в своем ритме, независимо от других"""
+    scheduler = AdaptiveScheduler(
+        "postgres_snapshot",
+        initial_interval=float(os.environ.get("REPLICATION_INTERVAL_SECONDS", "30")),
+        log=logging.info,
+    )
+    for source in sources:
+        def task(source=source):
+            copied = snapshot_source(source, replica_dsn, state)
+            metrics.dump_json()
+            return copied
+        scheduler.add(source["db"], task)
+    scheduler.run_forever()
+
+
+def main():
+    from pg_logical_replication import load_sources
+
+    parser = argparse.ArgumentParser(description="Снимок PostgreSQL через COPY")
+    parser.add_argument("databases", nargs="*", help="имена исходных БД (по умолчанию - все источники)")
+    parser.add_argument("--daemon", action="store_true", help="повторять снимки по адаптивному расписанию")
+    args = parser.parse_args()
+
+    sources, replica_dsn = load_sources()
+    sources = [source for source in sources if not args.databases or source["db"] in args.databases]
+    state = open_store(STATE_PATH)
+    if args.daemon:
+        start_metrics_server()
+        run_scheduled(sources, replica_dsn, state)
+        return
+    for source in sources:
+        logging.info(f"=== Снимок {source['db']} ===")
+        snapshot_source(source, replica_dsn, state)
+    # Разовый запуск: метрики снимка сохраняются в METRICS_DUMP_PATH
+    metrics.dump_json()
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,13 @@ DST_DB="${DEST_DB:-replicadb}"
 DST_USER="${DEST_USER:-replica}"
 DST_PASSWORD="${DEST_PASSWORD:-replicapass}"
 
+# dump - pg_dump + psql (по умолчанию), copy - потоковая передача таблиц через COPY (pg_snapshot.py),
+# archive - сжатый снимок на диске с контрольными суммами (pg_archive.py)
+TRANSFER_MODE="${TRANSFER_MODE:-dump}"
+SNAPSHOT_SCRIPT="$(dirname "$0")/pg_snapshot.py"
+ARCHIVE_SCRIPT="$(dirname "$0")/pg_archive.py"
+DUMP_DIR="${DUMP_DIR:-/tmp}"
+
 for VAR in SRC1_DB SRC1_USER SRC1_PASSWORD SRC2_DB SRC2_USER SRC2_PASSWORD DST_DB DST_USER DST_PASSWORD DST_HOST; do
     if [ -z "${!VAR}" ]; then
         log "ERROR: переменная $VAR не задана"
@@ -32,23 +39,32 @@ for VAR in SRC1_DB SRC1_USER SRC1_PASSWORD SRC2_DB SRC2_USER SRC2_PASSWORD DST_D
     fi
 done
 
-replicate() {
+# У каждого источника свой файл дампа: дампы источников выполняются одновременно
+dump_file() {
+    echo "$DUMP_DIR/dump_$1.sql"
+}
+
+dump_source() {
     local SRC_H="$1"
     local SRC_P="$2"
     local SRC_D="$3"
     local SRC_U="$4"
     local SRC_PW="$5"
 
-    export PGPASSWORD="$SRC_PW"
-    if ! psql -h "$SRC_H" -p "$SRC_P" -U "$SRC_U" -d "$SRC_D" -c "SELECT 1" >/dev/null 2>&1; then
+    if ! PGPASSWORD="$SRC_PW" psql -h "$SRC_H" -p "$SRC_P" -U "$SRC_U" -d "$SRC_D" -c "SELECT 1" >/dev/null 2>&1; then
         log "ERROR: нет доступа к исходной БД $SRC_H/$SRC_D"
         return 1
     fi
 
     log "Dumping $SRC_H/$SRC_D..."
-    pg_dump -h "$SRC_H" -p "$SRC_P" -U "$SRC_U" -d "$SRC_D" \
+    PGPASSWORD="$SRC_PW" pg_dump -h "$SRC_H" -p "$SRC_P" -U "$SRC_U" -d "$SRC_D" \
         --clean --no-owner --no-privileges --no-acl --no-security-labels \
-        > /tmp/dump.sql
+        > "$(dump_file "$SRC_D").tmp"
+    mv "$(dump_file "$SRC_D").tmp" "$(dump_file "$SRC_D")"
+}
+
+restore_source() {
+    local SRC_D="$1"
 
     export PGPASSWORD="$DST_PASSWORD"
     if ! psql -h "$DST_HOST" -p "$DST_PORT" -U "$DST_USER" -d "$DST_DB" -c "SELECT 1" >/dev/null 2>&1; then
@@ -56,13 +72,35 @@ replicate() {
         return 1
     fi
 
-    log "Restoring dump into replica..."
-    psql -h "$DST_HOST" -p "$DST_PORT" -U "$DST_USER" -d "$DST_DB" < /tmp/dump.sql
+    log "Restoring dump of $SRC_D into replica..."
+    psql -h "$DST_HOST" -p "$DST_PORT" -U "$DST_USER" -d "$DST_DB" < "$(dump_file "$SRC_D")"
 }
 
+replicate() {
+    local STATUS=0
+    dump_source "$SRC1_HOST" "$SRC1_PORT" "$SRC1_DB" "$SRC1_USER" "$SRC1_PASSWORD" &
+    local DUMP1=$!
+    dump_source "$SRC2_HOST" "$SRC2_PORT" "$SRC2_DB" "$SRC2_USER" "$SRC2_PASSWORD" &
+    local DUMP2=$!
+    # Восстановление - по очереди: оба дампа пишут в одну БД-реплику
+    if wait "$DUMP1"; then restore_source "$SRC1_DB" || STATUS=1; else STATUS=1; fi
+    if wait "$DUMP2"; then restore_source "$SRC2_DB" || STATUS=1; else STATUS=1; fi
+    return $STATUS
+}
+
+if [ "$TRANSFER_MODE" = "copy" ]; then
+    # Расписание ведет pg_snapshot.py: у каждого источника свой адаптивный интервал и backoff
+    log "Starting adaptive COPY snapshots..."
+    exec python3 "$SNAPSHOT_SCRIPT" --daemon
+fi
+
 while true; do
-    replicate "$SRC1_HOST" "$SRC1_PORT" "$SRC1_DB" "$SRC1_USER" "$SRC1_PASSWORD"
-    replicate "$SRC2_HOST" "$SRC2_PORT" "$SRC2_DB" "$SRC2_USER" "$SRC2_PASSWORD"
+    if [ "$TRANSFER_MODE" = "archive" ]; then
+        # Снимки источников пишутся параллельно, неизменившиеся части при восстановлении пропускаются
+        python3 "$ARCHIVE_SCRIPT" dump && python3 "$ARCHIVE_SCRIPT" restore || log "ERROR: цикл снимков не удался"
+    else
+        replicate || log "ERROR: цикл дампов не удался"
+    fi
 
     log "Replication cycle finished. Sleeping ${REPLICATION_INTERVAL_SECONDS:-30}s..."
     sleep "${REPLICATION_INTERVAL_SECONDS:-30}"
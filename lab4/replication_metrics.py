@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Метрики репликации, общие для заданий MongoDB и PostgreSQL:
+- Счетчики прочитанных/записанных документов (строк) и переданных байт
+- Гистограммы длительности циклов и задержек по узлам
+- Отставание реплик (lag) от источника
+- HTTP-endpoint: /metrics в формате Prometheus и /metrics.json с тем же содержимым в JSON
+"""
+
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_DUMP_PATH = os.environ.get("METRICS_DUMP_PATH", "")
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+HELP = {
+    "replication_cycle_duration_seconds": "Длительность цикла синхронизации / применения транзакции",
+    "replication_documents_read_total": "Прочитано документов (строк)",
+    "replication_documents_written_total": "Записано документов (строк)",
+    "replication_bytes_transferred_total": "Передано байт",
+    "replication_node_latency_seconds": "Задержка операций по узлам",
+    "replication_lag_seconds": "Отставание реплики от источника",
+    "replication_errors_total": "Ошибки синхронизации",
+    "replication_staleness_seconds": "Время с последнего успешного цикла пары источник -> приемник",
+    "replication_catchup_pending": "Реплик в очереди догоняющей синхронизации",
+    "replication_tombstones": "Неподтвержденных надгробий удалений (MongoDB)",
+    "replication_ingest_documents_total": "Принято документов шлюзом записи",
+    "replication_ingest_commit_seconds": "Время записи пакета шлюза до кворума",
+    "replication_read_cache_total": "Чтения по ключу через кэш (result=hit/miss)",
+    "replication_node_up": "Доступность узла по последнему heartbeat'у (1/0)",
+}
+
+# Единый набор меток каждой метрики: не переданная метка получает пустое значение,
+# неизвестная метка - ошибка
+LABELS = {
+    "replication_cycle_duration_seconds": ("job", "db", "table"),
+    "replication_documents_read_total": ("job", "node"),
+    "replication_documents_written_total": ("job", "node", "table"),
+    "replication_bytes_transferred_total": ("job", "node", "table", "direction"),
+    "replication_node_latency_seconds": ("job", "node", "command"),
+    "replication_lag_seconds": ("job", "source", "db"),
+    "replication_errors_total": ("job", "node", "db", "table", "pair"),
+    "replication_staleness_seconds": ("job", "pair"),
+    "replication_catchup_pending": ("job",),
+    "replication_tombstones": ("job", "db"),
+    "replication_ingest_documents_total": ("job", "db"),
+    "replication_ingest_commit_seconds": ("job", "db"),
+    "replication_read_cache_total": ("job", "db", "result"),
+    "replication_node_up": ("job", "node"),
+}
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин (как в Prometheus)"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """[(граница, накопленное число)] включая +Inf"""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _labels_key(name, labels):
+    schema = LABELS.get(name)
+    if schema is None:
+        raise ValueError(f"Неизвестная метрика {name}")
+    unknown = set(labels) - set(schema)
+    if unknown:
+        raise ValueError(f"Метрика {name} не имеет меток {sorted(unknown)}")
+    return tuple((label, str(labels.get(label, ""))) for label in schema)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else f"{bound:g}"
+
+
+class MetricsRegistry:
+    """Потокобезопасный реестр метрик процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._gauge_functions = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """Увеличивает счетчик"""
+        key = _labels_key(name, labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Устанавливает значение gauge"""
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels_key(name, labels)] = value
+
+    def set_function(self, name, fn, **labels):
+        """Gauge, вычисляемый при каждом чтении метрик (например, время с последней синхронизации)"""
+        with self._lock:
+            self._gauge_functions.setdefault(name, {})[_labels_key(name, labels)] = fn
+
+    def observe(self, name, value, **labels):
+        """Добавляет наблюдение в гистограмму"""
+        key = _labels_key(name, labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Измеряет длительность блока и добавляет ее в гистограмму"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started, **labels)
+
+    def _gauge_values(self):
+        # Функции вызываются вне блокировки: они могут сами обращаться к реестру или ждать других потоков
+        with self._lock:
+            gauges = {name: dict(series) for name, series in self._gauges.items()}
+            functions = [(name, key, fn)
+                         for name, series in self._gauge_functions.items() for key, fn in series.items()]
+        for name, key, fn in functions:
+            try:
+                value = fn()
+            except Exception:
+                continue
+            if value is not None:
+                gauges.setdefault(name, {})[key] = value
+        return gauges
+
+    def render_prometheus(self):
+        """Метрики в текстовом формате Prometheus"""
+        lines = []
+
+        def header(name, kind):
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        gauges = self._gauge_values()
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                header(name, "counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(gauges.items()):
+                header(name, "gauge")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                header(name, "histogram")
+                for key, histogram in sorted(series.items()):
+                    for bound, count in histogram.cumulative():
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', _format_bound(bound))])} {count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Метрики в виде словаря (для JSON)"""
+
+        def series_list(series, convert):
+            return [dict(labels=dict(key), **convert(value)) for key, value in sorted(series.items())]
+
+        gauges = self._gauge_values()
+        with self._lock:
+            return {
+                "timestamp": time.time(),
+                "counters": {
+                    name: series_list(series, lambda v: {"value": v}) for name, series in self._counters.items()
+                },
+                "gauges": {
+                    name: series_list(series, lambda v: {"value": v}) for name, series in gauges.items()
+                },
+                "histograms": {
+                    name: series_list(series, lambda h: {
+                        "count": h.count,
+                        "sum": h.sum,
+                        "buckets": {_format_bound(bound): count for bound, count in h.cumulative()},
+                    })
+                    for name, series in self._histograms.items()
+                },
+            }
+
+    def dump_json(self, path=METRICS_DUMP_PATH):
+        """Атомарно записывает снимок метрик в JSON-файл"""
+        if not path:
+            return
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+
+metrics = MetricsRegistry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = metrics.render_prometheus().encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body = json.dumps(metrics.snapshot(), ensure_ascii=False).encode()
+            content_type = "application/json; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT):
+    """Запускает HTTP-endpoint метрик в фоновом потоке (port=0 - не запускать)"""
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    except OSError as e:
+        # Порт занят другим заданием в том же контейнере - метрики этого процесса доступны только в JSON
+        print(f"⚠ Не удалось запустить endpoint метрик на порту {port}: {e}")
+        return None
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    return server
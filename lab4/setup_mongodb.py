@@ -6,12 +6,19 @@
 - Создает документы со случайными данными
 """
 
-import pymongo
+import os
 import random
 import string
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from mongodb_clients import get_client, registry, wait_for_nodes
+
+# Число документов для массовой генерации (mongodb_bulk_seed.py); 0 - два случайных документа, как раньше
+SEED_DOCUMENTS = int(os.environ.get("SEED_DOCUMENTS", "0"))
+SEED = int(os.environ.get("SEED", "0"))
+
 def generate_random_string(length=10):
     """Генерирует случайную строку"""
     return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
@@ -29,38 +36,12 @@ def generate_random_document():
         "tags": [generate_random_string(5) for _ in range(random.randint(1, 5))]
     }
 
-def wait_for_mongodb(host, port, max_retries=30):
-    """Ожидает готовности MongoDB"""
-    for i in range(max_retries):
-        try:
-            client = pymongo.MongoClient(
-                host=host,
-                port=port,
-                serverSelectionTimeoutMS=2000
-            )
-            client.admin.command('ping')
-            client.close()
-            print(f"✓ MongoDB {host}:{port} готов")
-            return True
-        except Exception as e:
-            if i == max_retries - 1:
-                print(f"✗ Не удалось подключиться к MongoDB {host}:{port}: {e}")
-                return False
-            time.sleep(2)
-    return False
-
 def setup_mongodb_node(host, port, admin_user, admin_pass, db_name, local_user, local_pass, remote_user, remote_pass, can_access_remote=False, remote_host=None, remote_port=None):
     """Настраивает MongoDB узел"""
     print(f"\n=== Настройка MongoDB {host}:{port} ===")
     
     # Подключение как администратор
-    client = pymongo.MongoClient(
-        host=host,
-        port=port,
-        username=admin_user,
-        password=admin_pass,
-        authSource='admin'
-    )
+    client = get_client(host, port, admin_user, admin_pass)
     
     db = client[db_name]
     
@@ -70,15 +51,24 @@ def setup_mongodb_node(host, port, admin_user, admin_pass, db_name, local_user,
     # Удаляем старые данные
     collection.delete_many({})
     
-    # Создаем два документа со случайными данными
-    print(f"Создание документов в базе {db_name}...")
-    doc1 = generate_random_document()
-    doc2 = generate_random_document()
-    
-    result1 = collection.insert_one(doc1)
-    result2 = collection.insert_one(doc2)
-    
-    print(f"✓ Созданы документы: {result1.inserted_id}, {result2.inserted_id}")
+    if SEED_DOCUMENTS > 0:
+        # Массовая генерация для нагрузочной проверки (NumPy, параллельные insert_many)
+        from mongodb_bulk_seed import seed_collection
+        
+        print(f"Генерация {SEED_DOCUMENTS} документов в базе {db_name} (seed={SEED})...")
+        # У каждой БД свой seed, чтобы данные узлов не совпадали
+        inserted, rate = seed_collection(collection, SEED_DOCUMENTS, seed=SEED + (1 if db_name == "mongodb_db1" else 2))
+        print(f"✓ Создано {inserted} документов, {rate:.0f} док/с")
+    else:
+        # Создаем два документа со случайными данными
+        print(f"Создание документов в базе {db_name}...")
+        doc1 = generate_random_document()
+        doc2 = generate_random_document()
+        
+        result1 = collection.insert_one(doc1)
+        result2 = collection.insert_one(doc2)
+        
+        print(f"✓ Созданы документы: {result1.inserted_id}, {result2.inserted_id}")
     
     # Создание пользователей
     print(f"Создание пользователей...")
@@ -132,13 +122,7 @@ def setup_mongodb_node(host, port, admin_user, admin_pass, db_name, local_user,
     # Если пользователь должен иметь доступ к соседней БД, создаем его там тоже
     if can_access_remote and remote_host and remote_port:
         try:
-            remote_client = pymongo.MongoClient(
-                host=remote_host,
-                port=remote_port,
-                username=admin_user,
-                password=admin_pass,
-                authSource='admin'
-            )
+            remote_client = get_client(remote_host, remote_port, admin_user, admin_pass)
             remote_db = remote_client[remote_db_name]
             try:
                 remote_db.command(
@@ -156,11 +140,9 @@ def setup_mongodb_node(host, port, admin_user, admin_pass, db_name, local_user,
                         remote_db.command("updateUser", remote_user, pwd=remote_pass, roles=[{"role": "read", "db": remote_db_name}])
                     except:
                         pass
-            remote_client.close()
         except Exception as e:
             print(f"⚠ Не удалось создать пользователя в соседней БД: {e}")
     
-    client.close()
     print(f"✓ Настройка {host}:{port} завершена\n")
 
 def main():
@@ -177,49 +159,51 @@ def main():
     ADMIN_USER = "admin"
     ADMIN_PASS = "adminpass"
     
-    # Ожидание готовности MongoDB
+    # Ожидание готовности MongoDB: узлы опрашиваются параллельно, узел готов после успешной аутентификации
     print("\nОжидание готовности MongoDB контейнеров...")
-    if not wait_for_mongodb(NODE1_HOST, NODE1_PORT):
-        print("Ошибка: MongoDB node1 не готов")
-        return 1
-    
-    if not wait_for_mongodb(NODE2_HOST, NODE2_PORT):
-        print("Ошибка: MongoDB node2 не готов")
+    if not wait_for_nodes([(NODE1_HOST, NODE1_PORT), (NODE2_HOST, NODE2_PORT)], ADMIN_USER, ADMIN_PASS):
+        print("Ошибка: MongoDB узлы не готовы")
         return 1
     
-    time.sleep(5)  # Дополнительная пауза для полной инициализации
-    
-    # Настройка первого узла
-    setup_mongodb_node(
-        host=NODE1_HOST,
-        port=NODE1_PORT,
-        admin_user=ADMIN_USER,
-        admin_pass=ADMIN_PASS,
-        db_name="mongodb_db1",
-        local_user="user_local_node1",
-        local_pass="localpass1",
-        remote_user="user_remote_node1",
-        remote_pass="remotepass1",
-        can_access_remote=True,  # Этот пользователь может видеть соседнюю БД
-        remote_host=NODE2_HOST,
-        remote_port=NODE2_PORT
-    )
-    
-    # Настройка второго узла
-    setup_mongodb_node(
-        host=NODE2_HOST,
-        port=NODE2_PORT,
-        admin_user=ADMIN_USER,
-        admin_pass=ADMIN_PASS,
-        db_name="mongodb_db2",
-        local_user="user_local_node2",
-        local_pass="localpass2",
-        remote_user="user_remote_node2",
-        remote_pass="remotepass2",
-        can_access_remote=True,  # Этот пользователь может видеть соседнюю БД
-        remote_host=NODE1_HOST,
-        remote_port=NODE1_PORT
-    )
+    started = time.monotonic()
+    nodes = [
+        dict(
+            host=NODE1_HOST,
+            port=NODE1_PORT,
+            admin_user=ADMIN_USER,
+            admin_pass=ADMIN_PASS,
+            db_name="mongodb_db1",
+            local_user="user_local_node1",
+            local_pass="localpass1",
+            remote_user="user_remote_node1",
+            remote_pass="remotepass1",
+            can_access_remote=True,  # Этот пользователь может видеть соседнюю БД
+            remote_host=NODE2_HOST,
+            remote_port=NODE2_PORT
+        ),
+        dict(
+            host=NODE2_HOST,
+            port=NODE2_PORT,
+            admin_user=ADMIN_USER,
+            admin_pass=ADMIN_PASS,
+            db_name="mongodb_db2",
+            local_user="user_local_node2",
+            local_pass="localpass2",
+            remote_user="user_remote_node2",
+            remote_pass="remotepass2",
+            can_access_remote=True,  # Этот пользователь может видеть соседнюю БД
+            remote_host=NODE1_HOST,
+            remote_port=NODE1_PORT
+        ),
+    ]
+    # Узлы настраиваются параллельно: шаги узлов не зависят друг от друга
+    # (пользователь в соседней БД создается идемпотентно - createUser или updateUser)
+    with ThreadPoolExecutor(max_workers=len(nodes)) as pool:
+        for future in [pool.submit(setup_mongodb_node, **node) for node in nodes]:
+            future.result()
+    print(f"✓ Узлы настроены за {time.monotonic() - started:.1f}с")
+    
+    registry.close_all()
     
     print("=" * 60)
     print("✓ Инициализация MongoDB завершена успешно")
@@ -6,28 +6,7 @@
 - Настраивает синхронизацию между основными узлами и репликами
 """
 
-import pymongo
-import time
-
-def wait_for_mongodb(host, port, max_retries=30):
-    """Ожидает готовности MongoDB"""
-    for i in range(max_retries):
-        try:
-            client = pymongo.MongoClient(
-                host=host,
-                port=port,
-                serverSelectionTimeoutMS=2000
-            )
-            client.admin.command('ping')
-            client.close()
-            print(f"✓ MongoDB {host}:{port} готов")
-            return True
-        except Exception as e:
-            if i == max_retries - 1:
-                print(f"✗ Не удалось подключиться к MongoDB {host}:{port}: {e}")
-                return False
-            time.sleep(2)
-    return False
+from mongodb_clients import get_client, registry, wait_for_nodes
 
 def init_replica_set(client, rs_name, members):
     """Инициализирует Replica Set"""
@@ -79,16 +58,11 @@ def main():
     
     print("\nОжидание готовности всех MongoDB контейнеров...")
     
-    # Ожидание основных узлов
-    wait_for_mongodb(NODE1_HOST, NODE1_PORT)
-    wait_for_mongodb(NODE2_HOST, NODE2_PORT)
-    
-    # Ожидание реплик
-    wait_for_mongodb(REPLICA1_HOST, REPLICA1_PORT)
-    wait_for_mongodb(REPLICA2_HOST, REPLICA2_PORT)
-    wait_for_mongodb(REPLICA3_HOST, REPLICA3_PORT)
-    
-    time.sleep(5)
+    # Основные узлы и реплики опрашиваются параллельно; узел готов после успешной аутентификации
+    wait_for_nodes([
+        (NODE1_HOST, NODE1_PORT), (NODE2_HOST, NODE2_PORT),
+        (REPLICA1_HOST, REPLICA1_PORT), (REPLICA2_HOST, REPLICA2_PORT), (REPLICA3_HOST, REPLICA3_PORT),
+    ], ADMIN_USER, ADMIN_PASS)
     
     print("\n=== Настройка Replica Set для основных узлов (rs0) ===")
     # Для основных узлов создаем отдельные replica sets (они независимы)
@@ -97,14 +71,8 @@ def main():
     print("\n=== Настройка Replica Set для реплик (rs1) ===")
     # Подключаемся к первому реплика-узлу и инициализируем replica set
     try:
-        client_replica1 = pymongo.MongoClient(
-            host=REPLICA1_HOST,
-            port=REPLICA1_PORT,
-            username=ADMIN_USER,
-            password=ADMIN_PASS,
-            authSource='admin',
-            serverSelectionTimeoutMS=10000
-        )
+        client_replica1 = get_client(REPLICA1_HOST, REPLICA1_PORT, ADMIN_USER, ADMIN_PASS,
+                                     serverSelectionTimeoutMS=10000)
         
         members = [
             {"_id": 0, "host": f"{REPLICA1_HOST}:{REPLICA1_PORT}"},
@@ -113,7 +81,6 @@ def main():
         ]
         
         init_replica_set(client_replica1, "rs1", members)
-        client_replica1.close()
         
         print("✓ Replica Set rs1 настроен для реплик")
         print("  Реплики будут синхронизироваться автоматически через MongoDB Replica Set")
@@ -122,6 +89,8 @@ def main():
         print(f"⚠ Ошибка настройки Replica Set для реплик: {e}")
         print("  Продолжаем работу - синхронизация будет через скрипт")
     
+    registry.close_all()
+    
     print("\n" + "=" * 60)
     print("✓ Настройка репликации завершена")
     print("=" * 60)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Формат снимков на диске (общий для PostgreSQL и MongoDB):
+- Снимок - каталог с манифестом manifest.json и файлами частей; часть - диапазон ключей одной таблицы
+  (коллекции) в бинарном виде (COPY binary / BSON), сжатый zstd (zlib, если модуль zstandard не установлен)
+- Для каждой части в манифесте хранится SHA-256 несжатых данных: он проверяется при чтении, по нему
+  при восстановлении пропускаются части, уже совпадающие с приемником, а при повторной записи снимка
+  в тот же каталог не перезаписываются неизменившиеся файлы
+- Манифест записывается последним и атомарно: каталог без манифеста - незавершенный снимок
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import zlib
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+CHUNK_ROWS = int(os.environ.get("SNAPSHOT_CHUNK_ROWS", "100000"))
+COMPRESSION_LEVEL = int(os.environ.get("SNAPSHOT_COMPRESSION_LEVEL", "3"))
+RESTORE_WORKERS = int(os.environ.get("RESTORE_WORKERS", "4"))
+EXTENSIONS = {"zstd": "zst", "zlib": "zz"}
+
+
+class SnapshotError(Exception):
+    """Снимок незавершен или поврежден"""
+
+
+def default_compression():
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def compress(data, compression):
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL).compress(data)
+    return zlib.compress(data, min(COMPRESSION_LEVEL, 9))
+
+
+def decompress(data, compression):
+    if compression == "zstd":
+        if zstandard is None:
+            raise SnapshotError("снимок сжат zstd, нужен модуль zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def checksum(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST_NAME)
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        raise SnapshotError(f"в {directory} нет манифеста (снимок не завершен)")
+    except ValueError as e:
+        raise SnapshotError(f"манифест {path} поврежден: {e}")
+    if manifest.get("format_version") != FORMAT_VERSION:
+        raise SnapshotError(f"неподдерживаемая версия формата снимка: {manifest.get('format_version')}")
+    return manifest
+
+
+def read_chunk(directory, manifest, chunk):
+    """Читает и распаковывает часть, проверяя контрольную сумму"""
+    with open(os.path.join(directory, chunk["file"]), "rb") as f:
+        data = decompress(f.read(), manifest["compression"])
+    if checksum(data) != chunk["sha256"]:
+        raise SnapshotError(f"контрольная сумма части {chunk['file']} не совпадает")
+    return data
+
+
+def totals(manifest):
+    """(строк, байт без сжатия, байт на диске) по всему снимку"""
+    chunks = [chunk for item in manifest["items"] for chunk in item["chunks"]]
+    return (sum(chunk["rows"] for chunk in chunks), sum(chunk["bytes"] for chunk in chunks),
+            sum(chunk["compressed_bytes"] for chunk in chunks))
+
+
+class SnapshotWriter:
+    """
+    Пишет части снимка в каталог. Таблицы (коллекции) можно писать параллельно,
+    части одной таблицы - последовательно, в порядке ключей
+    """
+
+    def __init__(self, directory, kind, source, compression=None):
+        self.directory = directory
+        self.kind = kind
+        self.source = source
+        self.compression = compression or default_compression()
+        self.items = []
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Части прежнего снимка в этом каталоге: неизменившиеся файлы переиспользуются
+        try:
+            previous = read_manifest(directory)
+        except SnapshotError:
+            previous = None
+        self._previous = {}
+        if previous is not None and previous["compression"] == self.compression:
+            self._previous = {chunk["file"]: chunk for item in previous["items"] for chunk in item["chunks"]}
+
+    def add_item(self, name, **meta):
+        """Регистрирует таблицу (коллекцию); meta - описание для восстановления (столбцы, ключ, индексы)"""
+        item = {"name": name, **meta, "chunks": []}
+        with self._lock:
+            self.items.append(item)
+        return item
+
+    def write_chunk(self, item, data, rows, **meta):
+        """Сохраняет очередную часть таблицы; meta - например, диапазон ключей части"""
+        prefix = re.sub(r"[^A-Za-z0-9_.-]", "_", item["name"])
+        file_name = f"{prefix}.{len(item['chunks']):05d}.{EXTENSIONS[self.compression]}"
+        path = os.path.join(self.directory, file_name)
+        digest = checksum(data)
+        previous = self._previous.get(file_name)
+        if previous is not None and previous["sha256"] == digest and os.path.exists(path):
+            compressed_bytes = previous["compressed_bytes"]
+        else:
+            blob = compress(data, self.compression)
+            _write_atomic(path, blob)
+            compressed_bytes = len(blob)
+        chunk = {"file": file_name, "rows": rows, "bytes": len(data), "compressed_bytes": compressed_bytes,
+                 "sha256": digest, **meta}
+        item["chunks"].append(chunk)
+        return chunk
+
+    def finish(self):
+        """Записывает манифест и удаляет файлы частей, не вошедшие в снимок; возвращает манифест"""
+        manifest = {
+            "format_version": FORMAT_VERSION,
+            "kind": self.kind,
+            "source": self.source,
+            "created_at": datetime.now().isoformat(),
+            "compression": self.compression,
+            "items": sorted(self.items, key=lambda item: item["name"]),
+        }
+        _write_atomic(os.path.join(self.directory, MANIFEST_NAME),
+                      json.dumps(manifest, ensure_ascii=False, indent=1).encode("utf-8"))
+        used = {chunk["file"] for item in self.items for chunk in item["chunks"]}
+        extensions = tuple(f".{extension}" for extension in EXTENSIONS.values())
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(extensions) and file_name not in used:
+                os.remove(os.path.join(self.directory, file_name))
+        return manifest
@@ -6,80 +6,275 @@
 - Синхронизирует данные из основных узлов в реплики
 """
 
+import os
 import pymongo
+import threading
 import time
 from datetime import datetime
-from bson import ObjectId
+import bson
+from pymongo import DeleteOne, ReplaceOne, UpdateOne, monitoring
+from pymongo.errors import OperationFailure
 
-def get_all_documents(client, db_name, collection_name):
-    """Получает все документы из коллекции"""
-    try:
-        db = client[db_name]
-        collection = db[collection_name]
-        return list(collection.find({}))
-    except Exception as e:
-        print(f"⚠ Ошибка получения документов из {db_name}.{collection_name}: {e}")
-        return []
+import mongodb_anti_entropy
+import mongodb_raw
+import mongodb_tombstones
+import mongodb_versioning
+from adaptive_scheduler import AdaptiveScheduler
+from mongodb_clients import ensure_available, get_client, registry
+from mongodb_document_diff import smaller_patch
+from mongodb_fanout import fan_out, fan_out_quorum, run_parallel
+from mongodb_quorum import WRITE_QUORUM, catch_up, with_write_concern
+from replication_metrics import metrics, start_metrics_server
+
+# Режим работы: "poll" - один полный цикл синхронизации, "daemon" - циклы опроса в одном процессе,
+# "stream" - инкрементальная синхронизация через change streams
+SYNC_MODE = os.environ.get("SYNC_MODE", "poll")
+REPLICATION_INTERVAL_SECONDS = float(os.environ.get("REPLICATION_INTERVAL_SECONDS", "10"))
+# Сравнение реплик деревом хешей на сервере вместо выкачивания всех документов
+ANTI_ENTROPY = os.environ.get("ANTI_ENTROPY", "1") == "1"
+# Потоковое слияние отсортированными курсорами вместо загрузки коллекций в память
+SYNC_STREAMING = os.environ.get("SYNC_STREAMING", "0") == "1"
+# Число разделов коллекции для параллельной синхронизации (mongodb_partitions.py); 0 или 1 - без разделов
+SYNC_PARTITIONS = int(os.environ.get("SYNC_PARTITIONS", "0"))
+# Пополевые патчи ($set/$unset/$push) вместо замены всего документа (mongodb_document_diff.py)
+FIELD_PATCHES = os.environ.get("FIELD_PATCHES", "1") == "1"
+COLLECTION_NAME = "users"
+# Уникальный индекс ключа name/email; частичный - только для документов с непустыми name и email (как в get_doc_key)
+KEY_INDEX_NAME = "name_email_unique"
+KEY_INDEX_FILTER = {'name': {'$gt': ''}, 'email': {'$gt': ''}}
+# Сколько ключей искать одним запросом $or при точечном поиске по индексу
+LOOKUP_BATCH_SIZE = int(os.environ.get("LOOKUP_BATCH_SIZE", "500"))
+DUPLICATE_KEY_ERROR = 11000
+# Узлы и коллекции, на которых индексы уже созданы в этом процессе
+_indexed = set()
+_indexed_lock = threading.Lock()
+# Время начала последнего завершенного цикла по БД: реплики отражают источник не позже этого момента
+_last_synced = {}
+
+class CommandLatencyListener(monitoring.CommandListener):
+    """Записывает задержку каждой команды MongoDB в гистограмму по узлам"""
+    
+    def started(self, event):
+        pass
+    
+    def succeeded(self, event):
+        self._observe(event)
+    
+    def failed(self, event):
+        self._observe(event)
+        metrics.inc("replication_errors_total", job="mongodb", node=self._node(event))
+    
+    def _node(self, event):
+        host, port = event.connection_id
+        return f"{host}:{port}"
+    
+    def _observe(self, event):
+        metrics.observe("replication_node_latency_seconds", event.duration_micros / 1e6,
+                        job="mongodb", node=self._node(event), command=event.command_name)
+
+def node_label(client):
+    """Имя узла для метрик (host:port)"""
+    address = client.address
+    return f"{address[0]}:{address[1]}" if address else "unknown"
+
+def get_all_documents(client, db_name, collection_name, query=None):
+    """Получает все документы из коллекции, подходящие под фильтр (ошибки обрабатывает вызывающий код)"""
+    db = client[db_name]
+    collection = db[collection_name]
+    # Документы в сыром BSON: разбираются только те, что различаются между узлами (mongodb_raw.split_in_sync)
+    docs = list(mongodb_raw.find(collection, query))
+    node = node_label(client)
+    metrics.inc("replication_documents_read_total", len(docs), job="mongodb", node=node)
+    metrics.inc("replication_bytes_transferred_total", sum(mongodb_raw.doc_size(doc) for doc in docs),
+                job="mongodb", node=node, direction="read")
+    return docs
 
-def sync_collection(source_client, target_clients, db_name, collection_name):
-    """Синхронизирует коллекцию из источника во все целевые клиенты (объединяет данные)"""
+def find_by_keys(client, db_name, collection_name, docs):
+    """Находит документы с теми же ключами, что у docs, точечными запросами по индексу name/email (и _id)"""
+    found = {}
+    for start in range(0, len(docs), LOOKUP_BATCH_SIZE):
+        batch = docs[start:start + LOOKUP_BATCH_SIZE]
+        query = {'$or': [get_doc_filter(doc) for doc in batch]}
+        for doc in get_all_documents(client, db_name, collection_name, query):
+            found[doc['_id']] = doc
+    return list(found.values())
+
+def ensure_indexes(client, db_name, collection_name):
+    """
+    Создает на узле индекс created_at и уникальный индекс ключа name/email (один раз на процесс).
+    Если в коллекции еще есть дубликаты по ключу, уникальный индекс не создается -
+    попытка повторяется в следующем цикле, после того как синхронизация удалит дубликаты
+    """
+    key = (node_label(client), db_name, collection_name)
+    with _indexed_lock:
+        if key in _indexed:
+            return True
+    collection = client[db_name][collection_name]
+    collection.create_index([('created_at', pymongo.ASCENDING)])
     try:
-        # Получаем все документы из источника
-        source_docs = get_all_documents(source_client, db_name, collection_name)
+        collection.create_index(
+            [('name', pymongo.ASCENDING), ('email', pymongo.ASCENDING)],
+            name=KEY_INDEX_NAME, unique=True, partialFilterExpression=KEY_INDEX_FILTER,
+        )
+    except OperationFailure as e:
+        if e.code != DUPLICATE_KEY_ERROR:
+            raise
+        print(f"⚠ {key[0]} {db_name}.{collection_name}: есть дубликаты name/email, уникальный индекс отложен")
+        return False
+    with _indexed_lock:
+        _indexed.add(key)
+    return True
+
+def divergence_query(clients, db_name, collection_name, partition=None, source_client=None):
+    """
+    Сравнивает коллекции (или раздел коллекции - фильтр partition) через anti-entropy и возвращает фильтры
+    документов, которые нужно сравнить, - пару (фильтр для clients, фильтр для источника): None - коллекции
+    совпадают и синхронизировать нечего, иначе фильтр по различающимся корзинам для clients и по _id
+    различающихся документов для source_client (или фильтр раздела - все его документы, если anti-entropy
+    выключена или недоступна). Без source_client фильтр источника - None
+    """
+    within = lambda query: {'$and': [partition, query]} if partition else query
+    if ANTI_ENTROPY:
+        collections = [client[db_name][collection_name] for client in clients]
+        source = source_client[db_name][collection_name] if source_client is not None else None
+        divergence = mongodb_anti_entropy.divergent_buckets(collections, partition, source)
+        if divergence == ([], []):
+            return None
+        if divergence is not None and len(divergence[1]) <= mongodb_anti_entropy.MAX_SOURCE_IDS:
+            buckets, source_ids = divergence
+            query = within(mongodb_anti_entropy.bucket_query(buckets))
+            if source_client is None:
+                return query, None
+            return query, within(mongodb_anti_entropy.source_query(source_ids))
+    query = partition or {}
+    return query, (query if source_client is not None else None)
+
+def pick_newer(current, candidate):
+    """Выбирает последнюю запись по версии HLC (правило слияния реплик; документы должны пройти observe)"""
+    if mongodb_versioning.version_key(candidate) > mongodb_versioning.version_key(current):
+        return candidate
+    return current
+
+def pick_source_if_newer(current, candidate):
+    """
+    Версия из источника заменяет версию реплики, если ее HLC строго новее или если документ источника
+    без версии изменился после версии, записанной из источника (is_source_update) - тогда с новой отметкой HLC
+    """
+    if mongodb_versioning.version_key(candidate)[:2] > mongodb_versioning.version_key(current)[:2]:
+        return candidate
+    if mongodb_versioning.is_source_update(candidate, current):
+        return mongodb_versioning.source_update(candidate)
+    return current
+
+def streaming_merge(*args, **kwargs):
+    """Потоковое слияние (mongodb_streaming_merge импортирует этот модуль, поэтому импорт отложенный)"""
+    from mongodb_streaming_merge import streaming_merge as merge
+    return merge(*args, **kwargs)
+
+def sync_partitioned(*args, **kwargs):
+    """Синхронизация по разделам (mongodb_partitions импортирует этот модуль, поэтому импорт отложенный)"""
+    from mongodb_partitions import sync_partitioned as sync
+    return sync(*args, **kwargs)
+
+def sync_collection(source_client, target_clients, db_name, collection_name, partition=None):
+    """
+    Синхронизирует коллекцию (или раздел коллекции - фильтр partition) из источника во все целевые клиенты.
+    Для раздела ошибки узлов не только логируются, но и пробрасываются, чтобы раздел можно было повторить
+    """
+    # Надгробия реплик: удаленный документ не восстанавливается из источника, пока тот его не изменит
+    tombstones = mongodb_tombstones.load(target_clients, db_name, collection_name)
+    
+    def sync_target(target_client):
+        collection = target_client[db_name][collection_name]
+        
+        # Сравниваем только те части коллекций, в которых источник и реплика различаются
+        queries = divergence_query([target_client], db_name, collection_name, partition, source_client)
+        if queries is None:
+            return 0
+        query, source_query = queries
+        
+        if SYNC_STREAMING:
+            # Потоковое слияние: память ограничена размером пачки
+            written = streaming_merge(
+                [collection, source_client[db_name][collection_name]],
+                writable=[0], choose=pick_source_if_newer, queries=[query, source_query], tombstones=tombstones,
+                source=1
+            )
+            metrics.inc("replication_documents_written_total", written[0],
+                        job="mongodb", node=node_label(target_client))
+            return written[0]
         
+        source_docs = get_all_documents(source_client, db_name, collection_name, source_query)
         if not source_docs:
-            return
+            return 0
         
-        # Для каждого целевого клиента объединяем данные
-        for target_client in target_clients:
-            try:
-                db = target_client[db_name]
-                collection = db[collection_name]
-                
-                # Получаем существующие документы в реплике
-                existing_docs = get_all_documents(target_client, db_name, collection_name)
-                existing_ids = {str(doc.get('_id', '')) for doc in existing_docs}
-                
-                # Объединяем документы: добавляем новые из источника, сохраняем существующие в реплике
-                all_docs = {}
-                
-                # Сначала добавляем существующие документы из реплики
-                for doc in existing_docs:
-                    doc_id = str(doc.get('_id', ''))
-                    all_docs[doc_id] = doc
-                
-                # Затем добавляем/обновляем документы из источника
-                for doc in source_docs:
-                    doc_id = str(doc.get('_id', ''))
-                    # Если документа нет в реплике, добавляем его
-                    if doc_id not in existing_ids:
-                        all_docs[doc_id] = doc
-                    # Если есть, сравниваем по created_at и обновляем если источник новее
-                    elif doc_id in all_docs:
-                        source_time = doc.get('created_at', '')
-                        existing_time = all_docs[doc_id].get('created_at', '')
-                        if source_time and existing_time and source_time > existing_time:
-                            all_docs[doc_id] = doc
-                
-                # Синхронизируем объединенные данные
-                docs_list = list(all_docs.values())
-                collection.delete_many({})
-                if docs_list:
-                    docs_to_insert = []
-                    for doc in docs_list:
-                        new_doc = doc.copy()
-                        # MongoDB создаст новый ObjectId при вставке
-                        if '_id' in new_doc:
-                            del new_doc['_id']
-                        docs_to_insert.append(new_doc)
-                    if docs_to_insert:
-                        collection.insert_many(docs_to_insert)
-                    
-            except Exception as e:
-                print(f"⚠ Ошибка синхронизации в {db_name}.{collection_name}: {e}")
+        # Получаем документы реплики с теми же ключами точечными запросами по индексу
+        existing_docs = find_by_keys(target_client, db_name, collection_name, source_docs)
+        
+        # Ключи, побайтно совпадающие в источнике и реплике, не разбираются и не сравниваются
+        (source_docs, existing_docs), _ = mongodb_raw.split_in_sync([source_docs, existing_docs], get_doc_key)
+        
+        # Объединяем документы: сохраняем существующие в реплике, добавляем новые из источника
+        all_docs = {}
+        target_node = node_label(target_client)
+        for doc in existing_docs:
+            doc = mongodb_versioning.observe(doc, target_node)
+            if not mongodb_tombstones.killed(doc, tombstones):
+                all_docs.setdefault(get_doc_key(doc), doc)
+        
+        # Документ из источника заменяет существующий только если его версия новее
+        source_node = node_label(source_client)
+        for doc in source_docs:
+            doc = mongodb_tombstones.resolve_source(mongodb_versioning.observe(doc, source_node), tombstones)
+            if doc is None:
+                continue
+            doc_key = get_doc_key(doc)
+            existing = all_docs.get(doc_key)
+            all_docs[doc_key] = doc if existing is None else pick_source_if_newer(existing, doc)
+        
+        # Применяем только отличия
+        return apply_diff(collection, compute_diff(existing_docs, all_docs))
+    
+    written = 0
+    failures = []
+    try:
+        if WRITE_QUORUM and len(target_clients) > 1:
+            # Ждем подтверждения кворума реплик; отставшие догонят источник в фоне
+            lagging = lambda client: schedule_catch_up(client, [source_client], db_name, collection_name)
+            results = fan_out_quorum(sync_target, target_clients, WRITE_QUORUM, on_lagging=lagging)
+            return sum(result for result in results if result is not None)
+        
+        # Все целевые клиенты обрабатываются параллельно, у каждого свой таймаут
+        for result in fan_out(sync_target, target_clients):
+            if isinstance(result, Exception):
+                print(f"⚠ Ошибка синхронизации в {db_name}.{collection_name}: {result}")
+                metrics.inc("replication_errors_total", job="mongodb", db=db_name)
+                failures.append(result)
+            else:
+                written += result
         
     except Exception as e:
         print(f"⚠ Ошибка синхронизации коллекции {db_name}.{collection_name}: {e}")
+        failures.append(e)
+    if failures and partition is not None:
+        raise failures[0]
+    return written
+
+def schedule_catch_up(target_client, source_clients, db_name, collection_name):
+    """Ставит отставшую реплику в очередь догоняющей синхронизации с первым доступным узлом из source_clients"""
+    def task():
+        errors = []
+        for source_client in source_clients:
+            try:
+                # Пустой фильтр раздела - вся коллекция; ошибки пробрасываются, чтобы очередь повторила задачу
+                return sync_collection(source_client, [target_client], db_name, collection_name, partition={})
+            except Exception as e:
+                errors.append(e)
+        raise errors[0]
+    node = node_label(target_client)
+    print(f"⚠ {node} {db_name}.{collection_name}: реплика не подтвердила запись, поставлена в очередь догоняющей синхронизации")
+    metrics.inc("replication_errors_total", job="mongodb", db=db_name)
+    catch_up.enqueue((node, f"{db_name}.{collection_name}"), task)
 
 def get_doc_key(doc):
     """Получает уникальный ключ для документа (использует name+email или _id)"""
@@ -89,74 +284,309 @@ def get_doc_key(doc):
         return f"{name}:{email}"
     return str(doc.get('_id', ''))
 
-def sync_between_replicas(replica_clients, db_name, collection_name):
-    """Синхронизирует данные между репликами (блокчейн-логика)"""
+def get_doc_filter(doc):
+    """Возвращает фильтр для поиска документа по тому же ключу, что и get_doc_key"""
+    name = doc.get('name', '')
+    email = doc.get('email', '')
+    if name and email:
+        return {'name': name, 'email': email}
+    return {'_id': doc.get('_id')}
+
+class WriteOps(list):
+    """Операции bulk_write и объем заменяющих документов и патчей в них (payload_bytes, для метрик записи)"""
+
+    payload_bytes = 0
+
+    def extend(self, ops):
+        super().extend(ops)
+        self.payload_bytes += getattr(ops, 'payload_bytes', 0)
+
+def replace_ops(desired, upsert=False):
+    """Замена документа реплики на desired"""
+    doc = mongodb_raw.as_raw(desired)
+    ops = WriteOps([ReplaceOne({'_id': desired['_id']}, doc, upsert=upsert)])
+    ops.payload_bytes = mongodb_raw.doc_size(doc)
+    return ops
+
+def document_ops(existing, desired):
+    """Возвращает операции, приводящие документ реплики (existing) к желаемой версии (desired), сохраняя _id"""
+    if existing is None:
+        return replace_ops(desired, upsert=True)
+    if existing['_id'] != desired['_id']:
+        # Тот же ключ name:email, но другой _id - переносим документ под _id победившей версии
+        ops = WriteOps([DeleteOne({'_id': existing['_id']})])
+        ops.extend(replace_ops(desired, upsert=True))
+        return ops
+    # Совпадающие версии означают одинаковое содержимое - сравнивать документы не нужно
+    if mongodb_versioning.same_version(existing, desired) or existing == desired:
+        return WriteOps()
+    if not FIELD_PATCHES:
+        return replace_ops(desired)
+    patch = smaller_patch(existing, desired)
+    if patch is None:
+        return replace_ops(desired)
+    if not patch:
+        return WriteOps()
+    # Патч считается от прочитанной версии: если документ реплики успел измениться, обновление
+    # ничего не найдет, и документ будет сверен в следующем цикле
+    version = existing.get(mongodb_versioning.VERSION_FIELD)
+    ops = WriteOps([UpdateOne({'_id': desired['_id'], mongodb_versioning.VERSION_FIELD: version}, patch)])
+    ops.payload_bytes = len(bson.encode(patch))
+    return ops
+
+def key_ops(existing_docs, desired):
+    """
+    Операции для всех документов одной реплики с ключом desired: документ с тем же _id
+    (или первый найденный) приводится к desired, остальные дубликаты по ключу удаляются
+    """
+    existing = next((doc for doc in existing_docs if doc['_id'] == desired['_id']), None)
+    if existing is None and existing_docs:
+        existing = existing_docs[0]
+    ops = WriteOps(DeleteOne({'_id': doc['_id']}) for doc in existing_docs if doc is not existing)
+    ops.extend(document_ops(existing, desired))
+    return ops
+
+def compute_diff(existing_docs, desired_docs, delete_missing=False):
+    """
+    Вычисляет разницу между документами реплики и желаемым состоянием (ключ -> документ):
+    новые и измененные документы заменяются с upsert, дубликаты по ключу (и, при delete_missing,
+    отсутствующие в желаемом состоянии) удаляются
+    """
+    existing_by_key = {}
+    for doc in existing_docs:
+        existing_by_key.setdefault(get_doc_key(doc), []).append(doc)
+    
+    ops = WriteOps()
+    for doc_key, doc in desired_docs.items():
+        ops.extend(key_ops(existing_by_key.pop(doc_key, []), doc))
+    
+    if delete_missing:
+        for docs in existing_by_key.values():
+            ops.extend(DeleteOne({'_id': doc['_id']}) for doc in docs)
+    return ops
+
+def bulk_apply(collection, ops):
+    """
+    Выполняет операции неупорядоченными bulk_write: сначала удаления, затем замены.
+    В неупорядоченном bulk_write драйвер отправляет обновления раньше удалений, и перенос документа
+    под _id победившей версии нарушил бы уникальный индекс name/email. Возвращает (upserted, modified, deleted)
+    """
+    collection = with_write_concern(collection)
+    deletes = [op for op in ops if isinstance(op, DeleteOne)]
+    replaces = [op for op in ops if not isinstance(op, DeleteOne)]
+    upserted = modified = deleted = 0
+    if deletes:
+        deleted = collection.bulk_write(deletes, ordered=False).deleted_count
+    if replaces:
+        result = collection.bulk_write(replaces, ordered=False)
+        upserted, modified = result.upserted_count, result.modified_count
+    return upserted, modified, deleted
+
+def apply_diff(collection, ops):
+    """Применяет операции compute_diff пакетно (bulk_apply) и возвращает число измененных документов"""
+    if not ops:
+        return 0
+    upserted, modified, deleted = bulk_apply(collection, ops)
+    node = node_label(collection.database.client)
+    metrics.inc("replication_documents_written_total", upserted + modified + deleted, job="mongodb", node=node)
+    # Объем записи - заменяющие документы и патчи
+    metrics.inc("replication_bytes_transferred_total", ops.payload_bytes, job="mongodb", node=node, direction="written")
+    print(f"  {collection.database.name}.{collection.name}: +{upserted} ~{modified} -{deleted}")
+    return upserted + modified + deleted
+
+def sync_between_replicas(replica_clients, db_name, collection_name, partition=None):
+    """
+    Синхронизирует данные между репликами (блокчейн-логика) во всей коллекции или в разделе partition;
+    возвращает число измененных документов. Для раздела ошибки пробрасываются, как в sync_collection
+    """
+    written = 0
+    failures = []
     try:
-        # Получаем документы из всех реплик
+        # Сравниваем реплики деревом хешей; если они совпадают, синхронизировать нечего
+        queries = divergence_query(replica_clients, db_name, collection_name, partition)
+        if queries is None:
+            return 0
+        query = queries[0]
+        
+        # Документы, закрытые надгробиями, не участвуют в слиянии
+        tombstones = mongodb_tombstones.load(replica_clients, db_name, collection_name)
+        
+        if SYNC_STREAMING:
+            # Потоковое слияние всех реплик: память ограничена размером пачки
+            collections = [client[db_name][collection_name] for client in replica_clients]
+            written = streaming_merge(collections, writable=range(len(collections)), choose=pick_newer, query=query,
+                                      tombstones=tombstones)
+            for i, count in written.items():
+                metrics.inc("replication_documents_written_total", count,
+                            job="mongodb", node=node_label(replica_clients[i]))
+            return sum(written.values())
+        
+        # Получаем документы из всех реплик параллельно (только из различающихся корзин)
         all_docs = {}
         replica_docs = {}
-        doc_keys_sets = []
         
-        for i, client in enumerate(replica_clients):
-            docs = get_all_documents(client, db_name, collection_name)
+        load_documents = lambda client: get_all_documents(client, db_name, collection_name, query)
+        loaded = []
+        for i, docs in enumerate(fan_out(load_documents, replica_clients)):
+            # Недоступная реплика пропускается в этом цикле и догонит остальных в следующем
+            if isinstance(docs, Exception):
+                print(f"⚠ Ошибка получения документов из реплики {i + 1} ({db_name}.{collection_name}): {docs}")
+                metrics.inc("replication_errors_total", job="mongodb", db=db_name)
+                failures.append(docs)
+                docs = None
+            loaded.append(docs)
+        
+        # Ключи, побайтно совпадающие во всех доступных репликах, не разбираются и не сравниваются
+        loaded, _ = mongodb_raw.split_in_sync(loaded, get_doc_key)
+        for i, docs in enumerate(loaded):
+            if docs is None:
+                continue
             replica_docs[i] = docs
-            doc_keys = set()
             
-            # Собираем все документы по уникальному ключу
+            # Собираем все документы по уникальному ключу; при совпадении побеждает последняя запись по HLC
+            node = node_label(replica_clients[i])
             for doc in docs:
+                doc = mongodb_versioning.observe(doc, node)
+                if mongodb_tombstones.killed(doc, tombstones):
+                    continue
                 doc_key = get_doc_key(doc)
-                doc_keys.add(doc_key)
-                
-                # Если документа еще нет или этот новее (по created_at)
-                if doc_key not in all_docs:
-                    all_docs[doc_key] = doc
-                else:
-                    # Сравниваем по created_at для определения более новой версии
-                    existing_time = all_docs[doc_key].get('created_at', '')
-                    new_time = doc.get('created_at', '')
-                    if new_time and existing_time:
-                        if new_time > existing_time:
-                            all_docs[doc_key] = doc
-                    elif new_time and not existing_time:
-                        all_docs[doc_key] = doc
-            
-            doc_keys_sets.append(doc_keys)
+                existing = all_docs.get(doc_key)
+                all_docs[doc_key] = doc if existing is None else pick_newer(existing, doc)
         
-        # Проверяем, есть ли различия между репликами
-        needs_sync = False
+        # Приводим каждую реплику к объединенной версии, записывая только различия (параллельно)
+        def apply_to_replica(i):
+            collection = replica_clients[i][db_name][collection_name]
+            return apply_diff(collection, compute_diff(replica_docs[i], all_docs))
         
-        # Проверяем количество документов и их ключи
-        if len(doc_keys_sets) > 0:
-            first_set = doc_keys_sets[0]
-            for doc_keys_set in doc_keys_sets[1:]:
-                if doc_keys_set != first_set:
-                    needs_sync = True
-                    break
+        if WRITE_QUORUM:
+            # Ждем подтверждения кворума реплик; отставшая реплика догонит любую из остальных в фоне
+            def lagging(i):
+                others = [client for j, client in enumerate(replica_clients) if j != i]
+                schedule_catch_up(replica_clients[i], others, db_name, collection_name)
+            results = fan_out_quorum(apply_to_replica, sorted(replica_docs), WRITE_QUORUM, on_lagging=lagging)
+            return sum(result for result in results if result is not None)
         
-        # Если есть различия, синхронизируем все реплики с объединенной версией
-        if needs_sync or len(all_docs) > 0:
-            # Синхронизируем все реплики одновременно
-            docs_list = list(all_docs.values())
-            for client in replica_clients:
-                try:
-                    db = client[db_name]
-                    collection = db[collection_name]
-                    collection.delete_many({})
-                    if docs_list:
-                        docs_to_insert = []
-                        for doc in docs_list:
-                            new_doc = doc.copy()
-                            # MongoDB создаст новый ObjectId при вставке
-                            if '_id' in new_doc:
-                                del new_doc['_id']
-                            docs_to_insert.append(new_doc)
-                        if docs_to_insert:
-                            collection.insert_many(docs_to_insert)
-                except Exception as e:
-                    print(f"⚠ Ошибка синхронизации реплики: {e}")
+        for result in fan_out(apply_to_replica, sorted(replica_docs)):
+            if isinstance(result, Exception):
+                print(f"⚠ Ошибка синхронизации реплики: {result}")
+                metrics.inc("replication_errors_total", job="mongodb", db=db_name)
+                failures.append(result)
+            else:
+                written += result
             
     except Exception as e:
         print(f"⚠ Ошибка синхронизации между репликами: {e}")
+        failures.append(e)
+    if failures and partition is not None:
+        raise failures[0]
+    return written
+
+def sync_database(source_client, replica_clients, db_name):
+    """
+    Полный цикл синхронизации одной БД: между репликами, из основного узла, финальный проход.
+    Возвращает число измененных документов
+    """
+    started = time.time()
+    with metrics.timer("replication_cycle_duration_seconds", job="mongodb", db=db_name):
+        # Удаления распространяются по надгробиям до слияния (без полного сканирования коллекций)
+        try:
+            if mongodb_tombstones.TRACK_DELETES:
+                mongodb_tombstones.detect_deletes(replica_clients, db_name, COLLECTION_NAME, node_label)
+            mongodb_tombstones.process(source_client, replica_clients, db_name, COLLECTION_NAME, node_label)
+        except Exception as e:
+            print(f"⚠ Ошибка обработки надгробий {db_name}.{COLLECTION_NAME}: {e}")
+            metrics.inc("replication_errors_total", job="mongodb", db=db_name)
+        if SYNC_PARTITIONS > 1:
+            # Коллекция делится на разделы по ключу, разделы синхронизируются параллельно
+            written = sync_partitioned(source_client, replica_clients, db_name)
+        else:
+            written = sync_database_steps(source_client, replica_clients, db_name)
+        if mongodb_tombstones.TRACK_DELETES:
+            try:
+                mongodb_tombstones.remember_ids(replica_clients, db_name, COLLECTION_NAME, node_label)
+            except Exception as e:
+                print(f"⚠ Не удалось запомнить _id реплик {db_name}.{COLLECTION_NAME}: {e}")
+                metrics.inc("replication_errors_total", job="mongodb", db=db_name)
+    if db_name not in _last_synced:
+        # Отставание - время с начала последнего завершенного цикла (вычисляется при чтении метрик)
+        metrics.set_function("replication_lag_seconds", lambda: time.time() - _last_synced[db_name],
+                             job="mongodb", source=node_label(source_client), db=db_name)
+    _last_synced[db_name] = started
+    return written
+
+def ensure_all_indexes(source_client, replica_clients, db_name):
+    """
+    Индексы ключа и created_at на всех узлах, а на репликах - индекс хеша ключа для anti-entropy
+    (создаются один раз на процесс)
+    """
+    def ensure(client):
+        if not ensure_indexes(client, db_name, COLLECTION_NAME) or not ANTI_ENTROPY or client is source_client:
+            return
+        key = (node_label(client), db_name, COLLECTION_NAME, mongodb_anti_entropy.KEY_HASH_FIELD)
+        with _indexed_lock:
+            if key in _indexed:
+                return
+        mongodb_anti_entropy.ensure_key_hashes(client[db_name][COLLECTION_NAME])
+        with _indexed_lock:
+            _indexed.add(key)
+
+    for result in fan_out(ensure, [source_client] + list(replica_clients)):
+        if isinstance(result, Exception):
+            print(f"⚠ Ошибка создания индексов в {db_name}.{COLLECTION_NAME}: {result}")
+
+def sync_database_steps(source_client, replica_clients, db_name, partition=None):
+    """
+    Шаги цикла синхронизации коллекции: между репликами, из основного узла, снова между репликами.
+    partition - фильтр раздела коллекции (mongodb_partitions.py), каждый шаг сравнивает только его документы;
+    индексы создаются только при синхронизации всей коллекции (для разделов - один раз до их запуска).
+    Возвращает число измененных документов
+    """
+    if partition is None:
+        ensure_all_indexes(source_client, replica_clients, db_name)
+    
+    # ВАЖНО: Сначала синхронизируем между репликами (блокчейн-логика)
+    # Это сохраняет изменения, сделанные в репликах
+    written = sync_between_replicas(replica_clients, db_name, COLLECTION_NAME, partition)
+    
+    # Затем синхронизируем из основного узла в реплики (данные извне)
+    written += sync_collection(source_client, replica_clients, db_name, COLLECTION_NAME, partition)
+    
+    # После синхронизации из основного узла, снова синхронизируем между репликами
+    # чтобы убедиться, что все реплики имеют одинаковые данные
+    written += sync_between_replicas(replica_clients, db_name, COLLECTION_NAME, partition)
+    return written
+
+def run_sync_cycle(sources, replica_clients):
+    """Выполняет полный цикл синхронизации для всех БД (базы обрабатываются параллельно)"""
+    started = time.monotonic()
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Синхронизация {', '.join(db for _, db in sources)}...")
+    run_parallel([
+        lambda source_client=source_client, db_name=db_name: sync_database(source_client, replica_clients, db_name)
+        for source_client, db_name in sources
+    ])
+    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Цикл синхронизации завершен за {time.monotonic() - started:.2f}с")
+    metrics.dump_json()
+
+def check_reachable(source_client, replica_clients):
+    """Проверяет доступность узлов пары: недоступен источник или все реплики - цикл откладывается с backoff"""
+    # Узлы, недоступные по heartbeat'ам, отбрасываются сразу, без ожидания таймаута выбора сервера
+    ensure_available(source_client)
+    source_client.admin.command('ping')
+    results = fan_out(lambda client: client.admin.command('ping'), replica_clients)
+    if all(isinstance(result, Exception) for result in results):
+        raise results[0]
+
+def run_scheduled(sources, replica_clients):
+    """Адаптивное расписание: каждая БД (основной узел -> реплики) синхронизируется в своем ритме"""
+    scheduler = AdaptiveScheduler("mongodb", initial_interval=REPLICATION_INTERVAL_SECONDS)
+    for source_client, db_name in sources:
+        def task(source_client=source_client, db_name=db_name):
+            check_reachable(source_client, replica_clients)
+            written = sync_database(source_client, replica_clients, db_name)
+            metrics.dump_json()
+            return written
+        scheduler.add(f"{node_label(source_client)}/{db_name}", task)
+    scheduler.run_forever()
 
 def main():
     ADMIN_USER = "admin"
@@ -176,88 +606,50 @@ def main():
     REPLICA3_HOST = "mongodb_replica3"
     REPLICA3_PORT = 27017
     
+    # Задержки команд по узлам; слушатель должен быть зарегистрирован до создания клиентов
+    monitoring.register(CommandLatencyListener())
+    start_metrics_server()
+    
     try:
-        # Подключение к основным узлам
-        node1_client = pymongo.MongoClient(
-            host=NODE1_HOST,
-            port=NODE1_PORT,
-            username=ADMIN_USER,
-            password=ADMIN_PASS,
-            authSource='admin',
-            serverSelectionTimeoutMS=5000
-        )
+        # Клиенты берутся из общего реестра: соединения и аутентификация переиспользуются между циклами
+        node1_client = get_client(NODE1_HOST, NODE1_PORT, ADMIN_USER, ADMIN_PASS)
+        node2_client = get_client(NODE2_HOST, NODE2_PORT, ADMIN_USER, ADMIN_PASS)
         
-        node2_client = pymongo.MongoClient(
-            host=NODE2_HOST,
-            port=NODE2_PORT,
-            username=ADMIN_USER,
-            password=ADMIN_PASS,
-            authSource='admin',
-            serverSelectionTimeoutMS=5000
-        )
-        
-        # Подключение к репликам
-        replica1_client = pymongo.MongoClient(
-            host=REPLICA1_HOST,
-            port=REPLICA1_PORT,
-            username=ADMIN_USER,
-            password=ADMIN_PASS,
-            authSource='admin',
-            serverSelectionTimeoutMS=5000
-        )
-        
-        replica2_client = pymongo.MongoClient(
-            host=REPLICA2_HOST,
-            port=REPLICA2_PORT,
-            username=ADMIN_USER,
-            password=ADMIN_PASS,
-            authSource='admin',
-            serverSelectionTimeoutMS=5000
-        )
-        
-        replica3_client = pymongo.MongoClient(
-            host=REPLICA3_HOST,
-            port=REPLICA3_PORT,
-            username=ADMIN_USER,
-            password=ADMIN_PASS,
-            authSource='admin',
-            serverSelectionTimeoutMS=5000
-        )
+        replica1_client = get_client(REPLICA1_HOST, REPLICA1_PORT, ADMIN_USER, ADMIN_PASS)
+        replica2_client = get_client(REPLICA2_HOST, REPLICA2_PORT, ADMIN_USER, ADMIN_PASS)
+        replica3_client = get_client(REPLICA3_HOST, REPLICA3_PORT, ADMIN_USER, ADMIN_PASS)
         
         replica_clients = [replica1_client, replica2_client, replica3_client]
+        sources = [(node1_client, "mongodb_db1"), (node2_client, "mongodb_db2")]
         
-        # ВАЖНО: Сначала синхронизируем между репликами (блокчейн-логика)
-        # Это сохраняет изменения, сделанные в репликах
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Синхронизация между репликами (блокчейн-логика)...")
-        sync_between_replicas(replica_clients, "mongodb_db1", "users")
-        sync_between_replicas(replica_clients, "mongodb_db2", "users")
-        
-        # Затем синхронизируем из основных узлов в реплики (данные извне)
-        # Но только если в репликах нет новых данных
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Синхронизация данных из основных узлов в реплики...")
-        
-        # Синхронизация из node1
-        sync_collection(node1_client, replica_clients, "mongodb_db1", "users")
-        
-        # Синхронизация из node2
-        sync_collection(node2_client, replica_clients, "mongodb_db2", "users")
-        
-        # После синхронизации из основных узлов, снова синхронизируем между репликами
-        # чтобы убедиться, что все реплики имеют одинаковые данные
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Финальная синхронизация между репликами...")
-        sync_between_replicas(replica_clients, "mongodb_db1", "users")
-        sync_between_replicas(replica_clients, "mongodb_db2", "users")
-        
-        # Закрываем соединения
-        node1_client.close()
-        node2_client.close()
-        replica1_client.close()
-        replica2_client.close()
-        replica3_client.close()
+        if SYNC_MODE == "stream":
+            # Долгоживущий режим: применяем только изменения из change stream'ов
+            from mongodb_change_stream import run_change_stream_sync
+            
+            run_change_stream_sync(
+                node_clients={NODE1_HOST: node1_client, NODE2_HOST: node2_client},
+                replica_clients={
+                    REPLICA1_HOST: replica1_client,
+                    REPLICA2_HOST: replica2_client,
+                    REPLICA3_HOST: replica3_client,
+                },
+                sources={NODE1_HOST: "mongodb_db1", NODE2_HOST: "mongodb_db2"},
+                full_sync=lambda: run_sync_cycle(sources, replica_clients),
+                poll=lambda: run_scheduled(sources, replica_clients),
+            )
+        elif SYNC_MODE == "daemon":
+            # Долгоживущий режим опроса: клиенты и пулы соединений живут между циклами,
+            # интервал каждой БД подстраивается под поток изменений
+            run_scheduled(sources, replica_clients)
+        else:
+            run_sync_cycle(sources, replica_clients)
         
     except Exception as e:
         print(f"⚠ Ошибка синхронизации: {e}")
         return 1
+    finally:
+        # Закрываем соединения
+        registry.close_all()
     
     return 0
 
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Локальное хранилище состояния синхронизации:
+- Хранит resume token'ы change stream'ов, LSN, отметки завершенных разделов и таблиц
+- Данные лежат в SQLite (журнал WAL): каждая отметка - отдельная строка, запись меняет только ее,
+  а не весь файл, и подтвержденная запись переживает падение процесса
+- Несколько процессов могут работать с одним файлом (например, логическая репликация и снимок PostgreSQL)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class SyncStateStore:
+    """Хранилище состояния синхронизации в локальной БД SQLite (значения - JSON)"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # В режиме WAL подтвержденные транзакции переживают падение процесса и без fsync на каждую запись
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sync_state ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+
+    def _write(self, items):
+        """Записывает пары (ключ, значение) одной транзакцией"""
+        now = time.time()
+        with self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.executemany(
+                "INSERT INTO sync_state (key, value, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+                [(key, json.dumps(value), now) for key, value in items],
+            )
+
+    def get(self, key, default=None):
+        """Возвращает значение по ключу"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        """Сохраняет значение по ключу"""
+        with self._lock:
+            self._write([(key, value)])
+
+    def delete(self, key):
+        """Удаляет значение по ключу"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sync_state WHERE key = ?", (key,))
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(path):
+    """Возвращает общее для процесса хранилище для файла path (одно соединение SQLite на файл)"""
+    with _stores_lock:
+        key = os.path.abspath(path)
+        if key not in _stores:
+            _stores[key] = SyncStateStore(path)
+        return _stores[key]
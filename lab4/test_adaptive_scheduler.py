@@ -0,0 +1,58 @@
+from adaptive_scheduler import AdaptiveScheduler, Backoff, ScheduledPair
+
+
+def scheduler():
+    return AdaptiveScheduler("test", min_interval=1, max_interval=60, max_staleness=30, log=lambda message: None)
+
+
+def test_interval_shrinks_with_changes_and_grows_when_idle():
+    pair = ScheduledPair("node1/db", task=None, interval=8)
+
+    assert scheduler().next_interval(pair, changes=5) == 4
+    assert scheduler().next_interval(pair, changes=0) == 12
+
+
+def test_interval_stays_within_limits_and_staleness_slo():
+    pair = ScheduledPair("node1/db", task=None, interval=1)
+    assert scheduler().next_interval(pair, changes=1) == 1
+
+    pair.interval = 50
+    assert scheduler().next_interval(pair, changes=0) == 30
+    # Следующий цикл должен успеть завершиться до истечения SLO
+    pair.last_duration = 25
+    assert scheduler().next_interval(pair, changes=0) == 5
+    pair.last_duration = 40
+    assert scheduler().next_interval(pair, changes=0) == 1
+
+
+def test_backoff_grows_exponentially_with_jitter_up_to_maximum():
+    backoff = Backoff(base=1, maximum=10)
+
+    for failures, cap in enumerate((1, 2, 4, 8, 10, 10), start=1):
+        for _ in range(20):
+            backoff.failures = failures - 1
+            assert cap / 2 <= backoff.next_delay() <= cap
+    assert backoff.failures == 6
+
+    backoff.reset()
+    assert backoff.next_delay() <= 1
+
+
+def test_failed_cycle_backs_off_and_success_resets():
+    results = iter([ConnectionError("недоступен"), ConnectionError("недоступен"), 3])
+
+    def task():
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    planner = scheduler()
+    pair = planner.add("node1/db", task)
+    pair.interval = 8
+
+    assert 0.5 <= planner.run_once(pair) <= 1
+    assert 1 <= planner.run_once(pair) <= 2
+    assert planner.run_once(pair) == 4
+    assert pair.backoff.failures == 0
+    assert pair.last_success is not None
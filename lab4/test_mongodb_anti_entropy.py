@@ -0,0 +1,118 @@
+import mongomock
+import pytest
+
+import mongodb_anti_entropy
+import mongodb_versioning
+import sync_mongodb_replication
+
+DOCS = [{'name': f'user{i}', 'email': f'user{i}@example.com', 'created_at': '2024-01-01T00:00:00'} for i in range(20)]
+
+
+def leaf(doc):
+    """Листовая корзина документа так же, как в агрегации: по сохраненному хешу ключа, иначе по вычисленному"""
+    version = doc.get(mongodb_versioning.VERSION_FIELD) or {}
+    key_hash = version.get('key_hash', mongodb_versioning.key_hash(doc))
+    return key_hash * mongodb_anti_entropy.LEAF_BUCKETS // mongodb_anti_entropy.HASH_SPACE
+
+
+def python_level_hashes(calls):
+    """level_hashes на Python (в mongomock нет $function); calls - журнал (уровень, родители, узлов в ответе)"""
+    def level_hashes(collection, level, parents=None, query=None, expected=None):
+        span = mongodb_anti_entropy.FANOUT ** (mongodb_anti_entropy.DEPTH - level)
+        nodes, ids = {}, {}
+        for doc in collection.find(query or {}):
+            bucket = leaf(doc)
+            if parents is not None and bucket // (span * mongodb_anti_entropy.FANOUT) not in parents:
+                continue
+            content = int(mongodb_versioning.content_hash(doc), 16)
+            h1, h2, n = nodes.get(bucket // span, (0, 0, 0))
+            nodes[bucket // span] = (h1 + content, h2 + content % 65521, n + 1)
+            ids.setdefault(bucket // span, []).append(doc['_id'])
+        calls.append((level, parents, len(nodes)))
+        if expected is None:
+            return nodes
+        return nodes, [i for bucket, hashes in nodes.items() if expected.get(bucket) != hashes for i in ids[bucket]]
+    return level_hashes
+
+
+@pytest.fixture
+def replicas():
+    clients = [mongomock.MongoClient() for _ in range(3)]
+    for client in clients:
+        client.db.users.insert_many([mongodb_versioning.stamp(doc, '') for doc in DOCS])
+    return clients
+
+
+def collections(clients):
+    return [client.db.users for client in clients]
+
+
+def test_in_sync_replicas_exchange_only_roots(replicas, monkeypatch):
+    calls = []
+    monkeypatch.setattr(mongodb_anti_entropy, 'level_hashes', python_level_hashes(calls))
+    assert mongodb_anti_entropy.divergent_buckets(collections(replicas)) == ([], [])
+    assert calls == [(0, None, 1)] * 3
+
+
+def test_descent_fetches_only_divergent_subtrees(replicas, monkeypatch):
+    replicas[1].db.users.update_one({'name': 'user3'}, {'$set': {'email': 'changed@example.com'}})
+    changed = replicas[1].db.users.find_one({'name': 'user3'})
+    calls = []
+    monkeypatch.setattr(mongodb_anti_entropy, 'level_hashes', python_level_hashes(calls))
+
+    buckets, source_ids = mongodb_anti_entropy.divergent_buckets(collections(replicas))
+
+    assert buckets == [leaf(changed)] and source_ids == []
+    for level, parents, nodes in calls:
+        # Ниже корня каждый узел возвращает только потомков одного различающегося узла
+        assert level == 0 or (len(parents) == 1 and nodes <= mongodb_anti_entropy.FANOUT)
+
+
+def test_source_ids_are_returned_for_divergent_leaves(replicas, monkeypatch):
+    source = mongomock.MongoClient()
+    source.db.users.insert_many([dict(doc) for doc in DOCS])
+    source.db.users.update_one({'name': 'user7'}, {'$set': {'age': 30}})
+    monkeypatch.setattr(mongodb_anti_entropy, 'level_hashes', python_level_hashes([]))
+
+    buckets, source_ids = mongodb_anti_entropy.divergent_buckets(collections(replicas), source=source.db.users)
+
+    assert source_ids == [source.db.users.find_one({'name': 'user7'})['_id']]
+    assert buckets == [leaf(DOCS[7])]
+
+
+def test_bucket_query_selects_documents_without_stored_key_hash(replicas):
+    replicas[0].db.users.insert_one({'name': 'direct', 'email': 'direct@example.com'})
+    selected = replicas[0].db.users.find(mongodb_anti_entropy.bucket_query([leaf(DOCS[0])]))
+    assert {doc['name'] for doc in selected} == {'user0', 'direct'}
+
+
+def test_unversioned_replica_document_spreads_to_all_replicas(replicas, monkeypatch):
+    doc = {'name': 'direct', 'email': 'direct@example.com', 'created_at': '2024-01-02T00:00:00'}
+    replicas[0].db.users.insert_one(dict(doc))
+    monkeypatch.setattr(mongodb_anti_entropy, 'divergent_buckets', lambda *args: ([leaf(doc)], []))
+
+    sync_mongodb_replication.sync_between_replicas(replicas, 'db', 'users')
+
+    assert [client.db.users.count_documents({}) for client in replicas] == [len(DOCS) + 1] * 3
+    stored = replicas[2].db.users.find_one({'name': 'direct'})
+    assert stored['_version']['key_hash'] == mongodb_versioning.key_hash(doc)
+
+
+def test_source_is_read_only_by_divergent_ids(replicas, monkeypatch):
+    source = mongomock.MongoClient()
+    source.db.users.insert_many([dict(doc) for doc in DOCS])
+    source.db.users.update_one({'name': 'user7'}, {'$set': {'age': 30}})
+    monkeypatch.setattr(mongodb_anti_entropy, 'level_hashes', python_level_hashes([]))
+
+    query, source_query = sync_mongodb_replication.divergence_query(replicas[:1], 'db', 'users', source_client=source)
+
+    assert [doc['name'] for doc in source.db.users.find(source_query)] == ['user7']
+    assert {doc['name'] for doc in replicas[0].db.users.find(query)} >= {'user7'}
+
+    reads = []
+    monkeypatch.setattr(sync_mongodb_replication, 'SYNC_STREAMING', False)
+    get_all_documents = sync_mongodb_replication.get_all_documents
+    monkeypatch.setattr(sync_mongodb_replication, 'get_all_documents',
+                        lambda client, *args: reads.append((client, get_all_documents(client, *args))) or reads[-1][1])
+    sync_mongodb_replication.sync_collection(source, replicas[:1], 'db', 'users')
+    assert [[doc['name'] for doc in docs] for client, docs in reads if client is source] == [['user7']]
@@ -0,0 +1,73 @@
+import pytest
+
+import mongodb_change_stream
+from mongodb_change_stream import ChangeStreamSync, WatchedCollection, WatcherStopped
+
+
+class Stop(BaseException):
+    """Останавливает бесконечный цикл чтения в тесте"""
+
+
+class FakeStream:
+    """Поток, который возвращает заданные результаты try_next по очереди (исключения выбрасываются)"""
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.resume_token = None
+        self.closed = False
+
+    def try_next(self):
+        result = self.results.pop(0)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def close(self):
+        self.closed = True
+
+
+class State(dict):
+    def set(self, key, value):
+        self[key] = value
+
+    def delete(self, key):
+        self.pop(key, None)
+
+
+def engine(streams, monkeypatch):
+    monkeypatch.setattr(mongodb_change_stream.time, 'sleep', lambda delay: None)
+    watched = WatchedCollection('replica1', client=None, db_name='mongodb_db1', targets={})
+    sync = ChangeStreamSync([watched], full_sync=lambda: None, state=State({watched.token_key: 'token'}))
+    opened = iter(streams)
+
+    def open_stream(target):
+        target.stream = next(opened)
+        return True
+
+    monkeypatch.setattr(sync, 'open_stream', open_stream)
+    monkeypatch.setattr(mongodb_change_stream, 'node_label', lambda client: 'replica1:27017')
+    return sync, watched
+
+
+def test_unexpected_error_restarts_stream_and_requests_resync(monkeypatch):
+    broken = FakeStream([ValueError("битый документ")])
+    sync, watched = engine([broken, FakeStream([Stop()])], monkeypatch)
+
+    with pytest.raises(Stop):
+        sync.watch_loop(watched)
+
+    assert broken.closed
+    assert sync._resync_requested.is_set()
+    assert watched.token_key not in sync.state
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_dead_watcher_stops_the_process(monkeypatch):
+    sync, _ = engine([FakeStream([])], monkeypatch)
+
+    def watch_loop(watched):
+        raise Stop()
+
+    monkeypatch.setattr(sync, 'watch_loop', watch_loop)
+    with pytest.raises(WatcherStopped):
+        sync.run_forever()
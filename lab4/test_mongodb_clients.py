@@ -0,0 +1,58 @@
+import mongodb_clients
+from types import SimpleNamespace
+
+import pymongo
+import pytest
+
+import mongodb_clients
+import sync_mongodb_replication
+from mongodb_clients import MongoClientRegistry, NodeUnavailable
+from mongodb_fanout import fan_out
+from replication_metrics import metrics
+
+
+def test_registry_keeps_clients_with_different_options_apart():
+    registry = MongoClientRegistry()
+    try:
+        default = registry.get('localhost', 27017)
+        patient = registry.get('localhost', 27017, serverSelectionTimeoutMS=10000)
+
+        assert patient is not default
+        assert patient is registry.get('localhost', '27017', serverSelectionTimeoutMS=10000)
+        assert patient.options.server_selection_timeout == 10
+        assert registry.get('localhost', 27017) is default
+    finally:
+        registry.close_all()
+
+
+def test_registry_clients_limit_each_operation():
+    registry = MongoClientRegistry()
+    try:
+        client = registry.get('localhost', 27017)
+        assert client.options.pool_options.socket_timeout == mongodb_clients.NODE_TIMEOUT_SECONDS
+        assert client.options.timeout is None
+    finally:
+        registry.close_all()
+
+
+def test_node_failing_heartbeats_is_skipped_without_waiting_for_timeout(monkeypatch):
+    registry = MongoClientRegistry()
+    monkeypatch.setattr(mongodb_clients, 'registry', registry)
+    client = pymongo.MongoClient('replica1', 27017, connect=False)
+    calls = []
+    try:
+        registry._listener.failed(SimpleNamespace(connection_id=('replica1', 27017), reply=OSError('refused')))
+
+        [result] = fan_out(calls.append, [client])
+
+        assert isinstance(result, NodeUnavailable)
+        assert calls == []
+        with pytest.raises(NodeUnavailable):
+            sync_mongodb_replication.check_reachable(client, [client])
+        assert 'replication_node_up{job="mongodb",node="replica1:27017"} 0' in metrics.render_prometheus().splitlines()
+
+        registry._listener.succeeded(SimpleNamespace(connection_id=('replica1', 27017), duration=0.002))
+        assert fan_out(lambda node: 'ok', [client]) == ['ok']
+        assert registry.health()['replica1:27017'].latency_ms == 2.0
+    finally:
+        client.close()
@@ -0,0 +1,38 @@
+from mongodb_document_diff import document_patch, same_value, smaller_patch
+
+BIO = "x" * 200
+
+
+def user(**fields):
+    return {'_id': 1, 'name': 'a', 'email': 'a@example.com', 'age': 30, 'bio': BIO, **fields}
+
+
+def test_changed_and_removed_fields_become_set_and_unset():
+    existing = user(address={'city': 'Moscow', 'zip': '101000'}, note='old')
+    desired = user(age=31, address={'city': 'Kazan', 'zip': '101000'})
+
+    assert document_patch(existing, desired) == {'$set': {'age': 31, 'address.city': 'Kazan'}, '$unset': {'note': ''}}
+
+
+def test_appended_array_elements_become_push():
+    assert document_patch(user(tags=['a']), user(tags=['a', 'b', 'c'])) == {'$push': {'tags': {'$each': ['b', 'c']}}}
+    assert document_patch(user(tags=['a', 'b']), user(tags=['a', 'x'])) == {'$set': {'tags.1': 'x'}}
+    assert document_patch(user(tags=['a', 'b']), user(tags=['b'])) == {'$set': {'tags': ['b']}}
+
+
+def test_bson_types_are_compared_strictly():
+    assert not same_value(1, 1.0)
+    assert not same_value(True, 1)
+    assert document_patch(user(age=30), user(age=30.0)) == {'$set': {'age': 30.0}}
+
+
+def test_identical_documents_need_no_patch():
+    assert document_patch(user(), user()) == {}
+    assert smaller_patch(user(), user()) == {}
+
+
+def test_full_replace_when_patch_is_not_smaller_or_path_is_not_addressable():
+    assert smaller_patch(user(), user(age=31)) == {'$set': {'age': 31}}
+    # Изменились все поля - патч не меньше документа
+    assert smaller_patch({'_id': 1, 'a': 1}, {'_id': 1, 'a': 2}) is None
+    assert smaller_patch(user(**{'a.b': 1}), user(**{'a.b': 2})) is None
@@ -0,0 +1,33 @@
+import threading
+
+import pytest
+
+from mongodb_fanout import QuorumNotReached, fan_out, fan_out_quorum
+
+
+def test_fan_out_is_not_cut_by_a_step_deadline():
+    def step(delay):
+        threading.Event().wait(delay)
+        return delay
+
+    assert fan_out(step, [0.01, 0.2]) == [0.01, 0.2]
+
+
+def test_quorum_returns_before_the_slow_node_and_reports_failures():
+    release = threading.Event()
+    lagging = []
+
+    def write(node):
+        if node == 'slow':
+            release.wait(5)
+            raise ConnectionError(node)
+        return node
+
+    try:
+        assert fan_out_quorum(write, ['a', 'b', 'slow'], 2, on_lagging=lagging.append) == ['a', 'b', None]
+        assert lagging == []
+    finally:
+        release.set()
+
+    with pytest.raises(QuorumNotReached):
+        fan_out_quorum(lambda node: 1 / 0, ['a', 'b'], 1, on_lagging=lagging.append)
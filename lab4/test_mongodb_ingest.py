@@ -0,0 +1,124 @@
+import threading
+from http.server import ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+import mongomock
+import pytest
+from pymongo.errors import ServerSelectionTimeoutError
+
+import mongodb_read_router
+import mongodb_versioning
+import sync_mongodb_replication
+from mongodb_ingest import GroupCommitter, _IngestHandler, prepare
+
+DB = 'mongodb_db1'
+CREATED_AT = '2024-01-01T00:00:00'
+
+
+@pytest.fixture
+def nodes():
+    """Основной узел и три реплики с одним документом; реплики уже хранят его правку с отметкой HLC"""
+    primary, *replicas = [mongomock.MongoClient() for _ in range(4)]
+    doc = {'name': 'a', 'email': 'a@example.com', 'age': 30, 'created_at': CREATED_AT}
+    primary[DB].users.insert_one(dict(doc))
+    edited = mongodb_versioning.stamp({**primary[DB].users.find_one(), 'age': 31}, 'replica1')
+    for replica in replicas:
+        replica[DB].users.insert_one(dict(edited))
+    return primary, replicas
+
+
+def users(client):
+    return client[DB].users.find_one({'name': 'a'}, {'_version': 0})
+
+
+def sync(primary, replicas):
+    sync_mongodb_replication.sync_database_steps(primary, replicas, DB)
+
+
+def test_update_keeps_created_at_and_inserts_get_it():
+    assert 'created_at' not in prepare({'name': 'a', 'email': 'a@example.com'})
+    primary = mongomock.MongoClient()
+    primary[DB].users.insert_one({'name': 'a', 'email': 'a@example.com', 'created_at': CREATED_AT})
+    committer = GroupCommitter(DB, [primary])
+
+    committer.commit([prepare({'name': 'a', 'email': 'a@example.com', 'age': 40}),
+                      prepare({'name': 'b', 'email': 'b@example.com'})])
+
+    assert users(primary)['created_at'] == CREATED_AT
+    assert primary[DB].users.find_one({'name': 'b'})['created_at'] > CREATED_AT
+
+
+def test_commit_drops_written_keys_from_read_cache():
+    primary = mongomock.MongoClient()
+    cache_key = (DB, 'users', 'a:a@example.com')
+    mongodb_read_router.cache.put(cache_key, {'_id': 1, 'name': 'a', 'email': 'a@example.com'})
+    GroupCommitter(DB, [primary]).commit([prepare({'name': 'a', 'email': 'a@example.com', 'age': 40})])
+    assert mongodb_read_router.cache.get(cache_key) is None
+
+
+def test_gateway_update_beats_earlier_replica_edit_on_lagging_replica(nodes):
+    primary, replicas = nodes
+    # Третья реплика не получила пакет шлюза и хранит прежнюю правку
+    GroupCommitter(DB, [primary] + replicas[:2]).commit([prepare({'name': 'a', 'email': 'a@example.com', 'age': 50})])
+
+    sync(primary, replicas)
+
+    assert [users(client)['age'] for client in [primary] + replicas] == [50] * 4
+    assert users(replicas[2])['created_at'] == CREATED_AT
+
+
+def test_primary_edit_after_gateway_write_reaches_replicas(nodes):
+    primary, replicas = nodes
+    GroupCommitter(DB, [primary] + replicas).commit([prepare({'name': 'a', 'email': 'a@example.com', 'age': 50})])
+    sync(primary, replicas)
+    primary[DB].users.update_one({'name': 'a'}, {'$set': {'age': 60}})
+
+    sync(primary, replicas)
+
+    assert [users(replica)['age'] for replica in replicas] == [60] * 3
+    assert '_version' not in primary[DB].users.find_one({'name': 'a'})
+    versions = [replica[DB].users.find_one({'name': 'a'})['_version'] for replica in replicas]
+    # Следующий цикл ничего не переписывает: версия из источника совпадает с основным узлом
+    sync(primary, replicas)
+    assert [replica[DB].users.find_one({'name': 'a'})['_version'] for replica in replicas] == versions
+
+
+def test_read_returns_503_when_replicas_are_unavailable():
+    class UnavailableRouter:
+        def find_by_key(self, db_name, name, email):
+            raise ServerSelectionTimeoutError("rs1 не инициализирован")
+
+    handler = type("Handler", (_IngestHandler,), {'committers': {DB: None}, 'router': UnavailableRouter()})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with pytest.raises(HTTPError) as error:
+            urlopen(f"http://127.0.0.1:{server.server_port}/{DB}?name=a&email=a@example.com", timeout=5)
+        assert error.value.code == 503
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_concurrent_submits_are_committed_as_one_batch(monkeypatch):
+    batches = []
+    committer = GroupCommitter(DB, [mongomock.MongoClient()], batch_size=3, batch_wait_ms=1000)
+    monkeypatch.setattr(committer, 'commit', lambda docs: batches.append(len(docs)) or 1)
+
+    futures = [committer.submit([prepare({'name': f'u{i}', 'email': f'u{i}@example.com'})]) for i in range(3)]
+
+    assert [future.result(timeout=5) for future in futures] == [1, 1, 1]
+    # Пакет закрылся по размеру, не дожидаясь batch_wait_ms
+    assert batches == [3]
+
+
+def test_failed_batch_fails_every_submitted_write(monkeypatch):
+    committer = GroupCommitter(DB, [mongomock.MongoClient()], batch_wait_ms=1)
+
+    def commit(docs):
+        raise ServerSelectionTimeoutError("кворум не набран")
+
+    monkeypatch.setattr(committer, 'commit', commit)
+    with pytest.raises(ServerSelectionTimeoutError):
+        committer.submit([prepare({'name': 'a', 'email': 'a@example.com'})]).result(timeout=5)
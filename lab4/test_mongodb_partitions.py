@@ -0,0 +1,54 @@
+import mongomock
+
+from mongodb_partitions import partition_bounds, partition_filters
+
+DOCS = [
+    {'name': 'a', 'email': 'a@example.com'},
+    {'name': 'm', 'email': 'm@example.com'},
+    {'name': 'ma', 'email': 'ma@example.com'},
+    {'name': 't', 'email': 't@example.com'},
+    {'name': 'z', 'email': 'z@example.com'},
+    # Документы без ключа name:email: сопоставляются по _id и попадают в отдельный раздел
+    {'name': '', 'email': 'empty@example.com'},
+    {'name': 'x'},
+    {'name': 42, 'email': 'number@example.com'},
+    {'email': 'noname@example.com'},
+    {'name': None, 'email': None},
+]
+
+
+def collection():
+    users = mongomock.MongoClient()['mongodb_db1'].users
+    users.insert_many([dict(doc) for doc in DOCS])
+    return users
+
+
+def test_partitions_cover_every_document_exactly_once():
+    users = collection()
+
+    for bounds in ([], ['m'], ['m', 't'], ['b', 'ma', 'z']):
+        filters = partition_filters(bounds)
+        assert len(filters) == len(bounds) + 2
+        hits = {}
+        for index, query in enumerate(filters):
+            for doc in users.find(query):
+                hits.setdefault(doc['_id'], []).append(index)
+        assert sorted(hits) == sorted(doc['_id'] for doc in users.find())
+        assert all(len(indexes) == 1 for indexes in hits.values())
+
+
+def test_bound_value_belongs_to_the_upper_partition():
+    users = collection()
+
+    filters = partition_filters(['m', 't'])
+
+    assert [sorted(doc['name'] for doc in users.find(query)) for query in filters[:-1]] == \
+        [['a'], ['m', 'ma'], ['t', 'z']]
+
+
+def test_bounds_are_increasing_key_names():
+    bounds = partition_bounds(collection(), 4)
+
+    assert bounds == sorted(set(bounds))
+    assert set(bounds) <= {'a', 'm', 'ma', 't', 'z'}
+    assert 1 <= len(bounds) <= 3
@@ -0,0 +1,48 @@
+import bson
+from bson.raw_bson import RawBSONDocument
+
+from mongodb_raw import RawBackedDoc, as_raw, split_in_sync
+
+VERSION = {'hlc': 1, 'node': '', 'hash': 'h'}
+
+
+def raw(doc_id, name, **fields):
+    return RawBSONDocument(bson.encode({'_id': doc_id, 'name': name, **fields}))
+
+
+def key(doc):
+    return doc['name']
+
+
+def test_keys_equal_on_every_node_are_skipped_without_parsing():
+    nodes = [
+        [raw(1, 'a', _version=VERSION), raw(2, 'b', _version=VERSION), raw(3, 'c', age=1)],
+        [raw(1, 'a', _version=VERSION), raw(2, 'b', _version=VERSION, age=2), raw(3, 'c', age=1)],
+    ]
+
+    result, skipped = split_in_sync(nodes, key)
+
+    # a совпадает побайтно и с версией; c совпадает, но версии еще нет - ее нужно записать
+    assert skipped == 1
+    assert [[doc['name'] for doc in docs] for docs in result] == [['b', 'c'], ['b', 'c']]
+    assert all(isinstance(doc, RawBackedDoc) for docs in result for doc in docs)
+    # Неизмененный документ записывается теми же байтами
+    assert as_raw(result[0][0]).raw == nodes[0][1].raw
+
+
+def test_key_missing_on_a_node_is_merged_and_unavailable_node_is_ignored():
+    nodes = [[raw(1, 'a', _version=VERSION)], [], None, [raw(1, 'a', _version=VERSION)]]
+
+    result, skipped = split_in_sync(nodes, key)
+
+    assert skipped == 0
+    assert [None if docs is None else [doc['name'] for doc in docs] for docs in result] == [['a'], [], None, ['a']]
+
+    result, skipped = split_in_sync([nodes[0], None, nodes[3]], key)
+    assert (result, skipped) == ([[], None, []], 1)
+
+
+def test_parsed_documents_are_returned_as_is():
+    nodes = [[{'_id': 1, 'name': 'a'}], [{'_id': 1, 'name': 'a'}]]
+
+    assert split_in_sync(nodes, key) == (nodes, 0)
@@ -0,0 +1,107 @@
+import time
+
+from pymongo.errors import OperationFailure, ServerSelectionTimeoutError
+
+import mongodb_read_router
+from mongodb_read_router import CHANGE_STREAM_NOT_SUPPORTED, LookupCache, ReadRouter
+
+
+def doc(doc_id, name='a'):
+    return {'_id': doc_id, 'name': name, 'email': f'{name}@example.com'}
+
+
+def test_cache_evicts_least_recently_used():
+    cache = LookupCache(max_size=2, ttl=60)
+    cache.put(('db', 'users', 'a'), doc(1))
+    cache.put(('db', 'users', 'b'), doc(2))
+    cache.get(('db', 'users', 'a'))
+    cache.put(('db', 'users', 'c'), doc(3))
+    assert cache.get(('db', 'users', 'b')) is None
+    assert cache.get(('db', 'users', 'a')) == doc(1)
+
+
+def test_cache_entries_expire():
+    cache = LookupCache(ttl=0.01)
+    cache.put(('db', 'users', 'a'), doc(1))
+    time.sleep(0.02)
+    assert cache.get(('db', 'users', 'a')) is None
+
+
+def test_cache_invalidates_by_key_and_id():
+    cache = LookupCache(ttl=60)
+    cache.put(('db', 'users', 'a'), doc(1))
+    cache.put(('db', 'users', 'b'), doc(2))
+    cache.invalidate_keys('db', 'users', ['a'])
+    assert cache.invalidate_ids('db', 'users', [2, 3]) == 1
+    assert len(cache) == 0
+
+
+class FakeStream:
+    def __init__(self, on_iter, changes):
+        self.on_iter = on_iter
+        self.changes = changes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __iter__(self):
+        self.on_iter()
+        return iter(self.changes)
+
+
+class FakeCollection:
+    """Первый watch отдает события, следующий - ошибку узла без replica set"""
+
+    def __init__(self, stream):
+        self.streams = [stream]
+
+    def watch(self, pipeline):
+        if not self.streams:
+            raise OperationFailure("not a replica set", code=CHANGE_STREAM_NOT_SUPPORTED)
+        return self.streams.pop()
+
+
+def test_change_stream_drops_changed_documents_and_stops_without_replica_set():
+    cache = LookupCache(ttl=60)
+
+    def fill():
+        cache.put(('db', 'users', 'a'), doc(1, 'a'))
+        cache.put(('db', 'users', 'b'), doc(2, 'b'))
+
+    collection = FakeCollection(FakeStream(fill, [{'documentKey': {'_id': 1}}]))
+    router = ReadRouter({'db': {'users': collection}}, lookup_cache=cache)
+
+    router._watch('db')
+
+    assert cache.get(('db', 'users', 'a')) is None
+    assert cache.get(('db', 'users', 'b')) == doc(2, 'b')
+
+
+def read_client(monkeypatch, replies):
+    def hello(host, port, username=None, password=None):
+        reply = replies[host]
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    monkeypatch.setattr(mongodb_read_router, 'hello', hello)
+    monkeypatch.setattr(mongodb_read_router, 'get_client', lambda *args, **options: (args, options))
+    return mongodb_read_router.get_read_client('admin', 'adminpass', hosts='replica1:27017,replica2:27017')
+
+
+def test_read_client_uses_replica_set_when_nodes_report_set_name(monkeypatch):
+    args, options = read_client(monkeypatch, {'replica1': {'isWritablePrimary': True, 'setName': 'rs1'}})
+
+    assert args == ('replica1:27017,replica2:27017', 27017, 'admin', 'adminpass')
+    assert options['replicaset'] == 'rs1'
+
+
+def test_read_client_connects_directly_to_standalone_node(monkeypatch):
+    args, options = read_client(monkeypatch, {'replica1': ServerSelectionTimeoutError('down'),
+                                              'replica2': {'isWritablePrimary': True}})
+
+    assert args == ('replica2', '27017', 'admin', 'adminpass')
+    assert options == {'directConnection': True}
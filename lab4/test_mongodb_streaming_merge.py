@@ -0,0 +1,32 @@
+from bson import ObjectId
+
+from mongodb_streaming_merge import merge_key
+
+
+def test_documents_with_the_same_key_merge_regardless_of_id():
+    assert merge_key({'_id': ObjectId(), 'name': 'a', 'email': 'a@example.com', 'age': 1}) == \
+        merge_key({'_id': ObjectId(), 'name': 'a', 'email': 'a@example.com', 'age': 2})
+
+
+def test_keyless_documents_are_told_apart_by_id():
+    first, second = ObjectId(), ObjectId()
+
+    assert merge_key({'_id': first, 'name': 'a'}) != merge_key({'_id': second, 'name': 'a'})
+    assert merge_key({'_id': first, 'name': 'a'}) < merge_key({'_id': second, 'name': 'a'})
+    assert merge_key({'_id': first, 'name': '', 'email': 'a@example.com'}) == \
+        merge_key({'_id': first, 'name': '', 'email': 'a@example.com'})
+
+
+def test_order_follows_mongodb_sort_by_name_email_id():
+    docs = [
+        {'_id': 1, 'name': 'b', 'email': 'a@example.com'},
+        {'_id': 2, 'name': 'a', 'email': 'b@example.com'},
+        {'_id': 3, 'name': 'a', 'email': 'a@example.com'},
+        {'_id': 4, 'name': 10, 'email': 'n@example.com'},
+        {'_id': 5, 'email': 'noname@example.com'},
+        {'_id': 6, 'name': True, 'email': 'bool@example.com'},
+        {'_id': 7, 'name': 'a'},
+    ]
+
+    # null (нет поля) < числа < строки < bool, как при сортировке курсора
+    assert [doc['_id'] for doc in sorted(docs, key=merge_key)] == [5, 4, 7, 3, 2, 1, 6]
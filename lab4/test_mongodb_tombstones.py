@@ -0,0 +1,85 @@
+import mongomock
+import pytest
+
+import mongodb_tombstones
+import mongodb_versioning
+import sync_mongodb_replication
+
+DB = 'mongodb_db1'
+CREATED_AT = '2024-01-01T00:00:00'
+
+
+@pytest.fixture
+def nodes():
+    """Основной узел и три реплики с одним документом, уже синхронизированным из основного узла"""
+    primary, *replicas = [mongomock.MongoClient(f'mongodb://{name}:27017')
+                          for name in ('primary', 'replica1', 'replica2', 'replica3')]
+    primary[DB].users.insert_one({'name': 'a', 'email': 'a@example.com', 'age': 30, 'created_at': CREATED_AT})
+    sync_mongodb_replication.sync_database(primary, replicas, DB)
+    return primary, replicas
+
+
+def ages(clients):
+    return [doc['age'] if doc else None for doc in (client[DB].users.find_one({'name': 'a'}) for client in clients)]
+
+
+def delete_on_replica(replicas):
+    deleted = mongodb_tombstones.delete_document(replicas[0], DB, 'users', {'name': 'a'}, 'replica1:27017')
+    assert deleted == 1
+
+
+def test_replica_delete_spreads_and_never_touches_primary(nodes):
+    primary, replicas = nodes
+    delete_on_replica(replicas)
+
+    sync_mongodb_replication.sync_database(primary, replicas, DB)
+    sync_mongodb_replication.sync_database(primary, replicas, DB)
+
+    assert ages(replicas) == [None] * 3
+    assert ages([primary]) == [30]
+    assert mongodb_tombstones.TOMBSTONE_COLLECTION not in primary[DB].list_collection_names()
+    # Надгробие живет, пока документ не изменен в основном узле, и помнит его содержимое
+    tombstones = mongodb_tombstones.load(replicas, DB, 'users')
+    assert [tombstone['source_hash'] for tombstone in tombstones.values()] == \
+        [mongodb_versioning.content_hash(primary[DB].users.find_one())]
+
+
+def test_primary_edit_after_delete_revives_document(nodes):
+    primary, replicas = nodes
+    delete_on_replica(replicas)
+    sync_mongodb_replication.sync_database(primary, replicas, DB)
+
+    primary[DB].users.update_one({'name': 'a'}, {'$set': {'age': 31}})
+    sync_mongodb_replication.sync_database(primary, replicas, DB)
+    sync_mongodb_replication.sync_database(primary, replicas, DB)
+
+    assert ages(replicas) == [31] * 3
+    # Все узлы подтвердили надгробие, и оно удалено
+    assert mongodb_tombstones.load(replicas, DB, 'users') == {}
+
+
+def test_revived_document_beats_tombstone():
+    tombstones = {1: {'hlc': 100, 'node': 'replica1:27017', 'acks': set(), 'source_hash': 'old'}}
+    doc = mongodb_versioning.observe({'_id': 1, 'name': 'a', 'email': 'a@example.com', 'created_at': CREATED_AT}, '')
+
+    revived = mongodb_tombstones.resolve_source(doc, tombstones)
+
+    assert mongodb_versioning.version_key(revived)[0] == 101
+    assert not mongodb_tombstones.killed(revived, tombstones)
+    assert mongodb_tombstones.resolve_source(doc, {1: {**tombstones[1], 'source_hash': doc['_version']['hash']}}) is None
+    # Пока основной узел не обработал надгробие, документ считается удаленным
+    assert mongodb_tombstones.resolve_source(doc, {1: {'hlc': 100, 'node': '', 'acks': set()}}) is None
+
+
+def test_plain_delete_on_replica_in_poll_mode_is_not_resurrected(nodes):
+    primary, replicas = nodes
+    replicas[1][DB].users.insert_one({'name': 'b', 'email': 'b@example.com', 'age': 40, 'created_at': CREATED_AT})
+    sync_mongodb_replication.sync_database(primary, replicas, DB)
+
+    # Обычный deleteOne без надгробия, как при ручном удалении в режиме опроса
+    replicas[0][DB].users.delete_one({'name': 'b'})
+    sync_mongodb_replication.sync_database(primary, replicas, DB)
+    sync_mongodb_replication.sync_database(primary, replicas, DB)
+
+    assert [client[DB].users.find_one({'name': 'b'}) for client in replicas] == [None] * 3
+    assert ages(replicas) == [30] * 3
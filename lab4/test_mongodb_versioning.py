@@ -0,0 +1,57 @@
+from bson import ObjectId
+
+import mongodb_versioning
+from mongodb_versioning import HybridLogicalClock, decode, encode, observe, stamp, version_key
+
+DOC = {'_id': 1, 'name': 'a', 'email': 'a@example.com', 'age': 30, 'created_at': '2024-01-01T00:00:00'}
+
+
+def test_clock_is_monotonic_within_one_millisecond(monkeypatch):
+    monkeypatch.setattr(mongodb_versioning.time, 'time', lambda: 1700000000.0)
+    clock = HybridLogicalClock()
+    stamps = [clock.now() for _ in range(3)]
+    assert stamps == sorted(set(stamps))
+    assert [decode(hlc)[1] for hlc in stamps] == [0, 1, 2]
+
+
+def test_clock_moves_past_remote_stamps_from_the_future(monkeypatch):
+    monkeypatch.setattr(mongodb_versioning.time, 'time', lambda: 1700000000.0)
+    clock = HybridLogicalClock()
+    remote = encode(1700000000000 + 60000, 5)
+    assert clock.update(remote) == encode(1700000000000 + 60000, 6)
+    assert clock.now() > remote
+
+
+def test_observe_keeps_valid_versions_and_restamps_edits():
+    stamped = stamp(DOC, 'replica1', hlc=encode(1000))
+    assert observe(stamped, 'replica2') is stamped
+
+    edited = observe({**stamped, 'age': 31}, 'replica2')
+    assert edited[mongodb_versioning.VERSION_FIELD]['node'] == 'replica2'
+    assert version_key(edited) > version_key(stamped)
+
+
+def test_unversioned_documents_get_the_same_legacy_version_on_every_node():
+    first, second = observe(dict(DOC), 'replica1'), observe(dict(DOC), 'replica2')
+    assert first[mongodb_versioning.VERSION_FIELD] == second[mongodb_versioning.VERSION_FIELD]
+    assert decode(version_key(first)[0])[0] == 1704067200000
+
+    oid = ObjectId()
+    by_id = observe({'_id': oid, 'name': 'b', 'email': 'b@example.com'}, 'replica1')
+    assert decode(version_key(by_id)[0])[0] == int(oid.generation_time.timestamp() * 1000)
+
+
+def test_source_edit_beats_recorded_source_version():
+    recorded = stamp(DOC, '', source=True)
+    edited = observe({**DOC, 'age': 31}, '')
+    assert version_key(edited) < version_key(recorded)
+    assert mongodb_versioning.is_source_update(edited, recorded)
+    assert not mongodb_versioning.is_source_update(observe(dict(DOC), ''), recorded)
+    # Правка реплики (узел не '') сравнивается по HLC
+    assert not mongodb_versioning.is_source_update(edited, stamp(DOC, 'replica1'))
+
+
+def test_key_hash_depends_only_on_the_key():
+    assert mongodb_versioning.key_hash(DOC) == mongodb_versioning.key_hash({**DOC, '_id': 2, 'age': 99})
+    assert mongodb_versioning.key_hash(DOC) != mongodb_versioning.key_hash({**DOC, 'email': 'b@example.com'})
+    assert 0 <= mongodb_versioning.key_hash({'_id': 'ключ 🙂'}) < 2 ** 32
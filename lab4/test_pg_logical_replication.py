@@ -0,0 +1,153 @@
+import struct
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("psycopg2")
+from psycopg2 import sql
+
+import pg_logical_replication
+from pg_logical_replication import UNCHANGED, LogicalReplicator, Relation
+
+
+def replicator():
+    return LogicalReplicator({"dsn": "postgresql://source", "db": "sourcedb1"}, "postgresql://replica", state={})
+
+
+def test_delete_with_full_identity_on_keyed_table_matches_primary_key_only():
+    relation = Relation("public", "users", ["id", "name", "note"], ["id", "name", "note"], ["id"])
+
+    query, params = replicator().delete_statement(relation, ["1", "a", None])
+
+    assert query == sql.SQL("DELETE FROM {} WHERE {}").format(
+        relation.identifier, sql.SQL(" AND ").join([sql.SQL("{} = %s").format(sql.Identifier("id"))]))
+    assert params == ["1"]
+
+
+def test_delete_without_primary_key_removes_one_row_matching_nulls():
+    relation = Relation("public", "events", ["kind", "note", "payload"], ["kind", "note", "payload"])
+
+    query, params = replicator().delete_statement(relation, ["click", None, UNCHANGED])
+
+    condition = sql.SQL(" AND ").join(
+        sql.SQL("{} IS NOT DISTINCT FROM %s").format(sql.Identifier(col)) for col in ("kind", "note"))
+    assert query == sql.SQL("DELETE FROM {0} WHERE ctid = (SELECT ctid FROM {0} WHERE {1} LIMIT 1)").format(
+        relation.identifier, condition)
+    assert params == ["click", None]
+
+
+def column(kind, value=None):
+    if kind == "t":
+        data = value.encode()
+        return b"t" + struct.pack("!i", len(data)) + data
+    return kind.encode()
+
+
+def tuple_data(*columns):
+    return struct.pack("!h", len(columns)) + b"".join(columns)
+
+
+def relation_message(relid, schema, name, columns):
+    body = b"".join(struct.pack("!b", flags) + col.encode() + b"\0" + struct.pack("!ii", 23, -1)
+                    for col, flags in columns)
+    return (b"R" + struct.pack("!i", relid) + schema.encode() + b"\0" + name.encode() + b"\0" + b"f"
+            + struct.pack("!h", len(columns)) + body)
+
+
+class FakeCursor:
+    def __init__(self, log):
+        self.log = log
+        self.feedback = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        self.log.append((query, params))
+
+    def send_feedback(self, flush_lsn):
+        self.feedback.append(flush_lsn)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.executed = []
+        self.commits = 0
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self.executed)
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        self.closed = True
+
+
+class State(dict):
+    def set(self, key, value):
+        self[key] = value
+
+
+def test_pgoutput_transaction_is_decoded_and_applied_in_one_commit(monkeypatch):
+    monkeypatch.setattr(pg_logical_replication.psycopg2, "connect", lambda dsn: FakeConnection())
+    monkeypatch.setattr(pg_logical_replication, "ensure_replica_table", lambda *args: None)
+    monkeypatch.setattr(pg_logical_replication, "primary_key", lambda cur, schema, name: ["id"])
+    replicator = LogicalReplicator({"dsn": "postgresql://source", "db": "sourcedb1"}, "postgresql://replica", State())
+    replicator.replica_conn = FakeConnection()
+    stream = FakeCursor([])
+
+    def send(payload):
+        replicator.handle_message(SimpleNamespace(payload=payload, cursor=stream))
+
+    send(b"B" + struct.pack("!qqi", 0x100, 0, 7))
+    send(relation_message(16384, "public", "users", [("id", 1), ("name", 0), ("bio", 0)]))
+    send(b"I" + struct.pack("!i", 16384) + b"N" + tuple_data(column("t", "1"), column("t", "a"), column("n")))
+    send(b"U" + struct.pack("!i", 16384) + b"N" + tuple_data(column("t", "1"), column("t", "b"), column("u")))
+    send(b"D" + struct.pack("!i", 16384) + b"K" + tuple_data(column("t", "2"), column("n"), column("n")))
+    assert replicator.replica_conn.commits == 0
+    send(b"C" + struct.pack("!bqqq", 0, 0x100, 0x1A0, 0))
+
+    relation = replicator.relations[16384]
+    assert (relation.schema, relation.name, relation.columns, relation.key_columns) == \
+        ("public", "users", ["id", "name", "bio"], ["id"])
+    params = [params for _, params in replicator.replica_conn.executed]
+    # Неизмененное TOAST-значение (u) не перезаписывается
+    assert params == [["1", "a", None], ["1", "b"], ["2"]]
+    assert replicator.replica_conn.commits == 1
+    assert stream.feedback == [0x1A0]
+    assert replicator.state[replicator.lsn_key] == "0/1A0"
+
+
+def test_run_closes_replication_and_replica_connections(monkeypatch):
+    connections = []
+
+    class ReplicationCursor(FakeCursor):
+        def start_replication(self, **options):
+            pass
+
+        def consume_stream(self, consumer):
+            raise ValueError("битое сообщение")
+
+    class ReplicationConnection(FakeConnection):
+        def cursor(self):
+            return ReplicationCursor(self.executed)
+
+    def connect(dsn, connection_factory=None):
+        connections.append(ReplicationConnection() if connection_factory else FakeConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(pg_logical_replication.psycopg2, "connect", connect)
+    replicator = LogicalReplicator({"dsn": "postgresql://source", "db": "sourcedb1"}, "postgresql://replica", State())
+    monkeypatch.setattr(replicator, "ensure_publication", lambda: True)
+    monkeypatch.setattr(replicator, "initial_copy", lambda slot_exists: None)
+
+    replicator.run()
+
+    assert len(connections) == 2
+    assert all(conn.closed for conn in connections)
+    assert replicator.replica_conn is None
@@ -0,0 +1,71 @@
+import pytest
+
+from replication_metrics import Histogram, MetricsRegistry
+
+
+def test_histogram_value_on_bucket_edge_falls_into_that_bucket():
+    histogram = Histogram(buckets=(0.1, 1))
+    for value in (0.1, 0.5, 1, 2):
+        histogram.observe(value)
+
+    assert histogram.cumulative() == [(0.1, 1), (1, 3), (float("inf"), 4)]
+    assert histogram.sum == 3.6
+    assert histogram.count == 4
+
+
+def test_prometheus_text_format():
+    registry = MetricsRegistry()
+    registry.inc("replication_errors_total", job="mongodb", node='host "a"\\b\n')
+    registry.observe("replication_node_latency_seconds", 0.001, job="mongodb", node="r1", command="find")
+
+    lines = registry.render_prometheus().splitlines()
+
+    assert lines[:3] == [
+        "# HELP replication_errors_total Ошибки синхронизации",
+        "# TYPE replication_errors_total counter",
+        'replication_errors_total{job="mongodb",node="host \\"a\\"\\\\b\\n",db="",table="",pair=""} 1',
+    ]
+    labels = 'job="mongodb",node="r1",command="find"'
+    assert "# TYPE replication_node_latency_seconds histogram" in lines
+    assert f'replication_node_latency_seconds_bucket{{{labels},le="0.001"}} 1' in lines
+    assert f'replication_node_latency_seconds_bucket{{{labels},le="+Inf"}} 1' in lines
+    assert f"replication_node_latency_seconds_sum{{{labels}}} 0.001" in lines
+    assert f"replication_node_latency_seconds_count{{{labels}}} 1" in lines
+
+
+def test_metric_keeps_one_label_schema():
+    registry = MetricsRegistry()
+    registry.inc("replication_errors_total", job="mongodb", db="mongodb_db1")
+    registry.inc("replication_errors_total", job="postgres_snapshot", table="public.users")
+
+    series = registry.snapshot()["counters"]["replication_errors_total"]
+
+    assert [list(item["labels"]) for item in series] == [["job", "node", "db", "table", "pair"]] * 2
+    with pytest.raises(ValueError):
+        registry.inc("replication_errors_total", job="mongodb", collection="users")
+    with pytest.raises(ValueError):
+        registry.inc("replication_unknown_total", job="mongodb")
+
+
+def test_gauge_functions_that_fail_or_return_none_are_skipped():
+    registry = MetricsRegistry()
+    registry.set_function("replication_lag_seconds", lambda: 1 / 0, job="mongodb", db="a")
+    registry.set_function("replication_lag_seconds", lambda: None, job="mongodb", db="b")
+    registry.set_function("replication_lag_seconds", lambda: 2.5, job="mongodb", db="c")
+
+    gauges = registry.snapshot()["gauges"]["replication_lag_seconds"]
+
+    assert [(item["labels"]["db"], item["value"]) for item in gauges] == [("c", 2.5)]
+
+
+def test_gauge_function_may_use_the_registry():
+    registry = MetricsRegistry()
+
+    def pending():
+        # Вызов под блокировкой реестра привел бы к взаимоблокировке
+        registry.inc("replication_errors_total", job="mongodb")
+        return 3
+
+    registry.set_function("replication_catchup_pending", pending, job="mongodb")
+
+    assert 'replication_catchup_pending{job="mongodb"} 3' in registry.render_prometheus().splitlines()
@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+import snapshot_archive
+from snapshot_archive import SnapshotError, SnapshotWriter, read_chunk, read_manifest, totals
+
+
+def write_snapshot(directory, chunks_per_item):
+    writer = SnapshotWriter(str(directory), "mongodb", "mongodb_node1", compression="zlib")
+    for name, chunks in chunks_per_item.items():
+        item = writer.add_item(name)
+        for data in chunks:
+            writer.write_chunk(item, data, rows=len(data))
+    return writer.finish()
+
+
+def mtimes(directory):
+    return {name: os.stat(directory / name).st_mtime_ns for name in os.listdir(directory) if name.endswith(".zz")}
+
+
+def test_chunks_round_trip_with_checksum(tmp_path):
+    manifest = write_snapshot(tmp_path, {"mongodb_db1.users": [b"first", b"second"]})
+
+    assert read_manifest(str(tmp_path)) == manifest
+    [item] = manifest["items"]
+    assert [read_chunk(str(tmp_path), manifest, chunk) for chunk in item["chunks"]] == [b"first", b"second"]
+    assert totals(manifest)[:2] == (11, 11)
+
+    with open(tmp_path / item["chunks"][0]["file"], "wb") as f:
+        f.write(snapshot_archive.compress(b"corrupted", "zlib"))
+    with pytest.raises(SnapshotError):
+        read_chunk(str(tmp_path), manifest, item["chunks"][0])
+
+
+def test_rewrite_keeps_unchanged_chunks_and_removes_orphans(tmp_path):
+    write_snapshot(tmp_path, {"mongodb_db1.users": [b"a" * 100, b"b" * 100, b"c" * 100], "mongodb_db2.users": [b"d"]})
+    for name in mtimes(tmp_path):
+        os.utime(tmp_path / name, ns=(0, 0))
+
+    write_snapshot(tmp_path, {"mongodb_db1.users": [b"a" * 100, b"B" * 100]})
+
+    after = mtimes(tmp_path)
+    assert sorted(after) == ["mongodb_db1.users.00000.zz", "mongodb_db1.users.00001.zz"]
+    # Совпадающая часть не перезаписывается, измененная - перезаписывается
+    assert after["mongodb_db1.users.00000.zz"] == 0
+    assert after["mongodb_db1.users.00001.zz"] != 0
+    manifest = read_manifest(str(tmp_path))
+    assert [read_chunk(str(tmp_path), manifest, chunk) for chunk in manifest["items"][0]["chunks"]] == \
+        [b"a" * 100, b"B" * 100]
+
+
+def test_directory_without_manifest_is_unfinished_snapshot(tmp_path):
+    with pytest.raises(SnapshotError):
+        read_manifest(str(tmp_path))
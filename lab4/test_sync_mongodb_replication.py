@@ -0,0 +1,48 @@
+from pymongo import DeleteOne, ReplaceOne, UpdateOne
+
+import sync_mongodb_replication
+from sync_mongodb_replication import compute_diff, get_doc_key
+
+BIO = "x" * 200
+
+
+def user(doc_id, name='a', **fields):
+    return {'_id': doc_id, 'name': name, 'email': f'{name}@example.com', 'age': 30, 'bio': BIO, **fields}
+
+
+def desired(*docs):
+    return {get_doc_key(doc): doc for doc in docs}
+
+
+def test_new_documents_are_upserted_and_equal_ones_skipped():
+    ops = compute_diff([user(1)], desired(user(1), user(2, 'b')))
+
+    assert ops == [ReplaceOne({'_id': 2}, user(2, 'b'), upsert=True)]
+    assert ops.payload_bytes > 0
+    assert compute_diff([user(1)], desired(user(1))) == []
+
+
+def test_changed_document_is_patched_against_the_read_version(monkeypatch):
+    monkeypatch.setattr(sync_mongodb_replication, 'FIELD_PATCHES', True)
+    existing = user(1, _version={'hlc': 1, 'node': 'replica1:27017'})
+    newer = user(1, age=31, _version={'hlc': 2, 'node': 'replica1:27017'})
+
+    assert compute_diff([existing], desired(newer)) == \
+        [UpdateOne({'_id': 1, '_version': existing['_version']}, {'$set': {'age': 31, '_version.hlc': 2}})]
+
+    monkeypatch.setattr(sync_mongodb_replication, 'FIELD_PATCHES', False)
+    assert compute_diff([existing], desired(newer)) == [ReplaceOne({'_id': 1}, newer)]
+
+
+def test_same_key_under_another_id_is_moved_and_duplicates_removed():
+    assert compute_diff([user(1)], desired(user(2, age=31))) == \
+        [DeleteOne({'_id': 1}), ReplaceOne({'_id': 2}, user(2, age=31), upsert=True)]
+    # Из дубликатов по ключу остается документ с _id победившей версии
+    assert compute_diff([user(1), user(2)], desired(user(2))) == [DeleteOne({'_id': 1})]
+
+
+def test_missing_documents_are_deleted_only_on_request():
+    existing = [user(1), user(2, 'b')]
+
+    assert compute_diff(existing, desired(user(1))) == []
+    assert compute_diff(existing, desired(user(1)), delete_missing=True) == [DeleteOne({'_id': 2})]
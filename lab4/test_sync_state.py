@@ -0,0 +1,46 @@
+import threading
+
+from sync_state import SyncStateStore, open_store
+
+
+def test_values_round_trip(tmp_path):
+    store = SyncStateStore(str(tmp_path / "state.db"))
+    store.set("lsn:sourcedb1", "0/1A0")
+    store.set("partitions:mongodb_db1.users", {'bounds': ['a', 'm'], 'done': [0]})
+
+    assert store.get("lsn:sourcedb1") == "0/1A0"
+    assert store.get("partitions:mongodb_db1.users") == {'bounds': ['a', 'm'], 'done': [0]}
+    assert store.get("missing", "default") == "default"
+
+    store.delete("lsn:sourcedb1")
+    assert store.get("lsn:sourcedb1") is None
+
+
+def test_values_survive_reopen(tmp_path):
+    path = str(tmp_path / "state" / "sync_state.db")
+    SyncStateStore(path).set("token:replica1/mongodb_db1", {'_data': '8265'})
+
+    assert SyncStateStore(path).get("token:replica1/mongodb_db1") == {'_data': '8265'}
+    assert open_store(path) is open_store(path)
+
+
+def test_concurrent_writers_share_one_file(tmp_path):
+    path = str(tmp_path / "sync_state.db")
+    # Отдельные соединения - как у двух процессов, работающих с одним файлом
+    stores = [SyncStateStore(path), SyncStateStore(path)]
+    assert stores[0]._conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+    def write(writer):
+        for i in range(50):
+            stores[writer].set(f"table:{writer}:{i}", i)
+            stores[writer].set("shared", writer)
+
+    threads = [threading.Thread(target=write, args=(writer,)) for writer in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    reader = SyncStateStore(path)
+    assert [reader.get(f"table:{writer}:{i}") for writer in range(2) for i in range(50)] == list(range(50)) * 2
+    assert reader.get("shared") in (0, 1)